@@ -0,0 +1,196 @@
+# BehaviorEngine/callback_ack.py
+# Ранний ответ на callback_query: "часики" на кнопке снимаются сразу при получении апдейта,
+# а не после чтения состояния, БД и вызовов AI в хендлерах
+
+# === BLOCK 1: Imports ===
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from telegram import CallbackQuery, Update
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Deferred-Answer Registry ===
+# Сколько ждать ответа хендлера для отложенных callback, прежде чем ответить пустым
+ACK_DEFER_DEADLINE = 1.0  # секунд
+
+_deferred_answer_patterns: List[re.Pattern] = []
+
+
+def register_deferred_answer(pattern: str) -> None:
+    """
+    Объявляет callback_data (regex, re.match), на которые отвечает сам хендлер
+    через answer_callback(...) - с всплывающим текстом или alert. Ранний этап
+    для них не отвечает сразу, а ждет хендлер не дольше ACK_DEFER_DEADLINE.
+    Вызывается при импорте модуля с хендлерами.
+    """
+    compiled = re.compile(pattern)
+    if all(existing.pattern != compiled.pattern for existing in _deferred_answer_patterns):
+        _deferred_answer_patterns.append(compiled)
+        logger.debug(f"CallbackAck: Registered deferred answer pattern '{pattern}'.")
+
+
+def _is_deferred(callback_data: Optional[str]) -> bool:
+    return bool(callback_data) and any(p.match(callback_data) for p in _deferred_answer_patterns)
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Per-Callback Acknowledgement ===
+class _CallbackAck:
+    """Ответ на один callback_query: отвечается ровно один раз (ранним этапом или хендлером)."""
+
+    __slots__ = ("query", "received_at", "answered", "answered_at", "deadline_task")
+
+    def __init__(self, query: CallbackQuery) -> None:
+        self.query = query
+        self.received_at = time.monotonic()
+        self.answered = False
+        self.answered_at: Optional[float] = None
+        self.deadline_task: Optional[asyncio.Task] = None
+
+    def claim(self) -> bool:
+        """Забирает право ответить (синхронно: второй вызов получит False)."""
+        if self.answered:
+            return False
+        self.answered = True
+        if self.deadline_task and not self.deadline_task.done():
+            self.deadline_task.cancel()
+        return True
+
+    async def send(self, text: Optional[str] = None, show_alert: bool = False) -> bool:
+        try:
+            await self.query.answer(text=text, show_alert=show_alert)
+            return True
+        except Exception as e:
+            # Истекший query (>15с) или сетевой сбой - обработку апдейта это не останавливает
+            logger.warning(f"CallbackAck: Could not answer callback query {self.query.id}: {e}")
+            return False
+        finally:
+            self.answered_at = time.monotonic()
+
+    async def answer_after_deadline(self) -> None:
+        await asyncio.sleep(ACK_DEFER_DEADLINE)
+        if self.claim():
+            logger.debug(f"CallbackAck: Handler did not answer {self.query.id} within {ACK_DEFER_DEADLINE}s, answering empty.")
+            await self.send()
+
+
+_pending_acks: Dict[str, _CallbackAck] = {}
+_background_tasks: Set[asyncio.Task] = set()
+_ack_stats: Dict[str, float] = {
+    "callbacks": 0, "deferred": 0, "late_toasts": 0,
+    "total_perceived": 0.0, "max_perceived": 0.0,
+    "total_processing": 0.0, "max_processing": 0.0,
+}
+
+
+def _spawn(coro: Any, name: str) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+# === END BLOCK 4 ===
+
+
+# === BLOCK 5: Engine Stage and Handler API ===
+def acknowledge_callback_early(update: Update) -> None:
+    """
+    Этап перед очередью пользователя: отвечает на callback_query сразу
+    (в фоне, приоритет CALLBACK_ANSWER в outbound_scheduler). Для callback_data
+    из register_deferred_answer ответ ждет хендлер до ACK_DEFER_DEADLINE.
+    """
+    query = update.callback_query
+    if not query or query.id in _pending_acks:
+        return
+    ack = _CallbackAck(query)
+    _pending_acks[query.id] = ack
+    _ack_stats["callbacks"] += 1
+    if _is_deferred(query.data):
+        _ack_stats["deferred"] += 1
+        ack.deadline_task = _spawn(ack.answer_after_deadline(), name=f"callback-ack-deadline-{query.id}")
+        return
+    ack.claim()
+    _spawn(ack.send(), name=f"callback-ack-{query.id}")
+
+
+async def answer_callback(query: CallbackQuery, text: Optional[str] = None, show_alert: bool = False) -> bool:
+    """
+    Отложенный ответ хендлера (вместо query.answer). Если ранний этап еще не
+    ответил - отвечает с text/show_alert. Если уже ответил: alert уходит
+    обычным сообщением в чат, всплывающий текст пропускается.
+    Возвращает True, если text показан пользователю (или text не задан).
+    """
+    ack = _pending_acks.get(query.id)
+    if ack is None:
+        # Вне движка (или повторный вызов после завершения апдейта) - как раньше
+        ack = _CallbackAck(query)
+    if ack.claim():
+        return await ack.send(text=text, show_alert=show_alert)
+    if not text:
+        return True
+    _ack_stats["late_toasts"] += 1
+    if show_alert and query.message:
+        try:
+            await query.get_bot().send_message(chat_id=query.message.chat_id, text=text)
+            return True
+        except Exception as e:
+            logger.warning(f"CallbackAck: Could not deliver late alert for {query.id} as a message: {e}")
+            return False
+    logger.debug(
+        f"CallbackAck: Callback {query.id} already answered, toast '{text}' dropped. "
+        "Register its callback_data with register_deferred_answer to show it."
+    )
+    return False
+
+
+def finish_callback_ack(update: Update) -> None:
+    """Конец обработки апдейта: учет воспринимаемой задержки (до ответа) отдельно от полной."""
+    query = update.callback_query
+    if not query:
+        return
+    ack = _pending_acks.pop(query.id, None)
+    if ack is None:
+        return
+    processing_time = time.monotonic() - ack.received_at
+    if ack.claim():
+        # Отложенный, но хендлер так и не ответил (например, transition без хендлера)
+        _spawn(ack.send(), name=f"callback-ack-final-{query.id}")
+        perceived = processing_time
+    elif ack.answered_at is not None:
+        perceived = ack.answered_at - ack.received_at
+    else:
+        # Ответ еще в пути - считаем по времени обработки
+        perceived = processing_time
+    _ack_stats["total_perceived"] += perceived
+    _ack_stats["max_perceived"] = max(_ack_stats["max_perceived"], perceived)
+    _ack_stats["total_processing"] += processing_time
+    _ack_stats["max_processing"] = max(_ack_stats["max_processing"], processing_time)
+    logger.debug(
+        f"CallbackAck: Callback {query.id} ('{query.data}'): perceived latency {perceived:.4f}s, "
+        f"total processing {processing_time:.4f}s."
+    )
+
+
+def get_callback_ack_stats() -> Dict[str, Any]:
+    """Средняя/максимальная воспринимаемая задержка и полное время обработки callback."""
+    finished = _ack_stats["callbacks"] - len(_pending_acks)
+    return {
+        "callbacks": int(_ack_stats["callbacks"]),
+        "deferred": int(_ack_stats["deferred"]),
+        "late_toasts": int(_ack_stats["late_toasts"]),
+        "in_flight": len(_pending_acks),
+        "avg_perceived": _ack_stats["total_perceived"] / finished if finished else 0.0,
+        "max_perceived": _ack_stats["max_perceived"],
+        "avg_processing": _ack_stats["total_processing"] / finished if finished else 0.0,
+        "max_processing": _ack_stats["max_processing"],
+    }
+# === END BLOCK 5 ===
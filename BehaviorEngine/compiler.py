@@ -0,0 +1,724 @@
+# BehaviorEngine/compiler.py
+# Компиляция YAML-сценария в неизменяемый граф объектов для executor
+
+# === BLOCK 1: Imports ===
+import heapq
+import logging
+import re
+import string
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+)
+
+from telegram import Update
+
+from .handler_registry import HandlerResolutionError, resolve_handler
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Param Templates ===
+_FIELD_ROOT_SPLIT_RE = re.compile(r"[.\[]")
+_FORMATTER = string.Formatter()
+
+
+class ParamTemplate:
+    """
+    Строковый параметр действия с подстановками {key}, разобранный один раз.
+    Поведение совпадает с прежним str.format: при отсутствии ключа или ошибке
+    форматирования возвращается исходная строка.
+    """
+
+    __slots__ = ("param_key", "source", "field_roots")
+
+    def __init__(self, param_key: str, source: str, field_roots: Tuple[str, ...]) -> None:
+        self.param_key = param_key
+        self.source = source
+        self.field_roots = field_roots
+
+    def render(self, format_data: Mapping[str, Any]) -> str:
+        for field_root in self.field_roots:
+            if field_root not in format_data:
+                logger.warning(
+                    f"KeyError formatting param '{self.param_key}' for value '{self.source}': Missing key '{field_root}' in available_format_data. Using original value."
+                )
+                return self.source
+        try:
+            formatted_value = self.source.format_map(format_data)
+        except Exception as e:
+            logger.error(
+                f"Error formatting param '{self.param_key}' for value '{self.source}': {e}. Using original value."
+            )
+            return self.source
+        if formatted_value != self.source:
+            logger.debug(
+                f"Formatted param '{self.param_key}': from '{self.source}' to '{formatted_value}'"
+            )
+        return formatted_value
+
+
+def _compile_param_value(param_key: str, value: Any) -> Any:
+    """Возвращает ParamTemplate для строк с подстановками, иначе само значение."""
+    if not (isinstance(value, str) and "{" in value and "}" in value):
+        return value
+    try:
+        field_names = [
+            field_name
+            for _, field_name, _, _ in _FORMATTER.parse(value)
+            if field_name is not None
+        ]
+    except ValueError as e:
+        logger.warning(
+            f"Compiler: Param '{param_key}' has invalid format string '{value}': {e}. It will be used as is."
+        )
+        return value
+    if not field_names:
+        # Только экранированные скобки ({{ }}) - результат известен заранее
+        return value.format_map({})
+    field_roots = tuple(
+        dict.fromkeys(_FIELD_ROOT_SPLIT_RE.split(name, 1)[0] for name in field_names)
+    )
+    if any(not root or root.isdigit() for root in field_roots):
+        logger.warning(
+            f"Compiler: Param '{param_key}' uses positional fields in '{value}'. It will be used as is."
+        )
+        return value
+    return ParamTemplate(param_key, value, field_roots)
+
+
+class CompiledParams:
+    """Параметры действия: константы и заранее разобранные шаблоны (порядок ключей сохраняется)."""
+
+    __slots__ = ("items", "has_templates")
+
+    def __init__(self, raw_params: Mapping[str, Any]) -> None:
+        self.items: Tuple[Tuple[str, Any], ...] = tuple(
+            (key, _compile_param_value(key, value)) for key, value in raw_params.items()
+        )
+        self.has_templates = any(isinstance(value, ParamTemplate) for _, value in self.items)
+
+    def render(self, format_data: Mapping[str, Any]) -> Dict[str, Any]:
+        if not self.has_templates:
+            return dict(self.items)
+        return {
+            key: value.render(format_data) if isinstance(value, ParamTemplate) else value
+            for key, value in self.items
+        }
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Filters ===
+_MESSAGE_CONTENT_ATTRS = {"text": "text", "photo": "photo", "document": "document"}
+
+
+def _compile_regex(pattern: Any, where: str) -> Tuple[Optional[Pattern], bool]:
+    """(скомпилированный regex или None, valid). Невалидный regex никогда не совпадает."""
+    if pattern is None:
+        return None, True
+    try:
+        return re.compile(str(pattern)), True
+    except re.error as re_err:
+        logger.error(f"Compiler: Invalid regex pattern '{pattern}' in {where}: {re_err}")
+        return None, False
+
+
+class CompiledFilter:
+    """Один фильтр input_handler с заранее скомпилированными regex."""
+
+    __slots__ = (
+        "filter_type",
+        "content_type",
+        "text",
+        "regex",
+        "data",
+        "pattern",
+        "command",
+        "valid",
+    )
+
+    def __init__(self, filter_item: Any, where: str) -> None:
+        self.filter_type: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.text: Optional[str] = None
+        self.regex: Optional[Pattern] = None
+        self.data: Optional[str] = None
+        self.pattern: Optional[Pattern] = None
+        self.command: Optional[str] = None
+        self.valid = True
+
+        if not isinstance(filter_item, dict):
+            logger.warning(
+                f"Compiler: Invalid filter item format in {where} (expected dict): {filter_item}"
+            )
+            self.valid = False
+            return
+
+        self.filter_type = filter_item.get("type")
+        if self.filter_type == "message":
+            self.content_type = filter_item.get("content_type")
+            self.text = filter_item.get("text")
+            self.regex, self.valid = _compile_regex(filter_item.get("regex"), where)
+            if self.content_type and self.content_type not in _MESSAGE_CONTENT_ATTRS:
+                logger.warning(
+                    f"Compiler: Unsupported content_type '{self.content_type}' in {where}. Filter will never match."
+                )
+                self.valid = False
+        elif self.filter_type == "callback_query":
+            self.data = filter_item.get("data")
+            self.pattern, self.valid = _compile_regex(filter_item.get("pattern"), where)
+        elif self.filter_type == "command":
+            command_expected = filter_item.get("command")
+            if command_expected:
+                self.command = str(command_expected).lstrip("/")
+            else:
+                logger.warning(
+                    f"Compiler: Filter type 'command' but 'command' parameter missing in {where}."
+                )
+                self.valid = False
+        else:
+            logger.warning(f"Compiler: Unknown filter type '{self.filter_type}' in {where}.")
+            self.valid = False
+
+    def matches(self, update: Update) -> bool:
+        if not self.valid:
+            return False
+
+        if self.filter_type == "message":
+            message = update.message
+            if not message:
+                return False
+            if self.content_type == "text":
+                if message.text is None:
+                    return False
+            elif self.content_type and not getattr(
+                message, _MESSAGE_CONTENT_ATTRS[self.content_type], None
+            ):
+                return False
+            if self.content_type in (None, "text"):
+                # Текстовые условия проверяются только для текста (или без content_type)
+                message_text = message.text
+                if message_text is None:
+                    return self.text is None and self.regex is None
+                if self.text is not None and message_text != self.text:
+                    return False
+                if self.regex is not None and not self.regex.fullmatch(message_text):
+                    return False
+            return True
+
+        if self.filter_type == "callback_query":
+            callback_data_val = getattr(update.callback_query, "data", None)
+            if callback_data_val is None:
+                return False
+            if self.data is not None and callback_data_val != self.data:
+                return False
+            return self.pattern is None or self.pattern.fullmatch(callback_data_val) is not None
+
+        # filter_type == "command"
+        message_text = getattr(update.message, "text", None)
+        if not message_text or not message_text.startswith("/"):
+            return False
+        return message_text.split(maxsplit=1)[0][1:] == self.command
+# === END BLOCK 4 ===
+
+
+# === BLOCK 4.5: call_ai Pre-Classifier ===
+_PRE_CLASSIFY_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _normalize_for_rules(text: str) -> str:
+    """Регистр, пробелы и ё/е не важны для ключевых слов: ' Я  МАСТЁР ' == 'я мастер'."""
+    return _PRE_CLASSIFY_WHITESPACE_RE.sub(" ", text).strip().casefold().replace("ё", "е")
+
+
+def _as_str_tuple(value: Any) -> Tuple[str, ...]:
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(str(item) for item in value)
+    return (str(value),)
+
+
+def _compile_rule_pattern(
+    keywords: Sequence[str], regexes: Sequence[str], where: str, errors: List[str]
+) -> Optional[Pattern]:
+    """Ключевые слова (целыми словами) и regex одного правила - в один regex для search()."""
+    alternatives = [
+        rf"(?<!\w){re.escape(_normalize_for_rules(keyword))}(?!\w)"
+        for keyword in keywords
+        if keyword.strip()
+    ]
+    for regex_source in regexes:
+        regex, valid = _compile_regex(regex_source, where)
+        if not valid:
+            errors.append(f"{where}: invalid regex '{regex_source}'")
+        elif regex is not None:
+            alternatives.append(f"(?:{regex.pattern})")
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+
+class PreClassifyRule:
+    """Правило pre_classify: результат, языки (пусто - любой) и regex из keywords/regex."""
+
+    __slots__ = ("result", "langs", "pattern")
+
+    def __init__(self, result: str, langs: Tuple[str, ...], pattern: Pattern) -> None:
+        self.result = result
+        self.langs = langs
+        self.pattern = pattern
+
+    def applies_to(self, lang_code: Optional[str]) -> bool:
+        # Язык неизвестен - проверяем все правила
+        return not self.langs or not lang_code or lang_code.lower().startswith(self.langs)
+
+    def matches(self, normalized_text: str, lang_code: Optional[str]) -> bool:
+        return self.applies_to(lang_code) and self.pattern.search(normalized_text) is not None
+
+
+class CompiledPreClassifier:
+    """
+    Локальная классификация перед call_ai (params.pre_classify). Если ответ
+    однозначен, он сохраняется в save_to без запроса к AI; иначе - обычный call_ai.
+
+        pre_classify:
+          callback_data:              # точный callback_data -> результат
+            "role_choice:master": MASTER
+            "role_choice:client": CLIENT
+          rules:                      # по порядку, keywords - целыми словами
+            - result: MASTER
+              lang: [ru, uk]          # префиксы language_code; без lang - для всех
+              keywords: ["я мастер", "я майстер"]
+              regex: ["^мастер\\b"]
+            - result: CLIENT
+              keywords: ["я клиент", "я клієнт", "ищу мастера"]
+          defer_keywords: ["не", "ні", "или", "чи"]  # при совпадении - решает AI
+          max_words: 6                # длинный текст - решает AI
+
+    Уверенным считается только случай, когда все совпавшие правила дают один
+    и тот же результат.
+    """
+
+    __slots__ = ("callback_results", "rules", "defer_pattern", "max_words")
+
+    def __init__(
+        self,
+        callback_results: Mapping[str, str],
+        rules: Tuple[PreClassifyRule, ...],
+        defer_pattern: Optional[Pattern],
+        max_words: Optional[int],
+    ) -> None:
+        self.callback_results = callback_results
+        self.rules = rules
+        self.defer_pattern = defer_pattern
+        self.max_words = max_words
+
+    def classify(
+        self,
+        text: Optional[str],
+        callback_data: Optional[str],
+        lang_code: Optional[str],
+    ) -> Optional[str]:
+        """Результат при высокой уверенности, иначе None (нужен AI)."""
+        if callback_data is not None:
+            result = self.callback_results.get(callback_data)
+            if result is not None:
+                return result
+        if not text:
+            return None
+        normalized_text = _normalize_for_rules(str(text))
+        if self.max_words and len(normalized_text.split()) > self.max_words:
+            return None
+        if self.defer_pattern is not None and self.defer_pattern.search(normalized_text):
+            return None
+        results = {rule.result for rule in self.rules if rule.matches(normalized_text, lang_code)}
+        return results.pop() if len(results) == 1 else None
+
+    def __repr__(self) -> str:
+        return (
+            f"<CompiledPreClassifier callbacks={len(self.callback_results)} "
+            f"rules={len(self.rules)} max_words={self.max_words}>"
+        )
+
+
+def _compile_pre_classifier(
+    raw: Any, where: str, errors: List[str]
+) -> Optional[CompiledPreClassifier]:
+    if not isinstance(raw, dict):
+        errors.append(f"{where}: pre_classify must be a mapping")
+        return None
+
+    raw_callbacks = raw.get("callback_data") or {}
+    if not isinstance(raw_callbacks, dict):
+        errors.append(f"{where}: pre_classify.callback_data must be a mapping")
+        raw_callbacks = {}
+    callback_results = {str(data): str(result) for data, result in raw_callbacks.items()}
+
+    rules: List[PreClassifyRule] = []
+    raw_rules = raw.get("rules") or []
+    if not isinstance(raw_rules, list):
+        errors.append(f"{where}: pre_classify.rules must be a list")
+        raw_rules = []
+    for rule_index, raw_rule in enumerate(raw_rules):
+        rule_where = f"{where} pre_classify rule #{rule_index}"
+        if not isinstance(raw_rule, dict) or raw_rule.get("result") is None:
+            errors.append(f"{rule_where}: rule must be a mapping with 'result'")
+            continue
+        errors_before = len(errors)
+        pattern = _compile_rule_pattern(
+            _as_str_tuple(raw_rule.get("keywords")), _as_str_tuple(raw_rule.get("regex")),
+            rule_where, errors,
+        )
+        if pattern is None:
+            if len(errors) == errors_before:
+                errors.append(f"{rule_where}: rule has no keywords or regex")
+            continue
+        langs = tuple(lang.lower() for lang in _as_str_tuple(raw_rule.get("lang")))
+        rules.append(PreClassifyRule(str(raw_rule["result"]), langs, pattern))
+
+    defer_pattern = _compile_rule_pattern(
+        _as_str_tuple(raw.get("defer_keywords")), _as_str_tuple(raw.get("defer_regex")),
+        f"{where} pre_classify defer", errors,
+    )
+
+    max_words = raw.get("max_words")
+    if max_words is not None and (not isinstance(max_words, int) or max_words <= 0):
+        errors.append(f"{where}: pre_classify.max_words must be a positive integer")
+        max_words = None
+
+    if not callback_results and not rules:
+        errors.append(f"{where}: pre_classify has neither callback_data nor rules")
+        return None
+    return CompiledPreClassifier(
+        MappingProxyType(callback_results), tuple(rules), defer_pattern, max_words
+    )
+# === END BLOCK 4.5 ===
+
+
+# === BLOCK 5: Compiled Graph ===
+class CompiledAction:
+    """Действие с уже найденным обработчиком и разобранными параметрами."""
+
+    __slots__ = ("index", "action_type", "handler", "params")
+
+    def __init__(
+        self, index: int, action_type: str, handler: Callable, params: CompiledParams
+    ) -> None:
+        self.index = index
+        self.action_type = action_type
+        self.handler = handler
+        self.params = params
+
+
+class CompiledInputHandler:
+    """input_handler: фильтры (все должны совпасть) и действия."""
+
+    __slots__ = ("index", "filters", "actions", "valid")
+
+    def __init__(
+        self,
+        index: int,
+        filters: Tuple[CompiledFilter, ...],
+        actions: Tuple[CompiledAction, ...],
+        valid: bool = True,
+    ) -> None:
+        self.index = index
+        self.filters = filters
+        self.actions = actions
+        self.valid = valid
+
+    def matches(self, update: Update) -> bool:
+        if not self.valid:
+            return False
+        # Пустой список фильтров совпадает с любым вводом
+        return all(compiled_filter.matches(update) for compiled_filter in self.filters)
+
+
+class InputHandlerIndex:
+    """
+    Индекс input_handlers состояния. Каждый обработчик лежит в одной корзине по
+    самому избирательному фильтру - условию, без которого он совпасть не может:
+    точный callback_data, команда, точный текст, content_type и т.д.
+    candidates() возвращает только обработчики из подходящих корзин в порядке
+    объявления; executor проверяет их полными фильтрами, первый совпавший выигрывает.
+    """
+
+    __slots__ = (
+        "callback_data",
+        "callback_any",
+        "commands",
+        "message_text",
+        "content_types",
+        "message_any",
+        "generic",
+    )
+
+    def __init__(self, input_handlers: Sequence[CompiledInputHandler]) -> None:
+        callback_data: Dict[str, List[CompiledInputHandler]] = {}
+        commands: Dict[str, List[CompiledInputHandler]] = {}
+        message_text: Dict[str, List[CompiledInputHandler]] = {}
+        content_types: Dict[str, List[CompiledInputHandler]] = {}
+        callback_any: List[CompiledInputHandler] = []
+        message_any: List[CompiledInputHandler] = []
+        generic: List[CompiledInputHandler] = []
+
+        for input_handler in input_handlers:
+            if not input_handler.valid or not all(f.valid for f in input_handler.filters):
+                continue  # Никогда не совпадет - в индекс не попадает
+            filters = input_handler.filters
+            exact_callback = next((f for f in filters if f.filter_type == "callback_query" and f.data is not None), None)
+            command = next((f for f in filters if f.filter_type == "command"), None)
+            exact_text = next(
+                (f for f in filters if f.filter_type == "message" and f.text is not None and f.content_type in (None, "text")),
+                None,
+            )
+            typed_message = next((f for f in filters if f.filter_type == "message" and f.content_type), None)
+
+            if exact_callback:
+                callback_data.setdefault(exact_callback.data, []).append(input_handler)
+            elif command:
+                commands.setdefault(command.command, []).append(input_handler)
+            elif exact_text:
+                message_text.setdefault(exact_text.text, []).append(input_handler)
+            elif typed_message:
+                content_types.setdefault(typed_message.content_type, []).append(input_handler)
+            elif any(f.filter_type == "callback_query" for f in filters):
+                callback_any.append(input_handler)
+            elif any(f.filter_type == "message" for f in filters):
+                message_any.append(input_handler)
+            else:
+                generic.append(input_handler)  # Пустой список фильтров
+
+        self.callback_data = {key: tuple(value) for key, value in callback_data.items()}
+        self.commands = {key: tuple(value) for key, value in commands.items()}
+        self.message_text = {key: tuple(value) for key, value in message_text.items()}
+        self.content_types = {key: tuple(value) for key, value in content_types.items()}
+        self.callback_any = tuple(callback_any)
+        self.message_any = tuple(message_any)
+        self.generic = tuple(generic)
+
+    def candidates(self, update: Update) -> Sequence[CompiledInputHandler]:
+        buckets: List[Sequence[CompiledInputHandler]] = []
+        callback_query = update.callback_query
+        callback_data_val = getattr(callback_query, "data", None) if callback_query else None
+        if callback_data_val is not None:
+            buckets.append(self.callback_data.get(callback_data_val, ()))
+            buckets.append(self.callback_any)
+
+        message = update.message
+        if message:
+            message_text = message.text
+            if message_text is not None:
+                buckets.append(self.message_text.get(message_text, ()))
+                buckets.append(self.content_types.get("text", ()))
+                if message_text.startswith("/"):
+                    buckets.append(self.commands.get(message_text.split(maxsplit=1)[0][1:], ()))
+            if message.photo:
+                buckets.append(self.content_types.get("photo", ()))
+            if message.document:
+                buckets.append(self.content_types.get("document", ()))
+            buckets.append(self.message_any)
+
+        buckets.append(self.generic)
+        buckets = [bucket for bucket in buckets if bucket]
+        if not buckets:
+            return ()
+        if len(buckets) == 1:
+            return buckets[0]
+        # Сохраняем порядок объявления в YAML
+        return list(heapq.merge(*buckets, key=lambda input_handler: input_handler.index))
+
+
+class CompiledState:
+    __slots__ = ("state_key", "on_entry", "input_handlers", "input_index")
+
+    def __init__(
+        self,
+        state_key: str,
+        on_entry: Tuple[CompiledAction, ...],
+        input_handlers: Tuple[CompiledInputHandler, ...],
+    ) -> None:
+        self.state_key = state_key
+        self.on_entry = on_entry
+        self.input_handlers = input_handlers
+        self.input_index = InputHandlerIndex(input_handlers)
+
+
+class CompiledScenario:
+    """
+    Скомпилированный сценарий. definition - исходный YAML-словарь (только для чтения).
+    unresolved_handlers - функции call_handler, которые не удалось найти при компиляции.
+    """
+
+    __slots__ = ("scenario_key", "states", "definition", "unresolved_handlers")
+
+    def __init__(
+        self,
+        scenario_key: str,
+        states: Mapping[str, CompiledState],
+        definition: Mapping[str, Any],
+        unresolved_handlers: Tuple[str, ...] = (),
+    ) -> None:
+        self.scenario_key = scenario_key
+        self.states = states
+        self.definition = definition
+        self.unresolved_handlers = unresolved_handlers
+
+    def get_state(self, state_key: str) -> Optional[CompiledState]:
+        return self.states.get(state_key)
+# === END BLOCK 5 ===
+
+
+# === BLOCK 6: Compile Functions ===
+def _resolve_call_handler(
+    raw_params: Mapping[str, Any], where: str, errors: List[str], unresolved: List[str]
+) -> None:
+    """Заранее находит функцию call_handler (имя без подстановок), чтобы ошибка была видна при загрузке."""
+    function_name = raw_params.get("function_name")
+    if not function_name:
+        errors.append(f"{where}: call_handler requires 'function_name'")
+        return
+    if isinstance(function_name, str) and "{" in function_name:
+        return  # Имя вычисляется во время выполнения
+    try:
+        resolve_handler(function_name)
+    except (HandlerResolutionError, TypeError) as e:
+        errors.append(f"{where}: {e}")
+        unresolved.append(str(function_name))
+
+
+def _compile_actions(
+    raw_actions: Any,
+    action_handlers: Mapping[str, Callable],
+    where: str,
+    errors: List[str],
+    unresolved: List[str],
+) -> Tuple[CompiledAction, ...]:
+    if raw_actions is None:
+        return ()
+    if not isinstance(raw_actions, list):
+        errors.append(f"{where}: actions must be a list")
+        return ()
+
+    compiled_actions: List[CompiledAction] = []
+    for action_index, action_data in enumerate(raw_actions):
+        if not isinstance(action_data, dict) or not action_data.get("action"):
+            continue
+        action_type = action_data["action"]
+        handler = action_handlers.get(action_type)
+        if handler is None:
+            errors.append(f"{where} action #{action_index}: unknown action '{action_type}'")
+            continue
+        raw_params = action_data.get("params", {})
+        if not isinstance(raw_params, dict):
+            errors.append(f"{where} action #{action_index}: params must be a dict")
+            raw_params = {}
+        if action_type == "call_handler":
+            _resolve_call_handler(
+                raw_params, f"{where} action #{action_index}", errors, unresolved
+            )
+        elif action_type == "call_ai" and "pre_classify" in raw_params:
+            # В params остается уже скомпилированный CompiledPreClassifier (константа)
+            raw_params = dict(raw_params)
+            pre_classifier = _compile_pre_classifier(
+                raw_params.pop("pre_classify"), f"{where} action #{action_index}", errors
+            )
+            if pre_classifier is not None:
+                raw_params["pre_classify"] = pre_classifier
+        compiled_actions.append(
+            CompiledAction(action_index, action_type, handler, CompiledParams(raw_params))
+        )
+    return tuple(compiled_actions)
+
+
+def compile_scenario(
+    scenario_key: str,
+    definition: Dict[str, Any],
+    action_handlers: Mapping[str, Callable],
+    errors: Optional[List[str]] = None,
+) -> CompiledScenario:
+    """
+    Компилирует распарсенный YAML сценария. Некорректные элементы пропускаются
+    (как и раньше при исполнении), а описания проблем добавляются в errors.
+    """
+    if errors is None:
+        errors = []
+    unresolved_handlers: List[str] = []
+
+    compiled_states: Dict[str, CompiledState] = {}
+    raw_states = definition.get("states", {})
+    if not isinstance(raw_states, dict):
+        errors.append("'states' must be a mapping")
+        raw_states = {}
+
+    for state_key, state_config in raw_states.items():
+        if not isinstance(state_config, dict):
+            errors.append(f"state '{state_key}': definition must be a mapping")
+            continue
+
+        on_entry = _compile_actions(
+            state_config.get("on_entry"), action_handlers, f"state '{state_key}' on_entry",
+            errors, unresolved_handlers,
+        )
+
+        input_handlers: List[CompiledInputHandler] = []
+        raw_input_handlers = state_config.get("input_handlers")
+        if isinstance(raw_input_handlers, list):
+            for handler_index, handler_definition in enumerate(raw_input_handlers):
+                if not isinstance(handler_definition, dict):
+                    continue
+                where = f"state '{state_key}' input_handler #{handler_index}"
+                raw_filters = handler_definition.get("filters", [])
+                filters_valid = isinstance(raw_filters, list)
+                if not filters_valid:
+                    errors.append(f"{where}: filters must be a list")
+                    raw_filters = []
+                compiled_filters = tuple(
+                    CompiledFilter(filter_item, where) for filter_item in raw_filters
+                )
+                input_handlers.append(
+                    CompiledInputHandler(
+                        index=handler_index,
+                        filters=compiled_filters,
+                        actions=_compile_actions(
+                            handler_definition.get("actions", []), action_handlers, where,
+                            errors, unresolved_handlers,
+                        ),
+                        valid=filters_valid,
+                    )
+                )
+        elif raw_input_handlers is not None:
+            errors.append(f"state '{state_key}': input_handlers must be a list")
+
+        compiled_states[state_key] = CompiledState(
+            state_key=state_key, on_entry=on_entry, input_handlers=tuple(input_handlers)
+        )
+
+    if errors:
+        logger.warning(
+            f"Compiler: Scenario '{scenario_key}' compiled with {len(errors)} problem(s): {errors}"
+        )
+    logger.info(
+        f"Compiler: Scenario '{scenario_key}' compiled: {len(compiled_states)} state(s)."
+    )
+    return CompiledScenario(
+        scenario_key=scenario_key,
+        states=MappingProxyType(compiled_states),
+        definition=MappingProxyType(definition),
+        unresolved_handlers=tuple(dict.fromkeys(unresolved_handlers)),
+    )
+# === END BLOCK 6 ===
@@ -0,0 +1,109 @@
+# BehaviorEngine/context.py
+# Контекст состояния с учетом изменений верхнего уровня (для дельта-записи state_context)
+
+# === BLOCK 1: Imports ===
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: StateContext ===
+_MISSING = object()
+
+
+class StateContext(dict):
+    """
+    dict, который помнит, какие ключи верхнего уровня были установлены или удалены
+    относительно контекста, загруженного из БД (base).
+
+    По этой записи state_manager пишет в JSONB только патч
+    (state_context || {измененные ключи} - {удаленные ключи}), а не весь документ.
+
+    Отслеживаются только ключи верхнего уровня: вложенные списки/словари нужно
+    заменять целиком (как и делают хендлеры - через .copy()), а не менять на месте.
+    """
+
+    __slots__ = ("_base", "_set_keys", "_deleted_keys")
+
+    def __init__(self, base: Optional[Mapping[str, Any]] = None) -> None:
+        base = base if base is not None else {}
+        super().__init__(base)
+        self._base: Mapping[str, Any] = base
+        self._set_keys: Set[str] = set()
+        self._deleted_keys: Set[str] = set()
+
+    @classmethod
+    def from_persisted(cls, context_data: Optional[Mapping[str, Any]]) -> "StateContext":
+        """Контекст для работы с состоянием. Сохраняет базу, если контекст уже StateContext."""
+        if isinstance(context_data, StateContext):
+            return context_data.copy()
+        return cls(context_data)
+
+    # --- Учет изменений ---
+    def _mark_set(self, key: str) -> None:
+        self._set_keys.add(key)
+        self._deleted_keys.discard(key)
+
+    def _mark_deleted(self, key: str) -> None:
+        self._set_keys.discard(key)
+        if key in self._base:
+            self._deleted_keys.add(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        super().__setitem__(key, value)
+        self._mark_set(key)
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._mark_deleted(key)
+
+    def pop(self, key: str, default: Any = _MISSING) -> Any:
+        if key in self:
+            value = super().pop(key)
+            self._mark_deleted(key)
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def popitem(self) -> Tuple[str, Any]:
+        key, value = super().popitem()
+        self._mark_deleted(key)
+        return key, value
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        for key in list(self.keys()):
+            self._mark_deleted(key)
+        super().clear()
+
+    def copy(self) -> "StateContext":
+        clone = StateContext.__new__(StateContext)
+        dict.__init__(clone, self)
+        clone._base = self._base
+        clone._set_keys = set(self._set_keys)
+        clone._deleted_keys = set(self._deleted_keys)
+        return clone
+
+    def __reduce__(self):
+        # Для pickle/deepcopy ведем себя как обычный dict
+        return (dict, (dict(self),))
+
+    # --- Дельта для записи ---
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._set_keys or self._deleted_keys)
+
+    def get_delta(self) -> Tuple[Dict[str, Any], List[str]]:
+        """(ключи для установки со значениями, ключи для удаления) относительно base."""
+        set_patch = {key: super(StateContext, self).__getitem__(key) for key in self._set_keys if key in self}
+        return set_patch, sorted(self._deleted_keys)
+# === END BLOCK 2 ===
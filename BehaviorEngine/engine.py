@@ -1,5 +1,6 @@
 # BehaviorEngine/engine.py
 # Версия с флагом process_only_on_entry для execute_state
+# и одним чтением UserStates на апдейт (цикл идет по ExecutionOutcome)
 
 # === BLOCK 1: Imports ===
 import asyncio
@@ -13,9 +14,17 @@ from telegram.ext import ContextTypes
 
 # Импорты компонентов движка
 try:
-    from .executor import execute_state
-    from .parser import load_and_parse_scenario
-    from .state_manager import UserStates, get_user_state, reset_user_state
+    from database.models import get_pool_status
+
+    from .executor import ACTION_HANDLERS, execute_state
+    from .parser import load_compiled_scenario
+    from .state_manager import (
+        UserStates,
+        begin_deferred_state_writes,
+        flush_deferred_state_writes,
+        get_user_state,
+        reset_user_state,
+    )
 except ImportError as e:
     logging.critical(
         f"CRITICAL: Failed to import engine components: {e}", exc_info=True
@@ -57,12 +66,19 @@ async def handle_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
         return False
 
     processed_by_engine_flag = False
-    # Константа для доступа к флагу из executor.py
-    # Определена в executor.py, здесь используется для логики engine
-    _ON_ENTRY_DONE_FLAG = "_internal_on_entry_actions_done" 
 
     try:
         async with session_maker() as session:
+            # Промежуточные состояния цепочки переходов держим в памяти,
+            # в БД пишется только итоговое (см. state_manager, BLOCK 2.5)
+            begin_deferred_state_writes(session)
+
+            # Состояние читается из БД один раз за апдейт; дальше цикл идет
+            # по ExecutionOutcome, который возвращает execute_state.
+            get_state_start_time = time.monotonic()
+            current_user_db_state = await get_user_state(user_id, session)
+            logger.debug(f"Engine: get_user_state (once per update) took {time.monotonic() - get_state_start_time:.4f}s")
+
             MAX_INTERNAL_TRANSITIONS = 10
             for transition_attempt in range(MAX_INTERNAL_TRANSITIONS):
                 iter_start_time = time.monotonic()
@@ -70,35 +86,33 @@ async def handle_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
                     f"Engine: Iteration {transition_attempt + 1}/{MAX_INTERNAL_TRANSITIONS} for user {user_id}, original_update_id: {original_update_id}"
                 )
 
-                get_state_start_time = time.monotonic()
-                current_user_db_state = await get_user_state(user_id, session)
-                logger.debug(f"Engine: get_user_state (initial in iter) took {time.monotonic() - get_state_start_time:.4f}s")
-
                 if not current_user_db_state:
                     logger.debug(
                         f"Engine: No active state for user {user_id}. Ending internal loop."
                     )
                     break
 
+                scenario_key_before_execute = current_user_db_state.scenario_key
                 current_state_key_before_execute = current_user_db_state.current_state_key
-                current_context_before_execute = (current_user_db_state.state_context or {}).copy() 
-                
+                current_context_before_execute = (current_user_db_state.state_context or {}).copy()
+
                 logger.debug(
-                    f"Engine: User {user_id} in state '{current_state_key_before_execute}' of scenario '{current_user_db_state.scenario_key}'. Context before exec: {current_context_before_execute}"
+                    f"Engine: User {user_id} in state '{current_state_key_before_execute}' of scenario '{scenario_key_before_execute}'. Context before exec: {current_context_before_execute}"
                 )
 
                 load_scenario_start_time = time.monotonic()
-                scenario_definition = await load_and_parse_scenario(
-                    current_user_db_state.scenario_key, session
+                scenario_definition = await load_compiled_scenario(
+                    scenario_key_before_execute, session, ACTION_HANDLERS
                 )
-                logger.debug(f"Engine: load_and_parse_scenario took {time.monotonic() - load_scenario_start_time:.4f}s")
+                logger.debug(f"Engine: load_compiled_scenario took {time.monotonic() - load_scenario_start_time:.4f}s")
 
                 if not scenario_definition:
                     logger.error(
-                        f"Engine: Failed to load scenario '{current_user_db_state.scenario_key}' for user {user_id}. Resetting state."
+                        f"Engine: Failed to load scenario '{scenario_key_before_execute}' for user {user_id}. Resetting state."
                     )
                     await reset_user_state(user_id, session)
                     commit_after_reset_start_time = time.monotonic()
+                    await flush_deferred_state_writes(session)
                     await session.commit()
                     logger.debug(f"Engine: session.commit (after reset) took {time.monotonic() - commit_after_reset_start_time:.4f}s")
                     logger.info(
@@ -113,58 +127,53 @@ async def handle_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
                     f"Engine: About to call execute_state for user {user_id} (process_only_on_entry={should_process_only_on_entry})."
                 )
                 execute_state_start_time = time.monotonic()
-                await execute_state(
+                outcome = await execute_state(
                     update=update,
                     context=context,
-                    current_state_from_db=current_user_db_state, 
+                    current_state_from_db=current_user_db_state,
                     scenario_definition=scenario_definition,
                     session=session,
                     process_only_on_entry=should_process_only_on_entry,
                 )
                 logger.debug(f"Engine: execute_state for user {user_id} took {time.monotonic() - execute_state_start_time:.4f}s")
                 processed_by_engine_flag = True
-                
-                # Повторно получаем состояние из БД ПОСЛЕ выполнения execute_state,
-                # чтобы увидеть актуальные изменения ключа состояния И КОНТЕКСТА.
-                get_state_post_exec_start_time = time.monotonic()
-                post_execute_user_db_state = await get_user_state(user_id, session)
-                logger.debug(f"Engine: get_user_state (post_execute in iter) took {time.monotonic() - get_state_post_exec_start_time:.4f}s")
-
-                if not post_execute_user_db_state:
+
+                current_user_db_state = outcome.user_state
+                if not current_user_db_state:
                     logger.debug(
                         f"Engine: No active state for user {user_id} after execute_state. Ending internal loop."
                     )
-                    break 
-                
-                on_entry_done_in_post_execute_context = (post_execute_user_db_state.state_context or {}).get(_ON_ENTRY_DONE_FLAG, False)
+                    break
 
-                if post_execute_user_db_state.current_state_key != current_state_key_before_execute:
+                if (outcome.scenario_key, outcome.state_key) != (scenario_key_before_execute, current_state_key_before_execute):
                     logger.info(
-                        f"Engine: State key changed for user {user_id} from '{current_state_key_before_execute}' to '{post_execute_user_db_state.current_state_key}'. Continuing internal loop."
+                        f"Engine: State changed for user {user_id} from '{scenario_key_before_execute}/{current_state_key_before_execute}' "
+                        f"to '{outcome.scenario_key}/{outcome.state_key}' (transition={outcome.transition_occurred}, scenario_switch={outcome.scenario_switched}). Continuing internal loop."
                     )
                     # Цикл продолжится
-                elif not on_entry_done_in_post_execute_context:
+                elif not outcome.on_entry_done:
                     # Ключ состояния тот же, но on_entry для нового/обновленного контекста еще не выполнен
                     logger.info(
-                        f"Engine: State key '{post_execute_user_db_state.current_state_key}' is the same, "
-                        f"but on_entry is not marked as done (flag is {on_entry_done_in_post_execute_context}). Continuing internal loop to process on_entry."
+                        f"Engine: State key '{outcome.state_key}' is the same, "
+                        f"but on_entry is not marked as done. Continuing internal loop to process on_entry."
                     )
                     # Цикл продолжится, should_process_only_on_entry будет True на след. итерации
                 else:
                     # Ключ состояния тот же, и on_entry для текущего контекста уже выполнен
                     logger.debug(
-                        f"Engine: State key '{post_execute_user_db_state.current_state_key}' is the same, "
+                        f"Engine: State key '{outcome.state_key}' is the same, "
                         f"and on_entry actions are marked as done. Ending internal loop."
                     )
-                    break 
+                    break
                 logger.debug(f"Engine: Iteration {transition_attempt + 1} for user {user_id} took {time.monotonic() - iter_start_time:.4f}s")
 
             if transition_attempt == MAX_INTERNAL_TRANSITIONS - 1 and MAX_INTERNAL_TRANSITIONS > 0 :
                 logger.warning(
                     f"Engine: Max internal transitions ({MAX_INTERNAL_TRANSITIONS}) reached for user {user_id}. Breaking loop to prevent infinite recursion."
                 )
-            
+
             final_commit_start_time = time.monotonic()
+            await flush_deferred_state_writes(session)
             await session.commit()
             logger.info(
                 f"Engine: Committed final state for user {user_id} after internal loop (if any), original_update_id: {original_update_id}. Commit took {time.monotonic() - final_commit_start_time:.4f}s"
@@ -176,14 +185,16 @@ async def handle_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
             f"Engine handle_update: asyncio.CancelledError for user {user_id}, original_update_id: {original_update_id}",
             exc_info=True,
         )
-        raise 
+        raise
     except Exception as e:
         logger.error(
             f"Engine handle_update: Unhandled exception for user {user_id}, original_update_id: {original_update_id}: {e}",
             exc_info=True,
         )
-        return False 
+        return False
     finally:
+        # Занятость пула: checkedout и время удержания соединений (см. database.models, BLOCK 16)
+        logger.debug(f"Engine: Pool status after update {original_update_id}: {get_pool_status()}")
         logger.info(
             f"Engine: handle_update FINISHING for user {user_id}, original_update_id: {original_update_id}. Total time: {time.monotonic() - total_handle_update_start_time:.4f}s. Returning: {processed_by_engine_flag}"
         )
@@ -208,17 +219,18 @@ async def trigger_on_entry_for_state(
         f"Engine: Triggering on_entry for user {user_id}, scenario '{scenario_key}', state '{state_key}'."
     )
 
-    scenario_definition = await load_and_parse_scenario(scenario_key, session)
+    scenario_definition = await load_compiled_scenario(
+        scenario_key, session, ACTION_HANDLERS
+    )
     if not scenario_definition:
         logger.error(
             f"Engine trigger_on_entry: Failed to load/parse scenario '{scenario_key}' for user {user_id}. Cannot execute on_entry."
         )
         return
 
-    states_definition = scenario_definition.get("states", {})
-    current_state_config = states_definition.get(state_key)
+    current_state_config = scenario_definition.get_state(state_key)
 
-    if not current_state_config or not isinstance(current_state_config, dict):
+    if current_state_config is None:
         logger.error(
             f"Engine trigger_on_entry: State '{state_key}' not found or invalid in scenario '{scenario_key}'. Resetting state."
         )
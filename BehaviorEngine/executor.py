@@ -4,17 +4,16 @@
 # новой обработкой _trigger_state_transition_to от call_handler и ЛОГИРОВАНИЕМ ВРЕМЕНИ
 
 # === BLOCK 1: Imports ===
-import importlib
-import inspect
 import logging
-import re
 import time # <--- ДОБАВЛЕН IMPORT TIME
+from collections import ChainMap
+from dataclasses import dataclass
+from types import MappingProxyType
 from typing import (
     Any,
     Callable,
     Coroutine,
     Dict,
-    List,
     Optional,
 )
 
@@ -24,13 +23,19 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 try:
-    from ai.interaction import _get_instruction_text, generate_text_response
-    from database.models import (
-        UserData,
-        UserStates,
-    )
-
+    from ai.gateway import AIError
+    from ai.interaction import _get_instruction_text, generate_ai_result
+    from ai.response_cache import resolve_cache_ttl
+    from database.models import UserStates
+    from database.user_profiles import get_user_profile
+
+    from .compiler import CompiledAction, CompiledPreClassifier, CompiledScenario
+    from .context import StateContext
+    from .handler_registry import HandlerResolutionError, resolve_handler
     from .state_manager import (
+        defers_state_writes,
+        get_known_user_state,
+        release_connection_for_io,
         reset_user_state,
         update_user_state,
     )
@@ -51,18 +56,59 @@ _TRIGGER_STATE_TRANSITION_KEY = "_trigger_state_transition_to"
 # === END BLOCK 2 ===
 
 
-# === BLOCK 2.5: Helper function for formatting action params ===
-def _format_action_params(
-    params: Dict[str, Any],
-    state_context: Dict[str, Any],
-    update: Update,
-    ptb_context: ContextTypes.DEFAULT_TYPE,
-) -> Dict[str, Any]:
-    if not isinstance(params, dict):
-        return params
+# === BLOCK 2.1: Execution Outcome ===
+@dataclass
+class ExecutionOutcome:
+    """
+    Результат execute_state: итоговое состояние пользователя после выполнения.
+    user_state=None означает, что состояние было сброшено.
+    Движок решает по нему, продолжать ли внутренний цикл, без повторного чтения UserStates.
+    """
+
+    user_state: Optional[UserStates]
+    transition_occurred: bool = False
+    scenario_switched: bool = False
+
+    @property
+    def scenario_key(self) -> Optional[str]:
+        return self.user_state.scenario_key if self.user_state else None
+
+    @property
+    def state_key(self) -> Optional[str]:
+        return self.user_state.current_state_key if self.user_state else None
+
+    @property
+    def state_context(self) -> Dict[str, Any]:
+        return (self.user_state.state_context or {}) if self.user_state else {}
 
-    available_format_data = {
-        **(state_context or {}),
+    @property
+    def on_entry_done(self) -> bool:
+        return bool(self.state_context.get(_ON_ENTRY_DONE_FLAG, False))
+
+
+def _build_execution_outcome(
+    user_id: int,
+    session: AsyncSession,
+    current_state_from_db: UserStates,
+    transition_occurred: bool,
+    scenario_switched: bool,
+) -> ExecutionOutcome:
+    # Итоговое состояние берем из того, что записали state_manager/хендлеры в этой сессии
+    known, user_state = get_known_user_state(user_id, session)
+    if not known:
+        user_state = current_state_from_db
+    return ExecutionOutcome(
+        user_state=user_state,
+        transition_occurred=transition_occurred,
+        scenario_switched=scenario_switched,
+    )
+# === END BLOCK 2.1 ===
+
+
+# === BLOCK 2.5: Helper functions for formatting action params ===
+def _get_update_format_data(update: Update) -> Dict[str, Any]:
+    """Данные апдейта для подстановки в параметры действий (собираются один раз на execute_state)."""
+    return {
         "message_text": getattr(getattr(update, "message", None), "text", None),
         "callback_data": getattr(getattr(update, "callback_query", None), "data", None),
         "user_id": getattr(getattr(update, "effective_user", None), "id", None),
@@ -72,29 +118,14 @@ def _format_action_params(
         "username": getattr(getattr(update, "effective_user", None), "username", None),
     }
 
-    formatted_params = {}
-    for key, value in params.items():
-        if isinstance(value, str) and "{" in value and "}" in value:
-            try:
-                formatted_value = value.format(**available_format_data)
-                formatted_params[key] = formatted_value
-                if value != formatted_value:
-                    logger.debug(
-                        f"Formatted param '{key}': from '{value}' to '{formatted_value}'"
-                    )
-            except KeyError as e:
-                logger.warning(
-                    f"KeyError formatting param '{key}' for value '{value}': Missing key {e} in available_format_data. Using original value."
-                )
-                formatted_params[key] = value
-            except Exception as e:
-                logger.error(
-                    f"Error formatting param '{key}' for value '{value}': {e}. Using original value."
-                )
-                formatted_params[key] = value
-        else:
-            formatted_params[key] = value
-    return formatted_params
+
+def _format_action_params(
+    action: CompiledAction,
+    state_context: Dict[str, Any],
+    update_format_data: Dict[str, Any],
+) -> Dict[str, Any]:
+    # Данные апдейта перекрывают ключи контекста (как и раньше); ChainMap - без копирования контекста
+    return action.params.render(ChainMap(update_format_data, state_context))
 # === END BLOCK 2.5 ===
 
 
@@ -103,22 +134,29 @@ async def execute_state(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     current_state_from_db: UserStates,
-    scenario_definition: Dict[str, Any],
+    scenario_definition: CompiledScenario,
     session: AsyncSession,
     process_only_on_entry: bool = False,
-) -> None:
+) -> ExecutionOutcome:
     func_total_start_time = time.monotonic()
     state_key = current_state_from_db.current_state_key
     user_id = current_state_from_db.user_id
     scenario_key = current_state_from_db.scenario_key
 
-    local_state_context = (current_state_from_db.state_context or {}).copy()
+    # StateContext запоминает измененные ключи - state_manager запишет только дельту
+    local_state_context = StateContext.from_persisted(current_state_from_db.state_context)
     handler_switched_scenario = local_state_context.pop(
         _HANDLER_INITIATED_SWITCH_FLAG, False
     )
 
     transition_occurred = False
 
+    def _outcome() -> ExecutionOutcome:
+        return _build_execution_outcome(
+            user_id, session, current_state_from_db, transition_occurred,
+            handler_switched_scenario or bool(local_state_context.get(_HANDLER_INITIATED_SWITCH_FLAG)),
+        )
+
     logger.info(
         f"Executor: Executing state '{state_key}' for scenario '{scenario_key}' for user {user_id} (process_only_on_entry={process_only_on_entry}, handler_switched_scenario_before_actions={handler_switched_scenario})"
     )
@@ -126,16 +164,17 @@ async def execute_state(
     #     f"Executor: Initial local_state_context for '{state_key}' (after popping flag): {local_state_context}"
     # )
 
-    states_definition = scenario_definition.get("states", {})
-    current_state_config = states_definition.get(state_key)
+    current_state_config = scenario_definition.get_state(state_key)
+    update_format_data = _get_update_format_data(update)
 
-    if not current_state_config or not isinstance(current_state_config, dict):
+    if current_state_config is None:
         logger.error(
-            f"Executor: State key '{state_key}' not found or invalid in scenario '{scenario_definition.get('scenario_key', 'UNKNOWN_SCENARIO')}'. Resetting state for user {user_id}."
+            f"Executor: State key '{state_key}' not found or invalid in scenario '{scenario_definition.scenario_key}'. Resetting state for user {user_id}."
         )
         await reset_user_state(user_id, session) # reset_user_state теперь тоже с логированием времени
         try:
             if update.effective_chat:
+                await release_connection_for_io(session)
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
                     text="Произошла ошибка сценария (состояние не найдено). Попробуйте /start.",
@@ -143,14 +182,14 @@ async def execute_state(
         except Exception as e_send:
             logger.error(f"Executor: Failed to send error message: {e_send}")
         logger.debug(f"Executor: execute_state (state not found path) took {time.monotonic() - func_total_start_time:.4f}s")
-        return
+        return _outcome()
 
     if handler_switched_scenario:
         logger.info(
             f"Executor: Skipping on_entry and input_handlers for YAML state '{state_key}' because handler initiated scenario switch earlier."
         )
         logger.debug(f"Executor: execute_state (handler_switched_scenario path) took {time.monotonic() - func_total_start_time:.4f}s")
-        return
+        return _outcome()
 
     on_entry_actions_done_in_context = local_state_context.get(
         _ON_ENTRY_DONE_FLAG, False
@@ -160,21 +199,16 @@ async def execute_state(
         logger.debug(
             f"Executor: Flag '{_ON_ENTRY_DONE_FLAG}' is False. Executing on_entry actions for '{state_key}'."
         )
-        on_entry_actions = current_state_config.get("on_entry")
-        if isinstance(on_entry_actions, list):
-            for action_index, action_data in enumerate(on_entry_actions):
-                if not isinstance(action_data, dict):
-                    continue
-                action_type = action_data.get("action")
-                raw_action_params = action_data.get("params", {})
+        on_entry_actions = current_state_config.on_entry
+        if on_entry_actions:
+            for compiled_action in on_entry_actions:
+                action_index = compiled_action.index
+                action_type = compiled_action.action_type
                 action_params = _format_action_params(
-                    raw_action_params, local_state_context, update, context
+                    compiled_action, local_state_context, update_format_data
                 )
 
-                if not action_type:
-                    continue
-
-                action_handler_func = ACTION_HANDLERS.get(action_type)
+                action_handler_func = compiled_action.handler
                 if action_handler_func:
                     action_specific_start_time = time.monotonic()
                     try:
@@ -245,10 +279,10 @@ async def execute_state(
                     f"Executor: Flag '{_ON_ENTRY_DONE_FLAG}' set True after on_entry for '{state_key}' (no transition occurred)."
                 )
             logger.debug(f"Executor: on_entry actions block for '{state_key}' took {time.monotonic() - on_entry_block_start_time:.4f}s")
-        else: # No on_entry_actions list
+        else: # No on_entry actions
             local_state_context[_ON_ENTRY_DONE_FLAG] = True
             logger.debug(
-                f"Executor: No on_entry list or not a list for '{state_key}'. Flag '{_ON_ENTRY_DONE_FLAG}' set True."
+                f"Executor: No on_entry actions for '{state_key}'. Flag '{_ON_ENTRY_DONE_FLAG}' set True."
             )
     else: # on_entry_actions_done_in_context was True
         logger.debug(
@@ -260,46 +294,38 @@ async def execute_state(
             f"Executor: Transition in on_entry for '{state_key}'. State execution for this YAML state ended."
         )
         logger.debug(f"Executor: execute_state (on_entry transition path) took {time.monotonic() - func_total_start_time:.4f}s")
-        return
+        return _outcome()
 
     if not process_only_on_entry:
         input_handlers_block_start_time = time.monotonic()
         logger.debug(
             f"Executor: process_only_on_entry is False for '{state_key}'. Proceeding to input_handlers."
         )
-        input_handlers_list = current_state_config.get("input_handlers")
-        if isinstance(input_handlers_list, list):
-            for handler_index, handler_definition in enumerate(input_handlers_list):
+        input_handlers_list = current_state_config.input_handlers
+        if input_handlers_list:
+            # Только обработчики из подходящих корзин индекса (см. compiler.InputHandlerIndex)
+            for compiled_input_handler in current_state_config.input_index.candidates(update):
                 if transition_occurred:
                     break
 
-                if not isinstance(handler_definition, dict):
-                    continue
-                handler_filters = handler_definition.get("filters", [])
-                handler_actions = handler_definition.get("actions", [])
-                
+                handler_index = compiled_input_handler.index
                 match_filters_start_time = time.monotonic()
-                match = await _match_filters(update, context, handler_filters)
-                logger.debug(f"Executor: _match_filters for handler #{handler_index} took {time.monotonic() - match_filters_start_time:.4f}s. Match: {match}")
+                match = compiled_input_handler.matches(update)
+                logger.debug(f"Executor: filter match for handler #{handler_index} took {time.monotonic() - match_filters_start_time:.4f}s. Match: {match}")
 
                 if match:
                     logger.info(
                         f"Executor: Input matches handler #{handler_index} for state '{state_key}'. Executing actions..."
                     )
-                    if isinstance(handler_actions, list):
-                        for action_index, action_data in enumerate(handler_actions):
-                            if not isinstance(action_data, dict):
-                                continue
-                            action_type = action_data.get("action")
-                            raw_action_params = action_data.get("params", {})
+                    if compiled_input_handler.actions:
+                        for compiled_action in compiled_input_handler.actions:
+                            action_index = compiled_action.index
+                            action_type = compiled_action.action_type
                             action_params = _format_action_params(
-                                raw_action_params, local_state_context, update, context
+                                compiled_action, local_state_context, update_format_data
                             )
 
-                            if not action_type:
-                                continue
-
-                            action_handler_func = ACTION_HANDLERS.get(action_type)
+                            action_handler_func = compiled_action.handler
                             if action_handler_func:
                                 action_specific_start_time = time.monotonic()
                                 try:
@@ -364,7 +390,7 @@ async def execute_state(
                     logger.debug(
                         f"Executor: Matched input_handler #{handler_index} for '{state_key}' did not result in transition. Processing of input_handlers for this update complete."
                     )
-                    break 
+                    break
             logger.debug(f"Executor: input_handlers block for '{state_key}' took {time.monotonic() - input_handlers_block_start_time:.4f}s")
         else:
             logger.debug(f"Executor: No input_handlers defined for state '{state_key}'.")
@@ -374,7 +400,7 @@ async def execute_state(
                 f"Executor: Transition in input_handler for '{state_key}'. State execution for this YAML state ended."
             )
             logger.debug(f"Executor: execute_state (input_handler transition path) took {time.monotonic() - func_total_start_time:.4f}s")
-            return
+            return _outcome()
     else: # process_only_on_entry is True
         logger.info(
             f"Executor: process_only_on_entry is True for '{state_key}'. Skipping input_handlers."
@@ -416,6 +442,7 @@ async def execute_state(
     logger.info(
         f"Executor: Finished execution for state '{state_key}' (YAML state) for user {user_id}. Total time for this execute_state call: {time.monotonic() - func_total_start_time:.4f}s"
     )
+    return _outcome()
 # === END BLOCK 3 ===
 
 # === BLOCK 4: Action Handlers ===
@@ -446,9 +473,9 @@ async def _handle_send_message(
             final_text_to_send = text_override
         elif message_key:
             db_call_start_time = time.monotonic()
-            db_user = await session.get(UserData, user.id) # Potential DB call
-            user_lang_code = db_user.language_code if db_user else None
-            text_from_db = await _get_instruction_text(session, message_key, user_lang_code) # DB call
+            user_profile = await get_user_profile(session, user.id) # Кэш профилей, БД только при промахе
+            user_lang_code = user_profile.language_code if user_profile else None
+            text_from_db = await _get_instruction_text(session, message_key, user_lang_code) # Из каталога data.instructions
             logger.debug(f"Executor: _get_instruction_text for '{message_key}' took {time.monotonic() - db_call_start_time:.4f}s")
 
             if text_from_db:
@@ -485,19 +512,28 @@ async def _handle_send_message(
                 logger.warning(
                     "Executor: reply_markup from YAML params not yet fully implemented in send_message action."
                 )
-            
+
+            await release_connection_for_io(session) # БД больше не нужна до следующего действия
             api_call_start_time = time.monotonic()
             await context.bot.send_message(chat_id=chat_id, text=final_text_to_send, parse_mode=parse_mode, reply_markup=final_reply_markup)
             logger.debug(f"Executor: Telegram API context.bot.send_message took {time.monotonic() - api_call_start_time:.4f}s")
             logger.info(f"Executor: Sent message to chat {chat_id}.")
-        else: 
+        else:
             logger.error("Executor: Cannot send message: chat_id is missing.")
-    except Exception as e: 
+    except Exception as e:
         logger.error(f"Executor: Error in _handle_send_message: {e}", exc_info=True)
     logger.debug(f"Executor: Action 'send_message' total took {time.monotonic() - action_start_time:.4f}s")
     return None
 
 
+# Сколько call_ai решено локально правилами pre_classify, а сколько ушло в AI
+_pre_classify_stats: Dict[str, int] = {"fast_path": 0, "deferred_to_ai": 0}
+
+
+def get_pre_classify_stats() -> Dict[str, int]:
+    return dict(_pre_classify_stats)
+
+
 async def _handle_call_ai(
     params: Dict[str, Any],
     update: Update,
@@ -513,53 +549,89 @@ async def _handle_call_ai(
     history_context_key = params.get("history_context_key")
     user_reply_for_format = params.get("user_reply_for_format")
 
-    if not (prompt_key or system_prompt_override) or not save_to:
-        logger.error("Executor: 'call_ai' action requires 'save_to' and ('prompt_key' or 'system_prompt_override').")
+    if not save_to:
+        logger.error("Executor: 'call_ai' action requires 'save_to'. Nothing will be saved.")
         logger.debug(f"Executor: Action 'call_ai' took {time.monotonic() - action_start_time:.4f}s (early exit)")
-        return {save_to: "ERROR: AI call misconfigured"}
-    
+        return None
+    if not (prompt_key or system_prompt_override):
+        logger.error("Executor: 'call_ai' action requires 'prompt_key' or 'system_prompt_override'.")
+        logger.debug(f"Executor: Action 'call_ai' took {time.monotonic() - action_start_time:.4f}s (early exit)")
+        return {save_to: None, f"{save_to}_error": AIError.NOT_CONFIGURED}
+
     user = update.effective_user
-    if not user: 
+    if not user:
         logger.error("Executor: Action 'call_ai': Cannot determine user.")
         logger.debug(f"Executor: Action 'call_ai' took {time.monotonic() - action_start_time:.4f}s (early exit)")
-        return {save_to: "ERROR: User not found"}
-    
+        return {save_to: None, f"{save_to}_error": AIError.INTERNAL}
+
     returned_payload = {save_to: None} # Default payload in case of issues
     try:
         db_user_call_start_time = time.monotonic()
-        db_user = await session.get(UserData, user.id) # Potential DB call
-        logger.debug(f"Executor: session.get(UserData) for call_ai took {time.monotonic() - db_user_call_start_time:.4f}s")
-        user_lang_code = db_user.language_code if db_user else None
+        user_profile = await get_user_profile(session, user.id) # Кэш профилей, БД только при промахе
+        logger.debug(f"Executor: get_user_profile for call_ai took {time.monotonic() - db_user_call_start_time:.4f}s")
+        user_lang_code = user_profile.language_code if user_profile else None
+
+        # YAML: pre_classify - ключевые слова/regex/callback_data, уверенный ответ без запроса к AI
+        pre_classifier = params.get("pre_classify")
+        if isinstance(pre_classifier, CompiledPreClassifier):
+            callback_data_val = getattr(getattr(update, "callback_query", None), "data", None)
+            message_text = getattr(getattr(update, "message", None), "text", None)
+            if message_text is None and callback_data_val is None:
+                message_text = user_reply_for_format
+            pre_classified = pre_classifier.classify(message_text, callback_data_val, user_lang_code)
+            if pre_classified is not None:
+                _pre_classify_stats["fast_path"] += 1
+                logger.info(f"Executor: call_ai '{save_to}' pre-classified locally as '{pre_classified}', AI call skipped.")
+                logger.debug(f"Executor: Action 'call_ai' total took {time.monotonic() - action_start_time:.4f}s (pre_classify)")
+                return {save_to: pre_classified, f"{save_to}_error": None}
+            _pre_classify_stats["deferred_to_ai"] += 1
+            logger.debug(f"Executor: call_ai '{save_to}' input is ambiguous for pre_classify, calling AI.")
 
         messages_history = []
         if history_context_key:
             history_from_context = state_context.get(history_context_key)
-            if isinstance(history_from_context, list): messages_history.extend(history_from_context)
-        
+            if isinstance(history_from_context, list):
+                messages_history.extend(history_from_context)
+
         if not messages_history:
             current_user_input_text = getattr(getattr(update, "message", None), "text", None) or getattr(getattr(update, "callback_query", None), "data", None)
-            if current_user_input_text: messages_history.append({"role": "user", "content": str(current_user_input_text)})
-            elif user_reply_for_format: messages_history.append({"role": "user", "content": str(user_reply_for_format)})
-        
+            if current_user_input_text:
+                messages_history.append({"role": "user", "content": str(current_user_input_text)})
+            elif user_reply_for_format:
+                messages_history.append({"role": "user", "content": str(user_reply_for_format)})
+
+        try:
+            ai_timeout = float(params["timeout"]) if params.get("timeout") is not None else None
+        except (TypeError, ValueError):
+            logger.warning(f"Executor: Invalid call_ai timeout '{params.get('timeout')}', using gateway default.")
+            ai_timeout = None
+
         ai_call_start_time = time.monotonic()
-        ai_response = await generate_text_response(
-            messages=messages_history, instruction_key=prompt_key, 
-            user_lang_code=user_lang_code, session=session, 
-            system_prompt_override=system_prompt_override, 
-            user_reply_for_format=user_reply_for_format
+        ai_result = await generate_ai_result(
+            messages=messages_history, instruction_key=prompt_key,
+            user_lang_code=user_lang_code, session=session,
+            system_prompt_override=system_prompt_override,
+            user_reply_for_format=user_reply_for_format,
+            # Соединение отпускается после загрузки инструкции, до запроса к AI
+            release_session_before_call=defers_state_writes(session),
+            # YAML: cache: true / cache_ttl: <сек> - для детерминированных классификаций
+            cache_ttl=resolve_cache_ttl(params),
+            # YAML: timeout: <сек> - дедлайн вызова с повторами (ai.gateway)
+            timeout=ai_timeout,
         )
-        logger.debug(f"Executor: AI call (generate_text_response internal) took {time.monotonic() - ai_call_start_time:.4f}s")
+        logger.debug(f"Executor: AI call (generate_ai_result internal) took {time.monotonic() - ai_call_start_time:.4f}s")
 
-        if ai_response is not None:
-            logger.info(f"Executor: AI response received: '{ai_response[:70]}...'")
-            returned_payload = {save_to: ai_response}
+        if ai_result.ok:
+            logger.info(f"Executor: AI response received (attempts={ai_result.attempts}, cached={ai_result.from_cache}): '{ai_result.text[:70]}...'")
+            returned_payload = {save_to: ai_result.text, f"{save_to}_error": None}
         else:
-            logger.error("Executor: AI call returned None.")
-            returned_payload = {save_to: None}
+            # Код ошибки - для переходов сценария (например, condition по '<save_to>_error')
+            logger.error(f"Executor: AI call failed with error '{ai_result.error}'.")
+            returned_payload = {save_to: None, f"{save_to}_error": ai_result.error}
     except Exception as e:
         logger.error(f"Executor: Error in _handle_call_ai: {e}", exc_info=True)
-        returned_payload = {save_to: f"ERROR_AI_CALL: {type(e).__name__}"}
-    
+        returned_payload = {save_to: None, f"{save_to}_error": AIError.INTERNAL}
+
     logger.debug(f"Executor: Action 'call_ai' total took {time.monotonic() - action_start_time:.4f}s")
     return returned_payload
 
@@ -576,53 +648,46 @@ async def _handle_call_handler(
     function_name_str = params.get("function_name")
     save_result_to = params.get("save_result_to")
     logger.debug(f"Executor: Executing action 'call_handler' for '{function_name_str}' with params: {params}")
-    
+
     if not function_name_str:
         logger.error("Executor: 'call_handler' requires 'function_name' parameter.")
         error_payload = {"error_calling_handler": "Missing function_name"}
-        if save_result_to: error_payload[save_result_to] = "ERROR: Missing function_name"
+        if save_result_to:
+            error_payload[save_result_to] = "ERROR: Missing function_name"
         logger.debug(f"Executor: Action 'call_handler' for '{function_name_str}' took {time.monotonic() - action_start_time:.4f}s (early exit)")
         return error_payload
 
     returned_payload = {}
     try:
-        module_path, func_name = function_name_str.rsplit(".", 1)
-        module = importlib.import_module(module_path)
-        handler_func_to_call = getattr(module, func_name)
-
-        if not inspect.iscoroutinefunction(handler_func_to_call):
-            logger.error(f"Executor: Handler function '{function_name_str}' is not an async function.")
-            error_val = f"ERROR: Handler '{function_name_str}' not async"
-            returned_payload = {"error_calling_handler": error_val}
-            if save_result_to: returned_payload[save_result_to] = error_val
-            raise TypeError(error_val) # Raise to be caught by generic exception
-
-        sig = inspect.signature(handler_func_to_call)
-        handler_kwargs = {}
-        if "update" in sig.parameters: handler_kwargs["update"] = update
-        if "context" in sig.parameters: handler_kwargs["context"] = context
-        if "session" in sig.parameters: handler_kwargs["session"] = session
-        if "state_context" in sig.parameters: handler_kwargs["state_context"] = state_context.copy()
-        if "current_state_from_db" in sig.parameters: handler_kwargs["current_state_from_db"] = current_state_from_db
+        # Импорт и разбор сигнатуры выполняются один раз (handler_registry)
+        resolved_handler = resolve_handler(function_name_str)
+        handler_func_to_call = resolved_handler.func
+        handler_kwargs = resolved_handler.build_kwargs({
+            "update": update,
+            "context": context,
+            "session": session,
+            "state_context": MappingProxyType(state_context), # только чтение, без копии
+            "current_state_from_db": current_state_from_db,
+        })
 
         logger.info(f"Executor: Calling custom handler: {function_name_str} with args: {list(handler_kwargs.keys())}")
-        
+
         handler_call_start_time = time.monotonic()
         returned_value_from_handler = await handler_func_to_call(**handler_kwargs)
         logger.debug(f"Executor: Custom handler '{function_name_str}' execution took {time.monotonic() - handler_call_start_time:.4f}s")
-        
+
         logger.info(f"Executor: Custom handler '{function_name_str}' returned type: {type(returned_value_from_handler)}, value: '{str(returned_value_from_handler)[:100]}...'")
 
         if isinstance(returned_value_from_handler, dict):
             returned_payload.update(returned_value_from_handler)
         elif returned_value_from_handler is not None and not save_result_to:
             logger.warning(f"Executor: Handler '{function_name_str}' returned a non-dict/non-None value but no 'save_result_to' was specified. Return value ignored: {returned_value_from_handler}")
-        
+
         if save_result_to:
             returned_payload[save_result_to] = returned_value_from_handler
             logger.debug(f"Executor: Result from handler '{function_name_str}' will be saved to context key '{save_result_to}'.")
-        
-    except (ModuleNotFoundError, AttributeError) as e_import:
+
+    except HandlerResolutionError as e_import:
         logger.error(f"Executor: Could not import/find handler '{function_name_str}': {e_import}")
         error_val = f"ERROR: Handler not found - {function_name_str}"
         returned_payload = {save_result_to: error_val} if save_result_to else {"error_calling_handler": error_val}
@@ -634,7 +699,7 @@ async def _handle_call_handler(
         logger.error(f"Executor: Error executing custom handler '{function_name_str}': {e}", exc_info=True)
         error_val = f"ERROR: Handler execution failed - {type(e).__name__}"
         returned_payload = {save_result_to: error_val} if save_result_to else {"error_calling_handler": error_val}
-    
+
     logger.debug(f"Executor: Action 'call_handler' for '{function_name_str}' total took {time.monotonic() - action_start_time:.4f}s")
     return returned_payload
 
@@ -665,7 +730,7 @@ async def _handle_transition_to(
 
     final_context_for_next_state = state_context.copy()
     final_context_for_next_state.update(context_to_set_from_yaml)
-    
+
     final_context_for_next_state.pop(_ON_ENTRY_DONE_FLAG, None)
     final_context_for_next_state.pop(_HANDLER_INITIATED_SWITCH_FLAG, None)
     final_context_for_next_state.pop(_TRIGGER_STATE_TRANSITION_KEY, None)
@@ -675,7 +740,7 @@ async def _handle_transition_to(
         f"in scenario '{current_state_from_db.scenario_key}' to (new state) '{next_state_key}'. "
         f"Context for new state (after YAML set_context and flag clearing): {final_context_for_next_state}"
     )
-    
+
     update_db_start_time = time.monotonic()
     updated_db_state = await update_user_state(
         user_id=current_state_from_db.user_id,
@@ -702,130 +767,4 @@ ACTION_HANDLERS: Dict[str, ActionHandlerType] = {
 # === END BLOCK 4 ===
 
 
-# === BLOCK 5: Filter Matching Helper ===
-async def _match_filters(
-    update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
-    filters_config: List[Dict[str, Any]],
-) -> bool:
-    # Этот блок не изменялся для логирования времени, т.к. обычно он очень быстрый.
-    # Если есть подозрения, можно добавить аналогичное логирование.
-    if not isinstance(filters_config, list):
-        logger.warning(
-            f"Executor: Filter matching failed: filters_config is not a list: {filters_config}"
-        )
-        return False
-    if not filters_config:
-        logger.debug("Executor: Empty filter list in input_handler matches any input by default.")
-        return True
-
-    all_match = True
-    for filter_index, filter_item in enumerate(filters_config):
-        if not isinstance(filter_item, dict):
-            logger.warning(
-                f"Executor: Invalid filter item format #{filter_index} (expected dict): {filter_item}"
-            )
-            all_match = False
-            break
-
-        filter_type = filter_item.get("type")
-        # logger.debug(f"Executor: Checking filter #{filter_index}: {filter_item}") # Может быть слишком многословно
-        match_this_filter = False
-
-        if filter_type == "message":
-            if update.message:
-                content_type = filter_item.get("content_type")
-                content_type_matched = False
-                if (
-                    not content_type
-                    or (
-                        content_type == "text"
-                        and getattr(update.message, "text", None) is not None
-                    )
-                    or (
-                        content_type == "photo"
-                        and getattr(update.message, "photo", None)
-                    ) 
-                    or ( 
-                        content_type == "document"
-                        and getattr(update.message, "document", None)
-                    )
-                ):
-                    content_type_matched = True
-                elif content_type: 
-                    # logger.debug(f"Executor: Filter type 'message': content_type '{content_type}' mismatch.") # Многословно
-                    pass
-
-
-                if not content_type_matched:
-                    all_match = False
-                    break
-
-                if content_type == "text" or not content_type: # Process text conditions only if it's a text message or no content_type specified
-                    message_text = getattr(update.message, "text", None)
-                    if message_text is not None: # Text message exists
-                        text_exact = filter_item.get("text")
-                        if text_exact is not None and message_text != text_exact:
-                            all_match = False; break
-                        text_regex_str = filter_item.get("regex")
-                        if text_regex_str is not None:
-                            try:
-                                if not re.fullmatch(text_regex_str, message_text):
-                                    all_match = False; break
-                            except re.error as re_err:
-                                logger.error(f"Executor: Invalid regex pattern '{text_regex_str}': {re_err}")
-                                all_match = False; break
-                    elif (filter_item.get("text") is not None or filter_item.get("regex") is not None): # Text conditions exist but it's not a text message
-                        all_match = False; break
-                match_this_filter = True
-            else: 
-                all_match = False; break
-        elif filter_type == "callback_query":
-            callback_data_val = getattr(getattr(update, "callback_query", None), "data", None)
-            if update.callback_query and callback_data_val is not None:
-                data_exact = filter_item.get("data")
-                if data_exact is not None and callback_data_val != data_exact:
-                    all_match = False; break
-                data_pattern_str = filter_item.get("pattern")
-                if data_pattern_str is not None:
-                    try:
-                        if not re.fullmatch(data_pattern_str, callback_data_val):
-                            all_match = False; break
-                    except re.error as re_err:
-                        logger.error(f"Executor: Invalid regex pattern for callback_data '{data_pattern_str}': {re_err}")
-                        all_match = False; break
-                match_this_filter = True
-            else: 
-                all_match = False; break
-        elif filter_type == "command":
-            message_text = getattr(getattr(update, "message", None), "text", None)
-            if update.message and message_text and message_text.startswith("/"):
-                command_expected = filter_item.get("command")
-                if command_expected:
-                    command_expected_clean = command_expected.lstrip("/")
-                    actual_command_parts = message_text.split(maxsplit=1)
-                    actual_command = actual_command_parts[0][1:]
-                    if actual_command == command_expected_clean:
-                        match_this_filter = True
-                    else:
-                        all_match = False; break
-                else:
-                    logger.warning("Executor: Filter type 'command' but 'command' parameter missing.")
-                    all_match = False; break
-            else: 
-                all_match = False; break
-        else:
-            logger.warning(f"Executor: Unknown filter type '{filter_type}'.")
-            all_match = False; break
-
-        if not match_this_filter: # Should be redundant if breaks are used above, but as a safeguard
-            all_match = False; break
-
-    if all_match:
-        logger.info(f"Executor: Update {update.update_id} MATCHED ALL filters in the list.")
-    # else: # Этот лог может быть слишком частым, если фильтры не совпали
-        # logger.debug(f"Executor: Update {update.update_id} did NOT match all filters in the list.")
-    return all_match
-# === END BLOCK 5 ===
-
-# === END BLOCK: BehaviorEngine/executor.py (Конец файла) ===
\ No newline at end of file
+# === END BLOCK: BehaviorEngine/executor.py (Конец файла) ===
@@ -0,0 +1,105 @@
+# BehaviorEngine/handler_registry.py
+# Реестр функций для действия call_handler: импорт и разбор сигнатуры один раз
+
+# === BLOCK 1: Imports ===
+import importlib
+import inspect
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Resolved Handler ===
+# Аргументы, которые executor умеет передавать в хендлер (в порядке проверки)
+INJECTABLE_ARGS: Tuple[str, ...] = (
+    "update",
+    "context",
+    "session",
+    "state_context",
+    "current_state_from_db",
+)
+
+
+class HandlerResolutionError(LookupError):
+    """function_name из сценария не удалось найти (модуль/функция не существуют)."""
+
+
+class ResolvedHandler:
+    """Найденная async-функция и план внедрения аргументов (какие из INJECTABLE_ARGS она принимает)."""
+
+    __slots__ = ("function_name", "func", "injected_args")
+
+    def __init__(
+        self, function_name: str, func: Callable, injected_args: Tuple[str, ...]
+    ) -> None:
+        self.function_name = function_name
+        self.func = func
+        self.injected_args = injected_args
+
+    def build_kwargs(self, available_args: Dict[str, Any]) -> Dict[str, Any]:
+        return {name: available_args[name] for name in self.injected_args}
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Registry ===
+# Кэш на процесс: dict[function_name, ResolvedHandler]. Ошибки не кэшируются.
+_handler_registry: Dict[str, ResolvedHandler] = {}
+
+
+def resolve_handler(function_name: str) -> ResolvedHandler:
+    """
+    Возвращает ResolvedHandler для 'module.path.func_name' (из кэша или импортирует).
+
+    Raises:
+        HandlerResolutionError: модуль или функция не найдены, неверный формат имени.
+        TypeError: функция найдена, но не является async.
+    """
+    resolved = _handler_registry.get(function_name)
+    if resolved is not None:
+        return resolved
+
+    if not isinstance(function_name, str) or "." not in function_name:
+        raise HandlerResolutionError(
+            f"Invalid function_name '{function_name}' (expected 'module.func')"
+        )
+    module_path, func_name = function_name.rsplit(".", 1)
+    try:
+        module = importlib.import_module(module_path)
+        handler_func = getattr(module, func_name)
+    except (ModuleNotFoundError, AttributeError) as e:
+        raise HandlerResolutionError(f"Handler '{function_name}' not found: {e}") from e
+
+    if not inspect.iscoroutinefunction(handler_func):
+        raise TypeError(f"Handler '{function_name}' is not an async function")
+
+    parameters = inspect.signature(handler_func).parameters
+    injected_args = tuple(name for name in INJECTABLE_ARGS if name in parameters)
+    resolved = ResolvedHandler(function_name, handler_func, injected_args)
+    _handler_registry[function_name] = resolved
+    logger.debug(
+        f"HandlerRegistry: Resolved '{function_name}', injected args: {list(injected_args)}"
+    )
+    return resolved
+
+
+def validate_handlers(function_names: Iterable[str]) -> List[str]:
+    """Пробует разрешить все имена; возвращает список ошибок (пустой - все в порядке)."""
+    errors: List[str] = []
+    for function_name in function_names:
+        try:
+            resolve_handler(function_name)
+        except (HandlerResolutionError, TypeError) as e:
+            errors.append(str(e))
+    return errors
+
+
+def clear_handler_registry() -> None:
+    _handler_registry.clear()
+    logger.info("HandlerRegistry: Registry cleared.")
+# === END BLOCK 4 ===
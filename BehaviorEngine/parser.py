@@ -2,7 +2,7 @@
 
 # === BLOCK 1: Imports ===
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
 
 import yaml
 from sqlalchemy import select
@@ -11,7 +11,10 @@ from yaml import YAMLError  # Импортируем специфичную ош
 
 # Импортируем модель сценария из БД
 try:
+    from database.cache_sync import cache_sync
     from database.models import ConversationScenario
+
+    from .compiler import CompiledScenario, compile_scenario
 except ImportError as e:
     # Логгируем критическую ошибку и прерываем выполнение, если модель не найдена
     logging.critical(
@@ -27,54 +30,63 @@ logger = logging.getLogger(__name__)
 
 
 # === BLOCK 3: In-Memory Cache ===
-# Простой кэш для хранения распарсенных сценариев (dict[scenario_key, parsed_yaml_dict])
+# Кэш распарсенных сценариев: dict[scenario_key, (version, parsed_yaml_dict)].
+# Скомпилированные сценарии: dict[(scenario_key, version), CompiledScenario].
 # Внимание: Этот кэш будет сброшен при перезапуске бота.
-# Для более надежного кэширования в будущем можно использовать Redis (Phase 5).
-_scenario_cache: Dict[str, Dict[str, Any]] = {}
+_scenario_cache: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+_compiled_scenario_cache: Dict[Tuple[str, int], CompiledScenario] = {}
+# Актуальные версии активных сценариев по данным cache_sync (NOTIFY/опрос).
+# Если версия ключа неизвестна (синхронизация не запущена), кэшу доверяем как раньше.
+_latest_scenario_versions: Dict[str, int] = {}
+
+SCENARIO_CACHE_CHANNEL = "scenario_cache"
 # === END BLOCK 3 ===
 
 
 # === BLOCK 4: Load and Parse Scenario Function ===
-async def load_and_parse_scenario(
-    scenario_key: str,
-    session: AsyncSession,
-    force_reload: bool = False,  # Флаг для принудительной перезагрузки из БД
-) -> Optional[Dict[str, Any]]:
-    """
-    Загружает активный сценарий по ключу из БД, парсит YAML и кэширует результат.
+def _get_cached_entry(scenario_key: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Запись кэша, если она соответствует последней известной версии."""
+    cached_entry = _scenario_cache.get(scenario_key)
+    if cached_entry is None:
+        return None
+    latest_version = _latest_scenario_versions.get(scenario_key)
+    if latest_version is not None and cached_entry[0] < latest_version:
+        logger.info(
+            f"Сценарий '{scenario_key}' в кэше устарел (v{cached_entry[0]}, актуальная v{latest_version})."
+        )
+        return None
+    return cached_entry
 
-    Args:
-        scenario_key: Уникальный ключ сценария для загрузки.
-        session: Активная сессия SQLAlchemy.
-        force_reload: Если True, принудительно загружает из БД, игнорируя кэш.
 
-    Returns:
-        Словарь с распарсенным сценарием или None, если сценарий не найден,
-        неактивен, содержит невалидный YAML или произошла ошибка БД.
-    """
+async def _load_scenario_entry(
+    scenario_key: str, session: AsyncSession, force_reload: bool
+) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Возвращает (version, parsed_yaml_dict) из кэша или из БД."""
     if not scenario_key:
         logger.warning("Попытка загрузить сценарий с пустым scenario_key")
         return None
 
     # 1. Проверка кэша (если не требуется принудительная перезагрузка)
-    if not force_reload and scenario_key in _scenario_cache:
-        logger.debug(f"Сценарий '{scenario_key}' найден в кэше.")
-        # Возвращаем копию из кэша, чтобы избежать случайного изменения оригинала
-        return _scenario_cache[scenario_key].copy()
+    if not force_reload:
+        cached_entry = _get_cached_entry(scenario_key)
+        if cached_entry is not None:
+            logger.debug(f"Сценарий '{scenario_key}' v{cached_entry[0]} найден в кэше.")
+            return cached_entry
 
     logger.debug(
         f"Загрузка сценария '{scenario_key}' из БД (force_reload={force_reload})..."
     )
     try:
-        # 2. Запрос к БД: ищем активный сценарий по ключу, выбираем только поле definition
+        # 2. Запрос к БД: ищем активный сценарий по ключу (definition и version)
         stmt = (
-            select(ConversationScenario.definition)
+            select(ConversationScenario.definition, ConversationScenario.version)
             .where(ConversationScenario.scenario_key == scenario_key)
             .where(ConversationScenario.is_active)
             .limit(1)
         )  # Отступ этой строки важен
         result = await session.execute(stmt)
-        yaml_definition_str = result.scalar_one_or_none()  # Получаем строку или None
+        row = result.one_or_none()
+        yaml_definition_str = row.definition if row else None
 
         # Если сценарий не найден или неактивен
         if not yaml_definition_str:
@@ -82,8 +94,7 @@ async def load_and_parse_scenario(
                 f"Активный сценарий с ключом '{scenario_key}' не найден в БД или не активен."
             )
             # Если ключ был в кэше (например, сценарий деактивировали), удаляем его
-            if scenario_key in _scenario_cache:
-                del _scenario_cache[scenario_key]
+            _drop_scenario(scenario_key)
             return None
 
         # 3. Парсинг YAML-строки
@@ -95,17 +106,17 @@ async def load_and_parse_scenario(
                     f"Ошибка парсинга YAML для '{scenario_key}': результат не является словарем (dict). Тип: {type(parsed_scenario)}"
                 )
                 # Очищаем кэш для этого ключа, если там была некорректная запись
-                if scenario_key in _scenario_cache:
-                    del _scenario_cache[scenario_key]
+                _drop_scenario(scenario_key)
                 return None
 
+            version = row.version
             logger.info(
-                f"Сценарий '{scenario_key}' успешно загружен из БД и распарсен."
+                f"Сценарий '{scenario_key}' v{version} успешно загружен из БД и распарсен."
             )
-            # 4. Кэширование успешно распарсенного результата
-            _scenario_cache[scenario_key] = parsed_scenario
-            # Возвращаем копию словаря
-            return parsed_scenario.copy()
+            # 4. Кэширование успешно распарсенного результата (старые версии удаляем)
+            _drop_scenario(scenario_key)
+            _scenario_cache[scenario_key] = (version, parsed_scenario)
+            return _scenario_cache[scenario_key]
 
         except YAMLError as e:
             # Обработка ошибок парсинга YAML
@@ -114,8 +125,7 @@ async def load_and_parse_scenario(
                 exc_info=True,
             )
             # Очищаем кэш для этого ключа
-            if scenario_key in _scenario_cache:
-                del _scenario_cache[scenario_key]
+            _drop_scenario(scenario_key)
             return None
 
     except Exception as e:
@@ -125,15 +135,87 @@ async def load_and_parse_scenario(
             exc_info=True,
         )
         # Очищаем кэш для этого ключа
-        if scenario_key in _scenario_cache:
-            del _scenario_cache[scenario_key]
+        _drop_scenario(scenario_key)
         return None
 
 
+async def load_and_parse_scenario(
+    scenario_key: str,
+    session: AsyncSession,
+    force_reload: bool = False,  # Флаг для принудительной перезагрузки из БД
+) -> Optional[Dict[str, Any]]:
+    """
+    Загружает активный сценарий по ключу из БД, парсит YAML и кэширует результат.
+    Кэш проверяется по версии сценария (см. BLOCK 6), поэтому обновленный
+    через /upload_scenario сценарий перечитывается без перезапуска.
+
+    Args:
+        scenario_key: Уникальный ключ сценария для загрузки.
+        session: Активная сессия SQLAlchemy.
+        force_reload: Если True, принудительно загружает из БД, игнорируя кэш.
+
+    Returns:
+        Словарь с распарсенным сценарием или None, если сценарий не найден,
+        неактивен, содержит невалидный YAML или произошла ошибка БД.
+    """
+    scenario_entry = await _load_scenario_entry(scenario_key, session, force_reload)
+    if scenario_entry is None:
+        return None
+    # Возвращаем копию из кэша, чтобы избежать случайного изменения оригинала
+    return scenario_entry[1].copy()
+
+
 # === END BLOCK 4 ===
 
 
+# === BLOCK 4.5: Load Compiled Scenario Function ===
+async def load_compiled_scenario(
+    scenario_key: str,
+    session: AsyncSession,
+    action_handlers: Mapping[str, Callable],
+    force_reload: bool = False,
+) -> Optional[CompiledScenario]:
+    """
+    Возвращает скомпилированный сценарий (см. compiler.py).
+    Компиляция выполняется один раз на версию сценария, дальше - из кэша.
+
+    Args:
+        scenario_key: Уникальный ключ сценария.
+        session: Активная сессия SQLAlchemy.
+        action_handlers: Обработчики действий (executor.ACTION_HANDLERS).
+        force_reload: Если True, заново загружает YAML из БД и перекомпилирует.
+
+    Returns:
+        CompiledScenario или None, если сценарий не удалось загрузить.
+    """
+    scenario_entry = await _load_scenario_entry(scenario_key, session, force_reload)
+    if scenario_entry is None:
+        return None
+    version, parsed_scenario = scenario_entry
+
+    cache_key = (scenario_key, version)
+    compiled_scenario = None if force_reload else _compiled_scenario_cache.get(cache_key)
+    if compiled_scenario is not None:
+        logger.debug(f"Скомпилированный сценарий '{scenario_key}' v{version} найден в кэше.")
+        return compiled_scenario
+
+    compiled_scenario = compile_scenario(scenario_key, parsed_scenario, action_handlers)
+    _compiled_scenario_cache[cache_key] = compiled_scenario
+    return compiled_scenario
+
+
+# === END BLOCK 4.5 ===
+
+
 # === BLOCK 5: Clear Cache Function ===
+def _drop_scenario(scenario_key: str) -> bool:
+    """Удаляет все закэшированные версии сценария. Возвращает True, если что-то было в кэше."""
+    was_cached = _scenario_cache.pop(scenario_key, None) is not None
+    for cache_key in [key for key in _compiled_scenario_cache if key[0] == scenario_key]:
+        del _compiled_scenario_cache[cache_key]
+    return was_cached
+
+
 def clear_scenario_cache(scenario_key: Optional[str] = None) -> None:
     """
     Очищает кэш сценариев (либо весь, либо по ключу).
@@ -143,18 +225,67 @@ def clear_scenario_cache(scenario_key: Optional[str] = None) -> None:
         scenario_key: Если указан, очищает кэш только для этого ключа.
                       Если None, очищает весь кэш.
     """
-    global _scenario_cache
     if scenario_key:
-        # Используем pop для удаления и избежания KeyError, если ключа нет
-        if _scenario_cache.pop(scenario_key, None) is not None:
+        if _drop_scenario(scenario_key):
             logger.info(f"Кэш для сценария '{scenario_key}' очищен.")
         else:
             logger.debug(
                 f"Попытка очистить кэш для ключа '{scenario_key}', который не был закэширован."
             )
     else:
-        _scenario_cache = {}
+        _scenario_cache.clear()
+        _compiled_scenario_cache.clear()
         logger.info("Кэш всех сценариев очищен.")
 
 
 # === END BLOCK 5 ===
+
+
+# === BLOCK 6: Cross-Process Invalidation (cache_sync) ===
+def build_scenario_notify_payload(scenario_key: str, version: int) -> str:
+    return f"{version}:{scenario_key}"
+
+
+def _on_scenario_notify(payload: str) -> None:
+    """NOTIFY от /upload_scenario: payload 'version:scenario_key'."""
+    version_str, _, scenario_key = payload.partition(":")
+    try:
+        version = int(version_str)
+    except ValueError:
+        logger.warning(f"Некорректный payload NOTIFY сценария: '{payload}'")
+        return
+    # Версии только растут: не откатываемся, если уже знаем более новую
+    _latest_scenario_versions[scenario_key] = max(
+        version, _latest_scenario_versions.get(scenario_key, version)
+    )
+    cached_entry = _scenario_cache.get(scenario_key)
+    if cached_entry is not None and cached_entry[0] < version:
+        _drop_scenario(scenario_key)
+        logger.info(f"Сценарий '{scenario_key}': получена версия v{version}, кэш сброшен.")
+
+
+async def _poll_scenario_versions(session: AsyncSession) -> None:
+    """Сверка версий всех активных сценариев (fallback для LISTEN/NOTIFY)."""
+    result = await session.execute(
+        select(ConversationScenario.scenario_key, ConversationScenario.version).where(
+            ConversationScenario.is_active
+        )
+    )
+    active_versions = {row.scenario_key: row.version for row in result}
+    for scenario_key in list(_scenario_cache):
+        active_version = active_versions.get(scenario_key)
+        if active_version is None or _scenario_cache[scenario_key][0] < active_version:
+            _drop_scenario(scenario_key)
+            logger.info(f"Сценарий '{scenario_key}' изменен или деактивирован, кэш сброшен.")
+    # NOTIFY мог прийти во время запроса - берем максимум из известных версий
+    for scenario_key in list(_latest_scenario_versions):
+        if scenario_key not in active_versions:
+            del _latest_scenario_versions[scenario_key]
+    for scenario_key, active_version in active_versions.items():
+        _latest_scenario_versions[scenario_key] = max(
+            active_version, _latest_scenario_versions.get(scenario_key, active_version)
+        )
+
+
+cache_sync.register(SCENARIO_CACHE_CHANNEL, _on_scenario_notify, _poll_scenario_versions)
+# === END BLOCK 6 ===
@@ -3,13 +3,20 @@
 # === BLOCK 1: Imports ===
 import logging
 import time # <--- ДОБАВЬТЕ ЭТУ СТРОКУ
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import Text, cast, delete, func, select, update
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 try:
-    from database.models import UserStates  # <--- UserData УДАЛЕН ОТСЮДА
+    from database.models import (  # <--- UserData УДАЛЕН ОТСЮДА
+        UserStates,
+        release_session_connection,
+    )
+
+    from .context import StateContext
 except ImportError as e:
     logging.critical(
         f"CRITICAL: Failed to import DB models in state_manager: {e}", exc_info=True
@@ -23,6 +30,96 @@ logger = logging.getLogger(__name__)
 # === END BLOCK 2 ===
 
 
+# === BLOCK 2.5: Session-Level State Tracking ===
+# Последнее известное состояние каждого пользователя в рамках сессии.
+# Заполняется get/update/reset_user_state, чтобы движок мог узнать итоговое
+# состояние после execute_state без повторного SELECT.
+_SESSION_STATES_KEY = "behavior_engine_user_states"
+
+
+def _remember_user_state(
+    session: AsyncSession, user_id: int, user_state: Optional[UserStates]
+) -> None:
+    session.info.setdefault(_SESSION_STATES_KEY, {})[user_id] = user_state
+
+
+def get_known_user_state(
+    user_id: int, session: AsyncSession
+) -> Tuple[bool, Optional[UserStates]]:
+    """
+    Возвращает (known, user_state) - последнее состояние пользователя, которое
+    эта сессия читала или записывала. known=False, если сессия его еще не видела.
+    user_state=None при known=True означает, что состояние было сброшено.
+    """
+    known_states = session.info.get(_SESSION_STATES_KEY, {})
+    if user_id in known_states:
+        return True, known_states[user_id]
+    return False, None
+
+
+# --- Отложенная запись состояний (одна запись на апдейт) ---
+# В режиме отложенной записи update_user_state/reset_user_state не ходят в БД:
+# промежуточные состояния цепочки переходов живут только в памяти (объекты
+# UserStates отсоединены от сессии, autoflush их не пишет), а итоговое
+# состояние пишется одним запросом в flush_deferred_state_writes перед commit.
+#
+# Семантика при сбое: до flush_deferred_state_writes в БД ничего не записано.
+# Если процесс упадет или обработка прервется исключением посреди цепочки,
+# пользователь останется в состоянии, которое было до апдейта (как и раньше -
+# промежуточные flush без commit тоже откатывались). Уже отправленные on_entry
+# сообщения при этом не отзываются, и при повторном апдейте on_entry
+# промежуточных состояний выполнятся снова.
+# Код, читающий user_states в обход get_user_state, отложенных изменений не видит.
+_SESSION_DEFERRED_KEY = "behavior_engine_deferred_state_user_ids"
+
+
+def begin_deferred_state_writes(session: AsyncSession) -> None:
+    """Включает для сессии режим отложенной записи UserStates."""
+    session.info.setdefault(_SESSION_DEFERRED_KEY, set())
+
+
+def _is_deferred(session: AsyncSession) -> bool:
+    return _SESSION_DEFERRED_KEY in session.info
+
+
+def _mark_user_state_dirty(session: AsyncSession, user_id: int) -> None:
+    deferred_user_ids: Set[int] = session.info[_SESSION_DEFERRED_KEY]
+    deferred_user_ids.add(user_id)
+
+
+# Пользователи, у которых в цепочке контекст заменялся целиком (обычный dict,
+# смена сценария или сброс). Дельта итогового StateContext тогда считается от
+# новой базы, а не от строки в БД, поэтому flush пишет контекст полным upsert.
+_SESSION_CONTEXT_REPLACED_KEY = "behavior_engine_context_replaced_user_ids"
+
+
+def _mark_context_replaced(session: AsyncSession, user_id: int) -> None:
+    session.info.setdefault(_SESSION_CONTEXT_REPLACED_KEY, set()).add(user_id)
+
+
+# --- Освобождение соединения на время внешнего I/O ---
+# Апдейт делится на фазы: чтения/записи в БД и внешние вызовы (AI, Telegram).
+# Перед внешним вызовом транзакция коммитится и соединение возвращается в пул,
+# следующий запрос возьмет его снова; итоговое состояние пишет flush перед
+# финальным commit. Разрешено только в режиме отложенной записи: там сессией
+# владеет движок и состояние еще не в БД. Если сессию открыл вызывающий код
+# (например, /start внутри session.begin()), транзакцию не трогаем.
+def defers_state_writes(session: AsyncSession) -> bool:
+    """True, если сессия в режиме отложенной записи (и соединение можно отпускать)."""
+    return _is_deferred(session)
+
+
+async def release_connection_for_io(session: AsyncSession) -> bool:
+    """Отпускает соединение сессии перед внешним вызовом. True - если отпущено."""
+    if not _is_deferred(session) or not session.in_transaction():
+        return False
+    release_start_time = time.monotonic()
+    await release_session_connection(session)
+    logger.debug(f"StateMgr: Connection released before external I/O, commit took {time.monotonic() - release_start_time:.4f}s")
+    return True
+# === END BLOCK 2.5 ===
+
+
 # === BLOCK 3: Get User State ===
 async def get_user_state(user_id: int, session: AsyncSession) -> Optional[UserStates]:
     func_start_time = time.monotonic()
@@ -31,6 +128,12 @@ async def get_user_state(user_id: int, session: AsyncSession) -> Optional[UserSt
         logger.warning(f"StateMgr: Получен некорректный user_id: {user_id}")
         logger.debug(f"StateMgr: get_user_state for {user_id} (invalid ID) took {time.monotonic() - func_start_time:.4f}s")
         return None
+    if _is_deferred(session):
+        known, known_state = get_known_user_state(user_id, session)
+        if known:
+            # В режиме отложенной записи актуальное состояние - в памяти
+            logger.debug(f"StateMgr: get_user_state for {user_id} served from deferred session state. Found: {'Yes' if known_state else 'No'}")
+            return known_state
     try:
         stmt = select(UserStates).where(UserStates.user_id == user_id)
 
@@ -46,6 +149,10 @@ async def get_user_state(user_id: int, session: AsyncSession) -> Optional[UserSt
         else:
             logger.debug(f"StateMgr: Активное состояние для user_id={user_id} не найдено.")
 
+        if user_state and _is_deferred(session):
+            # Отсоединяем объект: изменения в памяти не должны уходить в БД через autoflush
+            session.expunge(user_state)
+        _remember_user_state(session, user_id, user_state)
         logger.debug(f"StateMgr: get_user_state for {user_id} total took {time.monotonic() - func_start_time:.4f}s. Found: {'Yes' if user_state else 'No'}")
         return user_state
     except Exception as e:
@@ -57,6 +164,124 @@ async def get_user_state(user_id: int, session: AsyncSession) -> Optional[UserSt
         return None
 # === END BLOCK 3 ===
 
+# === BLOCK 3.5: Set-Based Statements ===
+async def _upsert_user_state(
+    user_id: int,
+    scenario_key: str,
+    state_key: str,
+    context_data: Optional[Dict[str, Any]],
+    session: AsyncSession,
+) -> UserStates:
+    """
+    Одна команда INSERT ... ON CONFLICT (user_id) DO UPDATE ... RETURNING.
+    Требует уникальный индекс uq_user_state (см. database.models).
+    populate_existing обновляет объект в identity map, если он уже загружен.
+    """
+    if isinstance(context_data, StateContext):
+        context_data = dict(context_data)
+    stmt = (
+        pg_insert(UserStates)
+        .values(
+            user_id=user_id,
+            scenario_key=scenario_key,
+            current_state_key=state_key,
+            state_context=context_data,
+        )
+        .on_conflict_do_update(
+            index_elements=[UserStates.user_id],
+            set_={
+                "scenario_key": scenario_key,
+                "current_state_key": state_key,
+                "state_context": context_data,
+                "updated_at": func.now(),
+            },
+        )
+        .returning(UserStates)
+    )
+    result = await session.execute(
+        stmt, execution_options={"populate_existing": True}
+    )
+    return result.scalar_one()
+
+
+async def _patch_user_state(
+    user_id: int,
+    scenario_key: str,
+    state_key: str,
+    context_data: StateContext,
+    session: AsyncSession,
+) -> Optional[UserStates]:
+    """
+    UPDATE ... RETURNING с дельтой контекста: в JSONB уходят только измененные
+    ключи верхнего уровня (state_context || патч - удаленные ключи).
+    Возвращает None, если строки нет (тогда нужен полный upsert).
+    """
+    values: Dict[str, Any] = {
+        "scenario_key": scenario_key,
+        "current_state_key": state_key,
+        "updated_at": func.now(),
+    }
+    set_patch, deleted_keys = context_data.get_delta()
+    if set_patch or deleted_keys:
+        context_expr = func.coalesce(UserStates.state_context, cast({}, JSONB))
+        if set_patch:
+            context_expr = context_expr.op("||", return_type=JSONB)(cast(set_patch, JSONB))
+        if deleted_keys:
+            context_expr = context_expr.op("-", return_type=JSONB)(cast(deleted_keys, ARRAY(Text)))
+        values["state_context"] = context_expr
+    logger.debug(
+        f"StateMgr: Patching state_context for user_id={user_id}: set={sorted(set_patch)}, deleted={deleted_keys}"
+    )
+
+    stmt = (
+        update(UserStates)
+        .where(UserStates.user_id == user_id)
+        .values(**values)
+        .returning(UserStates)
+    )
+    result = await session.execute(
+        stmt,
+        execution_options={"populate_existing": True, "synchronize_session": False},
+    )
+    return result.scalar_one_or_none()
+
+
+async def _write_user_state(
+    user_id: int,
+    scenario_key: str,
+    state_key: str,
+    context_data: Optional[Dict[str, Any]],
+    session: AsyncSession,
+    row_exists: bool,
+) -> UserStates:
+    """Дельта-UPDATE, если строка точно есть и контекст отслеживает изменения, иначе полный upsert."""
+    if row_exists and isinstance(context_data, StateContext):
+        patched_state = await _patch_user_state(
+            user_id, scenario_key, state_key, context_data, session
+        )
+        if patched_state is not None:
+            return patched_state
+        logger.debug(f"StateMgr: No row to patch for user_id={user_id}. Falling back to full upsert.")
+    return await _upsert_user_state(
+        user_id, scenario_key, state_key, context_data, session
+    )
+
+
+def _is_persisted_row(user_state: Optional[UserStates]) -> bool:
+    # user_state_id есть только у объектов, прочитанных из БД или записанных в нее
+    return user_state is not None and user_state.user_state_id is not None
+
+
+async def _delete_user_state(user_id: int, session: AsyncSession) -> List[int]:
+    """DELETE ... RETURNING: возвращает ID удаленных состояний (пустой список - нечего было удалять)."""
+    result = await session.execute(
+        delete(UserStates)
+        .where(UserStates.user_id == user_id)
+        .returning(UserStates.user_state_id)
+    )
+    return list(result.scalars().all())
+# === END BLOCK 3.5 ===
+
 # === BLOCK 4: Update User State (Implementation) ===
 async def update_user_state(
     user_id: int,
@@ -74,49 +299,25 @@ async def update_user_state(
         logger.debug(f"StateMgr: update_user_state for {user_id} (invalid args) took {time.monotonic() - func_start_time:.4f}s")
         return None
 
+    if _is_deferred(session):
+        staged_state = await _stage_user_state(
+            user_id, scenario_key, state_key, context_data, session
+        )
+        logger.debug(f"StateMgr: update_user_state for {user_id} (deferred) took {time.monotonic() - func_start_time:.4f}s")
+        return staged_state
+
     updated_or_created_state: Optional[UserStates] = None
     try:
-        get_existing_start_time = time.monotonic()
-        existing_state = await get_user_state(user_id, session) # get_user_state уже логирует свое время
-        logger.debug(f"StateMgr: get_user_state inside update_user_state took {time.monotonic() - get_existing_start_time:.4f}s")
-
-        db_op_type = ""
         db_op_start_time = time.monotonic()
+        _, known_state = get_known_user_state(user_id, session)
+        updated_or_created_state = await _write_user_state(
+            user_id, scenario_key, state_key, context_data, session,
+            row_exists=_is_persisted_row(known_state),
+        )
+        logger.debug(f"StateMgr: DB write (patch UPDATE or upsert, RETURNING) in update_user_state for {user_id} took {time.monotonic() - db_op_start_time:.4f}s")
 
-        if existing_state:
-            db_op_type = "update"
-            logger.debug(
-                f"StateMgr: Updating state for user_id={user_id} to scenario='{scenario_key}', state='{state_key}'"
-            )
-            existing_state.scenario_key = scenario_key
-            existing_state.current_state_key = state_key
-            existing_state.state_context = context_data
-            session.add(existing_state) # Важно для отслеживания изменений SQLAlchemy
-            updated_or_created_state = existing_state
-        else:
-            db_op_type = "create"
-            logger.debug(
-                f"StateMgr: Creating new state for user_id={user_id}: scenario='{scenario_key}', state='{state_key}'"
-            )
-            new_state = UserStates(
-                user_id=user_id,
-                scenario_key=scenario_key,
-                current_state_key=state_key,
-                state_context=context_data,
-            )
-            session.add(new_state)
-            updated_or_created_state = new_state
-
-        await session.flush()
-        if updated_or_created_state: # Проверка, что объект существует перед refresh
-             await session.refresh(updated_or_created_state)
-
-        logger.debug(f"StateMgr: DB {db_op_type} (flush+refresh) in update_user_state for {user_id} took {time.monotonic() - db_op_start_time:.4f}s")
-
-        if db_op_type == "update":
-             logger.debug(f"StateMgr: State updated successfully for user_id={user_id}")
-        else:
-             logger.info(f"StateMgr: New state created successfully for user_id={user_id}, state_id={getattr(updated_or_created_state, 'user_state_id', 'N/A')}")
+        _remember_user_state(session, user_id, updated_or_created_state)
+        logger.debug(f"StateMgr: State upserted successfully for user_id={user_id}, state_id={updated_or_created_state.user_state_id}")
 
     except Exception as e:
         logger.error(
@@ -138,25 +339,25 @@ async def reset_user_state(user_id: int, session: AsyncSession) -> bool:
         logger.debug(f"StateMgr: reset_user_state for {user_id} (invalid ID) took {time.monotonic() - func_start_time:.4f}s")
         return True # Считаем успешным, т.к. нет состояния для сброса
 
+    if _is_deferred(session):
+        _remember_user_state(session, user_id, None)
+        _mark_user_state_dirty(session, user_id)
+        _mark_context_replaced(session, user_id)
+        logger.debug(f"StateMgr: reset_user_state for {user_id} deferred until flush_deferred_state_writes.")
+        return True
+
     success = False
     try:
-        get_existing_start_time = time.monotonic()
-        existing_state = await get_user_state(user_id, session)
-        logger.debug(f"StateMgr: get_user_state inside reset_user_state took {time.monotonic() - get_existing_start_time:.4f}s")
-
-        if existing_state:
-            logger.debug(
-                f"StateMgr: Deleting state for user_id={user_id} (State ID: {existing_state.user_state_id})"
-            )
-            db_delete_start_time = time.monotonic()
-            await session.delete(existing_state)
-            await session.flush() # Применяем удаление
-            logger.debug(f"StateMgr: DB delete+flush in reset_user_state for {user_id} took {time.monotonic() - db_delete_start_time:.4f}s")
-            logger.info(f"StateMgr: State successfully marked for deletion for user_id={user_id}")
+        db_delete_start_time = time.monotonic()
+        deleted_ids = await _delete_user_state(user_id, session)
+        logger.debug(f"StateMgr: DB DELETE ... RETURNING in reset_user_state for {user_id} took {time.monotonic() - db_delete_start_time:.4f}s")
+        if deleted_ids:
+            logger.info(f"StateMgr: State successfully deleted for user_id={user_id} (State ID: {deleted_ids})")
         else:
             logger.debug(
                 f"StateMgr: No state found to delete for user_id={user_id}. Reset considered successful."
             )
+        _remember_user_state(session, user_id, None)
         success = True
     except Exception as e:
         logger.error(
@@ -166,4 +367,76 @@ async def reset_user_state(user_id: int, session: AsyncSession) -> bool:
 
     logger.debug(f"StateMgr: reset_user_state for {user_id} total took {time.monotonic() - func_start_time:.4f}s. Success: {success}")
     return success
-# === END BLOCK 5 ===
\ No newline at end of file
+# === END BLOCK 5 ===
+
+
+# === BLOCK 6: Deferred State Writes ===
+async def _stage_user_state(
+    user_id: int,
+    scenario_key: str,
+    state_key: str,
+    context_data: Optional[Dict[str, Any]],
+    session: AsyncSession,
+) -> UserStates:
+    """Меняет состояние пользователя только в памяти (режим отложенной записи)."""
+    staged_state = await get_user_state(user_id, session)
+    if staged_state is None:
+        # Новый объект в сессию не добавляется - его вставит flush_deferred_state_writes
+        staged_state = UserStates(user_id=user_id)
+    elif staged_state in session:
+        # Объект мог стать persistent после предыдущего flush - снова отсоединяем
+        session.expunge(staged_state)
+    if not isinstance(context_data, StateContext) or staged_state.scenario_key != scenario_key:
+        _mark_context_replaced(session, user_id)
+    staged_state.scenario_key = scenario_key
+    staged_state.current_state_key = state_key
+    staged_state.state_context = context_data
+
+    _remember_user_state(session, user_id, staged_state)
+    _mark_user_state_dirty(session, user_id)
+    logger.debug(
+        f"StateMgr: State for user_id={user_id} staged in memory: scenario='{scenario_key}', state='{state_key}'"
+    )
+    return staged_state
+
+
+async def flush_deferred_state_writes(session: AsyncSession) -> int:
+    """
+    Записывает итоговые состояния, накопленные в режиме отложенной записи:
+    одна запись на пользователя, сколько бы переходов ни было в цепочке.
+    Вызывается перед session.commit(). Возвращает число записанных пользователей.
+    Ошибки БД пробрасываются, чтобы вызывающий код не коммитил частичный результат.
+    """
+    if not _is_deferred(session):
+        return 0
+    deferred_user_ids: Set[int] = session.info[_SESSION_DEFERRED_KEY]
+    if not deferred_user_ids:
+        return 0
+
+    context_replaced_user_ids: Set[int] = session.info.get(_SESSION_CONTEXT_REPLACED_KEY, set())
+
+    func_start_time = time.monotonic()
+    written = 0
+    for user_id in sorted(deferred_user_ids):
+        _, final_state = get_known_user_state(user_id, session)
+        if final_state is None:
+            deleted_ids = await _delete_user_state(user_id, session)
+            logger.debug(f"StateMgr: Deferred reset written for user_id={user_id} (deleted: {deleted_ids})")
+        else:
+            persisted_state = await _write_user_state(
+                user_id,
+                final_state.scenario_key,
+                final_state.current_state_key,
+                final_state.state_context,
+                session,
+                row_exists=_is_persisted_row(final_state) and user_id not in context_replaced_user_ids,
+            )
+            _remember_user_state(session, user_id, persisted_state)
+            logger.debug(f"StateMgr: Deferred state written for user_id={user_id}: scenario='{persisted_state.scenario_key}', state='{persisted_state.current_state_key}'")
+        written += 1
+
+    deferred_user_ids.clear()
+    context_replaced_user_ids.clear()
+    logger.debug(f"StateMgr: flush_deferred_state_writes wrote {written} state(s) in {time.monotonic() - func_start_time:.4f}s")
+    return written
+# === END BLOCK 6 ===
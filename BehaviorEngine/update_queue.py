@@ -0,0 +1,287 @@
+# BehaviorEngine/update_queue.py
+# Очередь апдейтов на пользователя перед engine.handle_update
+
+# === BLOCK 1: Imports ===
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+try:
+    from utils.ttl_cache import TTLCache
+
+    from .callback_ack import acknowledge_callback_early, finish_callback_ack
+    from .engine import handle_update
+except ImportError as e:
+    logging.critical(
+        f"CRITICAL: Failed to import engine components in update_queue: {e}",
+        exc_info=True,
+    )
+    raise
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Per-User Actor ===
+UpdateHandlerType = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[bool]]
+
+
+# Статистика ожидания переживает воркер: хранится для недавно активных пользователей
+WAIT_STATS_TTL = 3600.0  # секунд с последнего апдейта пользователя
+WAIT_STATS_MAX_USERS = 10000
+
+
+class _WaitStats:
+    """Время ожидания апдейтов в очереди (одного пользователя или сводное)."""
+
+    __slots__ = ("processed", "last_wait", "max_wait", "total_wait")
+
+    def __init__(self) -> None:
+        self.processed = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    def record(self, wait_time: float) -> None:
+        self.processed += 1
+        self.last_wait = wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+        self.total_wait += wait_time
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "processed": self.processed,
+            "last_wait": self.last_wait,
+            "max_wait": self.max_wait,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+        }
+
+
+class _UserActor:
+    """
+    Очередь и воркер одного пользователя.
+    Апдейты пользователя выполняются строго по одному, в порядке поступления.
+    Воркер завершается, когда очередь пуста, и создается заново при новом апдейте.
+    """
+
+    __slots__ = ("user_id", "queue", "worker", "in_flight")
+
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+        self.in_flight = False
+
+    @property
+    def depth(self) -> int:
+        """Количество апдейтов в очереди, включая выполняющийся."""
+        return self.queue.qsize() + (1 if self.in_flight else 0)
+
+
+class UserUpdateQueue:
+    """
+    Упорядочивает вызовы handle_update по пользователю.
+
+    Апдейты одного пользователя обрабатываются последовательно (каждый читает
+    UserStates уже после коммита предыдущего), апдейты разных пользователей -
+    параллельно. Для каждого пользователя доступны глубина очереди и время ожидания.
+    """
+
+    def __init__(self, handler: UpdateHandlerType = handle_update) -> None:
+        self._handler = handler
+        self._actors: Dict[int, _UserActor] = {}
+        self._user_wait_stats: TTLCache[int, _WaitStats] = TTLCache(
+            WAIT_STATS_MAX_USERS, WAIT_STATS_TTL
+        )
+        self._total_wait_stats = _WaitStats()
+
+    # --- Публичный API ---
+    async def submit(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        handler: Optional[UpdateHandlerType] = None,
+    ) -> bool:
+        """
+        Ставит апдейт в очередь пользователя и ждет результата его обработки.
+        handler - другой обработчик вместо handle_update (в той же очереди).
+        """
+        handler = handler or self._handler
+        user = update.effective_user
+        if not user:
+            # Без пользователя нечего упорядочивать - передаем напрямую
+            return await handler(update, context)
+
+        future = self.enqueue(user.id, update, context, handler)
+        return await future
+
+    def enqueue(
+        self,
+        user_id: int,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        handler: Optional[UpdateHandlerType] = None,
+    ) -> "asyncio.Future[bool]":
+        """
+        Синхронно ставит апдейт в очередь (порядок фиксируется в момент вызова)
+        и возвращает future с результатом обработчика.
+        """
+        loop = asyncio.get_running_loop()
+        actor = self._actors.get(user_id)
+        if actor is None:
+            actor = _UserActor(user_id)
+            self._actors[user_id] = actor
+
+        future: asyncio.Future = loop.create_future()
+        actor.queue.put_nowait(
+            (update, context, handler or self._handler, future, time.monotonic())
+        )
+        logger.debug(
+            f"UpdateQueue: Enqueued update {update.update_id} for user {user_id}. Depth: {actor.depth}"
+        )
+        if actor.worker is None or actor.worker.done():
+            actor.worker = loop.create_task(
+                self._run_actor(actor), name=f"update-queue-{user_id}"
+            )
+        return future
+
+    def get_user_stats(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Глубина очереди и время ожидания для пользователя. Время ожидания
+        доступно и после опустения очереди (WAIT_STATS_TTL с последнего апдейта).
+        None - пользователь давно не присылал апдейтов.
+        """
+        actor = self._actors.get(user_id)
+        wait_stats = self._user_wait_stats.get(user_id)
+        if actor is None and wait_stats is None:
+            return None
+        return {
+            "user_id": user_id,
+            "depth": actor.depth if actor else 0,
+            **(wait_stats or _WaitStats()).as_dict(),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Сводная статистика: активные очереди и ожидание по всем апдейтам с запуска."""
+        per_user = [
+            stats
+            for stats in (self.get_user_stats(uid) for uid in list(self._actors))
+            if stats
+        ]
+        return {
+            "active_users": len(per_user),
+            "total_depth": sum(s["depth"] for s in per_user),
+            "max_depth": max((s["depth"] for s in per_user), default=0),
+            "tracked_users": len(self._user_wait_stats),
+            **self._total_wait_stats.as_dict(),
+            "users": per_user,
+        }
+
+    def _record_wait(self, user_id: int, wait_time: float) -> None:
+        wait_stats = self._user_wait_stats.get(user_id)
+        if wait_stats is None:
+            wait_stats = _WaitStats()
+        wait_stats.record(wait_time)
+        # set() продлевает TTL записи пользователя
+        self._user_wait_stats.set(user_id, wait_stats)
+        self._total_wait_stats.record(wait_time)
+
+    # --- Внутренняя логика ---
+    async def _run_actor(self, actor: _UserActor) -> None:
+        while True:
+            try:
+                item: Tuple[Any, ...] = actor.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                # Очередь опустела - освобождаем слот пользователя
+                if self._actors.get(actor.user_id) is actor:
+                    del self._actors[actor.user_id]
+                return
+
+            update, context, handler, future, enqueued_at = item
+            wait_time = time.monotonic() - enqueued_at
+            self._record_wait(actor.user_id, wait_time)
+            actor.in_flight = True
+            if wait_time > 0.5:
+                logger.info(
+                    f"UpdateQueue: Update {update.update_id} for user {actor.user_id} waited {wait_time:.4f}s in queue. Remaining depth: {actor.queue.qsize()}"
+                )
+            else:
+                logger.debug(
+                    f"UpdateQueue: Update {update.update_id} for user {actor.user_id} waited {wait_time:.4f}s in queue."
+                )
+            try:
+                result = await handler(update, context)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                logger.error(
+                    f"UpdateQueue: Handler failed for update {update.update_id}, user {actor.user_id}: {e}",
+                    exc_info=True,
+                )
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                actor.in_flight = False
+
+
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Module-Level Queue and PTB Entry Point ===
+# Один экземпляр на процесс (аналогично _scenario_cache в parser.py)
+user_update_queue = UserUpdateQueue()
+
+
+async def handle_update_ordered(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> bool:
+    """
+    Точка входа для MessageHandler/CallbackQueryHandler (block=False).
+    Сохраняет порядок апдейтов каждого пользователя и параллельность между пользователями.
+    На callback_query отвечает до постановки в очередь (см. callback_ack).
+    """
+    acknowledge_callback_early(update)
+    try:
+        return await user_update_queue.submit(update, context)
+    finally:
+        finish_callback_ack(update)
+
+
+def run_in_user_queue(handler: UpdateHandlerType) -> UpdateHandlerType:
+    """
+    Обертка для обработчиков вне движка (например, переключателей rts:):
+    handler выполняется в той же очереди пользователя, что и handle_update,
+    поэтому не обгоняет и не гонится с апдейтами движка этого пользователя.
+    """
+
+    async def handle_in_user_queue(
+        update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> bool:
+        acknowledge_callback_early(update)
+        try:
+            return await user_update_queue.submit(update, context, handler)
+        finally:
+            finish_callback_ack(update)
+
+    return handle_in_user_queue
+
+
+def get_update_queue_stats(user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Статистика очереди: по пользователю (если указан user_id) или сводная."""
+    if user_id is not None:
+        return user_update_queue.get_user_stats(user_id)
+    return user_update_queue.get_stats()
+
+
+# === END BLOCK 4 ===
@@ -0,0 +1,252 @@
+# ai/gateway.py
+# Шлюз вызовов AI-провайдеров: лимит параллельности, дедлайн, повторы с джиттером,
+# circuit breaker и структурированный результат вместо строк-заглушек
+
+# === BLOCK 1: Imports ===
+import asyncio
+import logging
+import random
+import time
+import typing
+from dataclasses import dataclass
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+import config
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Result ===
+class AIError:
+    """Коды ошибок в AIResult.error."""
+
+    NOT_CONFIGURED = "not_configured"  # провайдер/клиент не настроен
+    TIMEOUT = "timeout"  # дедлайн вызова истек
+    RATE_LIMITED = "rate_limited"  # 429 после всех повторов
+    PROVIDER_ERROR = "provider_error"  # 5xx/сеть после всех повторов, прочие ошибки API
+    CIRCUIT_OPEN = "circuit_open"  # провайдер деградировал, запрос не отправлялся
+    EMPTY_RESPONSE = "empty_response"  # ответ без текста
+    INTERNAL = "internal"  # неожиданное исключение
+
+
+@dataclass(frozen=True)
+class AIResult:
+    """Результат вызова AI: text при успехе, иначе error (код из AIError)."""
+
+    text: typing.Optional[str] = None
+    error: typing.Optional[str] = None
+    attempts: int = 0
+    latency: float = 0.0
+    from_cache: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.text is not None
+
+
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Circuit Breaker ===
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд запросы open_seconds секунд
+    сразу отклоняются. Затем пропускается один пробный запрос
+    (half-open): успех закрывает цепь, ошибка открывает ее снова.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float) -> None:
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._open_seconds = open_seconds
+        self._consecutive_failures = 0
+        self._opened_at: typing.Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self._open_seconds:
+            return "open"
+        return "half_open"
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info(f"AI-шлюз: цепь {self._name} закрыта, провайдер отвечает.")
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        was_probe = self._probe_in_flight
+        self._probe_in_flight = False
+        if was_probe or self._consecutive_failures >= self._failure_threshold:
+            if self._opened_at is None or was_probe:
+                logger.warning(
+                    f"AI-шлюз: цепь {self._name} открыта на {self._open_seconds}s "
+                    f"({self._consecutive_failures} ошибок подряд)."
+                )
+            self._opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """Пробный запрос завершился без вердикта (например, ошибка 4xx запроса)."""
+        self._probe_in_flight = False
+
+
+# === END BLOCK 4 ===
+
+
+# === BLOCK 5: Gateway ===
+AI_MAX_CONCURRENCY = getattr(config, "AI_MAX_CONCURRENCY", 8)  # на провайдера/модель
+AI_DEFAULT_TIMEOUT = getattr(config, "AI_DEFAULT_TIMEOUT", 30.0)  # секунд на весь вызов с повторами
+AI_MAX_ATTEMPTS = 3
+AI_RETRY_BASE_DELAY = 0.5  # секунд, удваивается с каждой попыткой (full jitter)
+AI_RETRY_MAX_DELAY = 8.0
+AI_BREAKER_FAILURE_THRESHOLD = 5
+AI_BREAKER_OPEN_SECONDS = 30.0
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def _error_code(error: BaseException) -> str:
+    if isinstance(error, RateLimitError):
+        return AIError.RATE_LIMITED
+    if isinstance(error, (APITimeoutError, TimeoutError)):
+        return AIError.TIMEOUT
+    if isinstance(error, (APIStatusError, APIConnectionError)):
+        return AIError.PROVIDER_ERROR
+    return AIError.INTERNAL
+
+
+class AIGateway:
+    """
+    complete(provider, model, request_factory, timeout): request_factory() -
+    один запрос к провайдеру (текст или None). Шлюз:
+      - ограничивает число одновременных запросов на (provider, model);
+      - укладывает все попытки в один дедлайн (timeout из YAML call_ai или AI_DEFAULT_TIMEOUT);
+      - повторяет 429/5xx/сетевые ошибки с экспоненциальной задержкой и джиттером;
+      - через CircuitBreaker сразу отказывает, пока провайдер деградировал.
+    Исключения наружу не выходят: всё превращается в AIResult.
+    """
+
+    def __init__(self) -> None:
+        self._semaphores: typing.Dict[typing.Tuple[str, str], asyncio.Semaphore] = {}
+        self._breakers: typing.Dict[typing.Tuple[str, str], CircuitBreaker] = {}
+        self._stats: typing.Dict[str, int] = {
+            "calls": 0, "succeeded": 0, "failed": 0, "retries": 0, "rejected_open_circuit": 0, "timeouts": 0,
+        }
+
+    async def complete(
+        self,
+        provider: str,
+        model: str,
+        request_factory: typing.Callable[[], typing.Awaitable[typing.Optional[str]]],
+        timeout: typing.Optional[float] = None,
+    ) -> AIResult:
+        self._stats["calls"] += 1
+        key = (provider, model)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker(
+                f"{provider}/{model}", AI_BREAKER_FAILURE_THRESHOLD, AI_BREAKER_OPEN_SECONDS
+            )
+        if not breaker.allow_request():
+            self._stats["rejected_open_circuit"] += 1
+            logger.warning(f"AI-шлюз: {provider}/{model} недоступен (цепь открыта), запрос не отправлен.")
+            return AIResult(error=AIError.CIRCUIT_OPEN)
+
+        started_at = time.monotonic()
+        deadline = started_at + (timeout if timeout and timeout > 0 else AI_DEFAULT_TIMEOUT)
+        attempts = 0
+        last_error: typing.Optional[BaseException] = None
+        semaphore = self._semaphores.setdefault(key, asyncio.Semaphore(AI_MAX_CONCURRENCY))
+        while attempts < AI_MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                # Дедлайн охватывает и ожидание слота, и сам запрос: при
+                # перегрузке вызов не ждет в очереди семафора дольше timeout
+                async with asyncio.timeout_at(self._loop_deadline(deadline)):
+                    async with semaphore:
+                        text = await request_factory()
+            except asyncio.CancelledError:
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                last_error = e
+                if isinstance(e, TimeoutError) or not _is_retryable(e):
+                    break
+                backoff = random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** (attempts - 1)))
+                if attempts >= AI_MAX_ATTEMPTS or time.monotonic() + backoff >= deadline:
+                    break
+                self._stats["retries"] += 1
+                logger.warning(
+                    f"AI-шлюз: {provider}/{model} попытка {attempts} не удалась ({type(e).__name__}), "
+                    f"повтор через {backoff:.2f}s."
+                )
+                await asyncio.sleep(backoff)
+                continue
+
+            latency = time.monotonic() - started_at
+            breaker.record_success()
+            if text is None:
+                self._stats["failed"] += 1
+                return AIResult(error=AIError.EMPTY_RESPONSE, attempts=attempts, latency=latency)
+            self._stats["succeeded"] += 1
+            return AIResult(text=text, attempts=attempts, latency=latency)
+
+        latency = time.monotonic() - started_at
+        error_code = _error_code(last_error) if last_error else AIError.INTERNAL
+        self._stats["failed"] += 1
+        if error_code == AIError.TIMEOUT:
+            self._stats["timeouts"] += 1
+        if error_code == AIError.INTERNAL or (
+            isinstance(last_error, APIStatusError) and not _is_retryable(last_error)
+        ):
+            # Ошибка запроса (4xx, баг), а не деградация провайдера
+            breaker.release_probe()
+        else:
+            breaker.record_failure()
+        logger.error(
+            f"AI-шлюз: {provider}/{model} ошибка '{error_code}' после {attempts} попыток "
+            f"за {latency:.4f}s: {last_error!r}",
+            exc_info=error_code == AIError.INTERNAL,
+        )
+        return AIResult(error=error_code, attempts=attempts, latency=latency)
+
+    @staticmethod
+    def _loop_deadline(deadline: float) -> float:
+        """Дедлайн по time.monotonic() -> время цикла событий для asyncio.timeout_at."""
+        loop = asyncio.get_running_loop()
+        return loop.time() + (deadline - time.monotonic())
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        return dict(
+            self._stats,
+            circuits={f"{p}/{m}": breaker.state for (p, m), breaker in self._breakers.items()},
+        )
+
+
+# Один экземпляр на процесс
+ai_gateway = AIGateway()
+# === END BLOCK 5 ===
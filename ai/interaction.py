@@ -5,16 +5,19 @@ import asyncio
 import logging
 import typing
 
-from openai import APIError, AsyncOpenAI, RateLimitError  # Импорт OpenAI
-from sqlalchemy import select
+from openai import AsyncOpenAI  # Импорт OpenAI
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # Импорт конфигурации и моделей БД
 import config
+from ai.gateway import AIError, AIResult, ai_gateway
+from ai.request_coalescer import ai_request_coalescer, make_flight_key
+from ai.response_cache import ai_response_cache, make_cache_key
+from data.instructions import fallback_chain, get_instruction_text
 from database.models import (
     AsyncSessionLocal,
-    Instructions,
+    release_session_connection,
 )
 
 # === END BLOCK 1 ===
@@ -35,7 +38,8 @@ if config.OPENAI_API_KEY and config.OPENAI_API_KEY not in [
 ]:  # Добавил ваш плейсхолдер
     try:
         # Используем AsyncOpenAI для асинхронной работы
-        openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+        # Повторы и таймауты - в ai.gateway, встроенные повторы SDK отключены
+        openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, max_retries=0)
         logger.info("Асинхронный клиент OpenAI инициализирован.")
     except Exception as e:
         logger.error(f"Ошибка инициализации клиента OpenAI: {e}")
@@ -54,77 +58,29 @@ vertex_client = None  # Пример заглушки
 
 
 # === BLOCK 4: _get_instruction_text Helper Function ===
-# --- Вспомогательная функция для получения инструкции из БД ---
+# --- Вспомогательная функция для получения инструкции (из каталога data.instructions) ---
 async def _get_instruction_text(
     session: AsyncSession,
     instruction_key: str,
     user_lang_code: typing.Optional[str] = None,
 ) -> typing.Optional[str]:
     """
-    Извлекает текст инструкции из БД по ключу с учетом fallback логики.
-    Fallback порядок: user_lang_code -> 'en' -> 'uk' -> 'ru'.
+    Извлекает текст инструкции по ключу с учетом fallback логики.
+    Fallback порядок: user_lang_code -> 'en' -> 'uk' -> 'ru'
+    (config.DEFAULT_FALLBACK_LANGS). Цепочка уже разрешена в каталоге,
+    к БД обращается только для ключа, которого в каталоге еще нет.
     """
-    # Определяем порядок языков для поиска
-    # Можно вынести ['en', 'uk', 'ru'] в config.py как DEFAULT_FALLBACK_LANGS
-    fallback_order = (
-        config.DEFAULT_FALLBACK_LANGS
-        if hasattr(config, "DEFAULT_FALLBACK_LANGS")
-        else ["en", "uk", "ru"]
-    )
-    codes_to_try = []
-    if (
-        user_lang_code and user_lang_code.lower() in fallback_order
-    ):  # Проверяем, поддерживается ли язык
-        codes_to_try.append(user_lang_code.lower())
-    # Добавляем остальные языки из fallback_order, если их еще нет
-    for code in fallback_order:
-        if code not in codes_to_try:
-            codes_to_try.append(code)
-
-    logger.debug(
-        f"Поиск инструкции '{instruction_key}' в порядке языков: {codes_to_try}"
-    )
-
     try:
-        for lang_code in codes_to_try:
-            column_name = f"text_{lang_code}"
-            # Проверяем, есть ли такая колонка в модели Instructions
-            if hasattr(Instructions, column_name):
-                column_to_select = getattr(Instructions, column_name)
-                # Выбираем только нужную колонку по ключу
-                stmt = (
-                    select(column_to_select)
-                    .where(Instructions.key == instruction_key)
-                    .limit(1)
-                )
-                result = await session.execute(stmt)
-                instruction_text = result.scalar_one_or_none()
-
-                # Если текст найден и он не пустой после удаления пробелов
-                if instruction_text and instruction_text.strip():
-                    # Строка f-string разбита для E501
-                    logger.debug(
-                        f"Найдена инструкция '{instruction_key}' "
-                        f"на языке '{lang_code}'."
-                    )
-                    return instruction_text.strip()
-            else:
-                # Логируем только если это язык пользователя,
-                # иначе это ожидаемо для fallback (Комментарий разбит для E501)
-                if user_lang_code and lang_code == user_lang_code.lower():
-                    # Строка f-string разбита для E501
-                    logger.warning(
-                        f"Колонка {column_name} не найдена в модели "
-                        f"Instructions, пропуск '{lang_code}'."
-                    )
-
-        # Если прошли по всем языкам и ничего не нашли
-        # Строка f-string разбита для E501
-        logger.warning(
-            f"Инструкция '{instruction_key}' не найдена ни на одном "
-            f"из языков: {codes_to_try}"
+        instruction_text = await get_instruction_text(
+            session, instruction_key, user_lang_code
         )
-        return None
+        if instruction_text is None:
+            # Строка f-string разбита для E501
+            logger.warning(
+                f"Инструкция '{instruction_key}' не найдена ни на одном "
+                f"из языков: {list(fallback_chain(user_lang_code))}"
+            )
+        return instruction_text
     except SQLAlchemyError as e:
         logger.error(
             f"Ошибка SQLAlchemy при получении инструкции '{instruction_key}': {e}",
@@ -142,9 +98,36 @@ async def _get_instruction_text(
 # === END BLOCK 4 ===
 
 
-# === BLOCK 5: generate_text_response Function (Обновленная) ===
+# === BLOCK 4.1: OpenAI Request ===
+async def _request_openai(
+    model_to_use: str, final_messages: list[dict[str, str]]
+) -> typing.Optional[str]:
+    """
+    Один запрос к OpenAI: текст ответа или None (ответ без текста).
+    Ошибки API не перехватываются - их классифицирует и повторяет ai.gateway.
+    """
+    logger.debug(f"Вызов OpenAI model='{model_to_use}'...")
+    response = await openai_client.chat.completions.create(
+        model=model_to_use, messages=final_messages
+    )
+    if (
+        response.choices
+        and response.choices[0].message
+        and response.choices[0].message.content
+    ):
+        ai_response = response.choices[0].message.content.strip()
+        logger.debug(f"Ответ OpenAI: '{ai_response[:100]}...'")
+        return ai_response
+    logger.error("Ответ OpenAI не содержит ожидаемых данных.")
+    return None
+
+
+# === END BLOCK 4.1 ===
+
+
+# === BLOCK 5: generate_ai_result / generate_text_response Functions ===
 # --- Основная функция взаимодействия с AI (обновленная) ---
-async def generate_text_response(
+async def generate_ai_result(
     # Аннотации типов исправлены для UP006
     messages: list[dict[str, str]],
     instruction_key: typing.Optional[str] = None,
@@ -156,18 +139,34 @@ async def generate_text_response(
     user_reply_for_format: typing.Optional[
         str
     ] = None,  # Для подстановки в промпт из БД
-) -> typing.Optional[str]:
+    release_session_before_call: bool = False,  # Вернуть соединение в пул на время запроса
+    cache_ttl: typing.Optional[float] = None,  # Кэшировать ответ (сек), см. ai.response_cache
+    timeout: typing.Optional[float] = None,  # Дедлайн вызова (сек), см. ai.gateway
+) -> AIResult:
     """
-    Генерирует текстовый ответ от AI.
+    Генерирует ответ от AI. Ошибки возвращаются как AIResult.error (коды
+    ai.gateway.AIError), а не как текст ответа.
     Приоритет системного промпта:
     1. system_prompt_override (если передан)
     2. Форматированная инструкция из БД (если переданы instruction_key
        и user_reply_for_format)
     3. Обычная инструкция из БД (если передан instruction_key)
     4. fallback_system_message
+
+    release_session_before_call=True: после загрузки инструкции транзакция
+    переданной сессии коммитится (database.models.release_session_connection),
+    чтобы соединение не простаивало в пуле занятым на время ответа AI.
+    Передавать только владельцу сессии, который не держит session.begin().
+
+    cache_ttl: ответ OpenAI на тот же промпт (с точностью до регистра и
+    пробелов во вводе) берется из ai.response_cache и кэшируется на cache_ttl
+    секунд. Только для детерминированных промптов (опция call_ai в YAML).
+
+    timeout: общий дедлайн на все попытки (ai.gateway, по умолчанию AI_DEFAULT_TIMEOUT).
     """
     provider = config.ACTIVE_AI_PROVIDER
     final_system_prompt: typing.Optional[str] = None
+    fetched_instruction_text: typing.Optional[str] = None
     session_provided_or_global_exists = (
         session is not None or AsyncSessionLocal is not None
     )
@@ -182,7 +181,6 @@ async def generate_text_response(
         logger.debug(
             f"Попытка получить/форматировать инструкцию '{instruction_key}'..."
         )
-        fetched_instruction_text: typing.Optional[str] = None
         try:
             current_session: typing.Optional[AsyncSession] = session
             if not current_session and AsyncSessionLocal:
@@ -299,6 +297,11 @@ async def generate_text_response(
             logger.debug("Системный промпт не используется.")
     # --- Конец определения системного промпта ---
 
+    # Дальше БД не нужна: освобождаем соединение до сетевого вызова
+    # (ошибка commit здесь не глушится: записи хендлеров не должны теряться молча)
+    if release_session_before_call and session is not None:
+        await release_session_connection(session)
+
     # --- Формирование финального списка сообщений для AI ---
     final_messages = []
     if final_system_prompt:
@@ -331,35 +334,44 @@ async def generate_text_response(
     if provider == "openai":
         if not openai_client:
             logger.error("OpenAI клиент не инициализирован.")
-            return None
-        try:
-            model_to_use = model if model else config.DEFAULT_OPENAI_MODEL
-            logger.debug(f"Вызов OpenAI model='{model_to_use}'...")
-            response = await openai_client.chat.completions.create(
-                model=model_to_use, messages=final_messages
+            return AIResult(error=AIError.NOT_CONFIGURED)
+        model_to_use = model if model else config.DEFAULT_OPENAI_MODEL
+        cache_key: typing.Optional[str] = None
+        if cache_ttl:
+            # Версия промпта - неформатированный текст инструкции: user_reply
+            # входит в ключ отдельно, нормализованным
+            cache_key = make_cache_key(
+                provider,
+                model_to_use,
+                instruction_key,
+                fetched_instruction_text or final_system_prompt,
+                user_reply_for_format,
+                messages,
             )
-            if (
-                response.choices
-                and response.choices[0].message
-                and response.choices[0].message.content
-            ):
-                ai_response = response.choices[0].message.content.strip()
-                logger.debug(f"Ответ OpenAI: '{ai_response[:100]}...'")
-                return ai_response
-            else:
-                logger.error("Ответ OpenAI не содержит ожидаемых данных.")
-                return None
-        except RateLimitError:
-            logger.error("Ошибка OpenAI: Превышен лимит запросов.")
-            return "Извините, сервис перегружен. Попробуйте позже."
-        except APIError as e:
-            logger.error(
-                f"Ошибка API OpenAI: status_code={e.status_code}, message={e.message}"
+            cached_response = await ai_response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug(
+                    f"Ответ AI для '{instruction_key}' взят из кэша: '{cached_response[:100]}...'"
+                )
+                return AIResult(text=cached_response, from_cache=True)
+
+        async def _request_and_cache() -> AIResult:
+            # Лимит параллельности, дедлайн, повторы и circuit breaker - в шлюзе
+            result = await ai_gateway.complete(
+                provider,
+                model_to_use,
+                lambda: _request_openai(model_to_use, final_messages),
+                timeout=timeout,
             )
-            return "Произошла ошибка при обращении к AI."
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при вызове OpenAI: {e}", exc_info=True)
-            return "Произошла внутренняя ошибка AI."
+            if result.ok and cache_key:
+                await ai_response_cache.set(cache_key, result.text, cache_ttl)
+            return result
+
+        # Одинаковые одновременные запросы (рассылка, всплеск одинаковых ответов)
+        # ждут один вызов OpenAI
+        return await ai_request_coalescer.run(
+            make_flight_key(provider, model_to_use, final_messages), _request_and_cache
+        )
 
     # --- Заглушки для других провайдеров ---
     elif provider == "gemini":
@@ -369,9 +381,11 @@ async def generate_text_response(
             (m["content"] for m in reversed(messages) if m["role"] == "user"),
             "Нет сообщения",
         )
-        return (
-            f"[ЗАГЛУШКА GEMINI] Промпт: {str(final_system_prompt)[:50]}..., "
-            f"Посл. польз.: {last_user_msg}"
+        return AIResult(
+            text=(
+                f"[ЗАГЛУШКА GEMINI] Промпт: {str(final_system_prompt)[:50]}..., "
+                f"Посл. польз.: {last_user_msg}"
+            )
         )
     elif provider == "vertexai":
         logger.warning("Вызов Vertex AI еще не реализован.")
@@ -380,13 +394,26 @@ async def generate_text_response(
             (m["content"] for m in reversed(messages) if m["role"] == "user"),
             "Нет сообщения",
         )
-        return (
-            f"[ЗАГЛУШКА VERTEXAI] Промпт: {str(final_system_prompt)[:50]}..., "
-            f"Посл. польз.: {last_user_msg}"
+        return AIResult(
+            text=(
+                f"[ЗАГЛУШКА VERTEXAI] Промпт: {str(final_system_prompt)[:50]}..., "
+                f"Посл. польз.: {last_user_msg}"
+            )
         )
     else:
         logger.error(f"Неизвестный AI провайдер: {provider}")
-        return None
+        return AIResult(error=AIError.NOT_CONFIGURED)
+
+
+async def generate_text_response(
+    *args: typing.Any, **kwargs: typing.Any
+) -> typing.Optional[str]:
+    """
+    Текст ответа AI или None при любой ошибке (параметры - как у
+    generate_ai_result). Для вызовов, которым не нужен код ошибки.
+    """
+    result = await generate_ai_result(*args, **kwargs)
+    return result.text if result.ok else None
 
 
 # === END BLOCK 5 ===
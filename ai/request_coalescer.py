@@ -0,0 +1,75 @@
+# ai/request_coalescer.py
+# Single-flight для запросов к AI: одинаковые одновременные запросы ждут один вызов провайдера
+
+# === BLOCK 1: Imports ===
+import asyncio
+import hashlib
+import json
+import logging
+import typing
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Request Coalescer ===
+T = typing.TypeVar("T")
+
+
+def make_flight_key(
+    provider: str, model: str, final_messages: typing.Sequence[typing.Mapping[str, str]]
+) -> str:
+    """Ключ - полностью сформированный запрос (системный промпт уже отформатирован)."""
+    payload = json.dumps([provider, model, list(final_messages)], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AIRequestCoalescer:
+    """
+    run(key, request_factory): первый вызов с ключом ("ведущий") запускает
+    request_factory() отдельной задачей, остальные одновременные вызовы с тем же
+    ключом ждут ее результат (или исключение). Отмена одного ожидающего не
+    отменяет запрос для остальных. После завершения ключ освобождается -
+    это не кэш (см. ai.response_cache).
+    """
+
+    def __init__(self) -> None:
+        self._in_flight: typing.Dict[str, asyncio.Task] = {}
+        self._stats: typing.Dict[str, int] = {"calls": 0, "requests": 0, "collapsed": 0}
+
+    async def run(
+        self, key: str, request_factory: typing.Callable[[], typing.Awaitable[T]]
+    ) -> T:
+        self._stats["calls"] += 1
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._stats["collapsed"] += 1
+            logger.debug(f"Запрос к AI присоединен к уже выполняющемуся (ключ {key[:12]}...).")
+        else:
+            self._stats["requests"] += 1
+            task = asyncio.get_running_loop().create_task(
+                request_factory(), name=f"ai-request-{key[:12]}"
+            )
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._forget(k, _t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Исключение уже получили ожидающие; здесь - чтобы asyncio не ругался, если их не осталось
+            logger.debug(f"Запрос к AI завершился ошибкой: {task.exception()}")
+
+    def get_stats(self) -> typing.Dict[str, int]:
+        """calls - вызовов run, requests - реальных запросов, collapsed - присоединенных."""
+        return dict(self._stats, in_flight=len(self._in_flight))
+
+
+# Один экземпляр на процесс
+ai_request_coalescer = AIRequestCoalescer()
+# === END BLOCK 3 ===
@@ -0,0 +1,193 @@
+# ai/response_cache.py
+# Кэш ответов AI для детерминированных промптов (классификация роли, города и т.п.):
+# память (LRU + TTL) и необязательный уровень на диске (sqlite)
+# Уровень sqlite включается в config.py, файл - в каталоге данных (в git не попадает):
+#   AI_RESPONSE_CACHE_SQLITE_PATH = "data/cache/ai_response_cache.sqlite"
+
+# === BLOCK 1: Imports ===
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import typing
+
+import config
+from utils.ttl_cache import TTLCache
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Cache Key ===
+DEFAULT_AI_CACHE_TTL = 24 * 3600.0  # секунд, для `cache: true` без cache_ttl
+AI_CACHE_MAX_ENTRIES = 5000
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: typing.Optional[str]) -> str:
+    """Регистр и пробелы не влияют на ответ классификатора: ' Київ ' == 'київ'."""
+    return _WHITESPACE_RE.sub(" ", str(text or "")).strip().casefold()
+
+
+def make_cache_key(
+    provider: str,
+    model: str,
+    instruction_key: typing.Optional[str],
+    instruction_text: typing.Optional[str],
+    user_reply_for_format: typing.Optional[str],
+    messages: typing.Sequence[typing.Mapping[str, str]],
+) -> str:
+    """
+    sha256 от (провайдер, модель, ключ инструкции, хэш текста инструкции -
+    ее "версия", нормализованные user_reply и сообщения). Изменение текста
+    инструкции в Instructions дает новый ключ, старые ответы просто истекают.
+    """
+    instruction_version = hashlib.sha256((instruction_text or "").encode("utf-8")).hexdigest()
+    key_material = json.dumps(
+        [
+            provider,
+            model,
+            instruction_key,
+            instruction_version,
+            normalize_text(user_reply_for_format),
+            [[m.get("role", ""), normalize_text(m.get("content"))] for m in messages],
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: SQLite Tier ===
+class _SqliteTier:
+    """Ответы на диске: переживают перезапуск бота. Запросы - в отдельном потоке."""
+
+    _PRUNE_EVERY_WRITES = 500
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS ai_response_cache "
+            "(cache_key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+        self._writes = 0
+
+    def _get_sync(self, cache_key: str) -> typing.Optional[typing.Tuple[str, float]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, expires_at FROM ai_response_cache WHERE cache_key = ? AND expires_at > ?",
+                (cache_key, time.time()),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _set_sync(self, cache_key: str, response: str, ttl: float) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO ai_response_cache (cache_key, response, expires_at) VALUES (?, ?, ?)",
+                (cache_key, response, time.time() + ttl),
+            )
+            self._writes += 1
+            if self._writes % self._PRUNE_EVERY_WRITES == 0:
+                self._connection.execute("DELETE FROM ai_response_cache WHERE expires_at <= ?", (time.time(),))
+            self._connection.commit()
+
+    async def get(self, cache_key: str) -> typing.Optional[typing.Tuple[str, float]]:
+        """(ответ, оставшееся время жизни в секундах) или None."""
+        row = await asyncio.to_thread(self._get_sync, cache_key)
+        if row is None:
+            return None
+        return row[0], row[1] - time.time()
+
+    async def set(self, cache_key: str, response: str, ttl: float) -> None:
+        await asyncio.to_thread(self._set_sync, cache_key, response, ttl)
+# === END BLOCK 4 ===
+
+
+# === BLOCK 5: Response Cache ===
+class AIResponseCache:
+    """
+    Ответы AI по ключу make_cache_key. Используется только для call_ai, где
+    в YAML включено `cache: true` или `cache_ttl: <сек>` (детерминированные
+    классификации); кэшируются только успешные ответы.
+    Уровень sqlite включается config.AI_RESPONSE_CACHE_SQLITE_PATH
+    (например, "data/cache/ai_response_cache.sqlite"; каталог создается при старте).
+    """
+
+    def __init__(self, max_entries: int = AI_CACHE_MAX_ENTRIES, sqlite_path: typing.Optional[str] = None) -> None:
+        self._memory: TTLCache[str, str] = TTLCache(max_entries, DEFAULT_AI_CACHE_TTL)
+        self._sqlite: typing.Optional[_SqliteTier] = None
+        if sqlite_path:
+            try:
+                self._sqlite = _SqliteTier(sqlite_path)
+                logger.info(f"Кэш ответов AI: уровень sqlite включен ({sqlite_path}).")
+            except Exception as e:
+                logger.error(f"Кэш ответов AI: не удалось открыть sqlite '{sqlite_path}': {e}. Только память.")
+        self._stats: typing.Dict[str, int] = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0}
+
+    async def get(self, cache_key: str) -> typing.Optional[str]:
+        response = self._memory.get(cache_key)
+        if response is not None:
+            self._stats["hits_memory"] += 1
+            return response
+        if self._sqlite is not None:
+            try:
+                row = await self._sqlite.get(cache_key)
+            except Exception as e:
+                logger.warning(f"Кэш ответов AI: ошибка чтения sqlite: {e}")
+                row = None
+            if row is not None:
+                response, ttl_left = row
+                self._memory.set(cache_key, response, ttl=ttl_left)
+                self._stats["hits_disk"] += 1
+                return response
+        self._stats["misses"] += 1
+        return None
+
+    async def set(self, cache_key: str, response: str, ttl: float) -> None:
+        self._memory.set(cache_key, response, ttl=ttl)
+        self._stats["stores"] += 1
+        if self._sqlite is not None:
+            try:
+                await self._sqlite.set(cache_key, response, ttl)
+            except Exception as e:
+                logger.warning(f"Кэш ответов AI: ошибка записи sqlite: {e}")
+
+    def get_stats(self) -> typing.Dict[str, int]:
+        return dict(self._stats, memory_size=len(self._memory))
+
+
+def resolve_cache_ttl(params: typing.Mapping[str, typing.Any]) -> typing.Optional[float]:
+    """TTL из параметров call_ai: cache_ttl (сек) или cache: true; None - кэш выключен."""
+    cache_ttl = params.get("cache_ttl")
+    if cache_ttl is not None:
+        try:
+            cache_ttl = float(cache_ttl)
+        except (TypeError, ValueError):
+            logger.warning(f"Кэш ответов AI: неверный cache_ttl '{cache_ttl}', кэш выключен.")
+            return None
+        return cache_ttl if cache_ttl > 0 else None
+    if params.get("cache") is True:
+        return DEFAULT_AI_CACHE_TTL
+    return None
+
+
+# Один экземпляр на процесс
+ai_response_cache = AIResponseCache(
+    sqlite_path=getattr(config, "AI_RESPONSE_CACHE_SQLITE_PATH", None)
+)
+# === END BLOCK 5 ===
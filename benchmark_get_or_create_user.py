@@ -0,0 +1,122 @@
+# benchmark_get_or_create_user.py
+# Нагрузочный тест get_or_create_user (путь /start): пропускная способность
+# при разном размере пула соединений. Без глобального мьютекса число
+# вызовов в секунду должно расти вместе с размером пула.
+#
+# Запуск: python benchmark_get_or_create_user.py [--calls 2000] [--concurrency 50]
+# Пишет в БД из config.py тестовых пользователей с user_id >= BENCH_USER_ID_BASE
+# и удаляет их в конце.
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+try:
+    from sqlalchemy import delete
+    from sqlalchemy.ext.asyncio import (
+        AsyncSession,
+        async_sessionmaker,
+        create_async_engine,
+    )
+
+    import database.models as db_models
+    from database.models import (
+        DATABASE_URL,
+        UserData,
+        close_database,
+        get_or_create_user,
+        initialize_database,
+    )
+except ImportError as e:
+    print(
+        f"Ошибка импорта: {e}. Запускайте скрипт из корня проекта "
+        "или настройте PYTHONPATH."
+    )
+    sys.exit(1)
+
+# --- Параметры ---
+POOL_SIZES = (1, 2, 5, 10)
+BENCH_USER_ID_BASE = 9_000_000_000_000  # Вне диапазона реальных Telegram ID
+# Доля вызовов для уже существующих пользователей (повторный /start)
+REPEAT_EVERY = 2
+# --- Конец Параметров ---
+
+logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+logger = logging.getLogger("benchmark")
+
+
+async def _run_calls(calls: int, concurrency: int) -> float:
+    """Выполняет calls вызовов get_or_create_user, не более concurrency одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def one_call(index: int) -> None:
+        nonlocal failures
+        # Каждый REPEAT_EVERY-й вызов - для уже созданного пользователя (ветка ON CONFLICT)
+        user_id = BENCH_USER_ID_BASE + index // REPEAT_EVERY
+        async with semaphore:
+            user, _created = await get_or_create_user(
+                user_id, f"bench_{user_id}", "Bench", "ru"
+            )
+        if user is None:
+            failures += 1
+
+    started_at = time.monotonic()
+    await asyncio.gather(*(one_call(i) for i in range(calls)))
+    elapsed = time.monotonic() - started_at
+    if failures:
+        logger.warning(f"{failures} вызовов завершились ошибкой.")
+    return elapsed
+
+
+async def _cleanup() -> None:
+    async with db_models.AsyncSessionLocal() as session, session.begin():
+        await session.execute(
+            delete(UserData).where(UserData.user_id >= BENCH_USER_ID_BASE)
+        )
+
+
+async def main(calls: int, concurrency: int) -> None:
+    if not await initialize_database():
+        logger.error("Инициализация БД не удалась. Бенчмарк отменен.")
+        return
+    default_session_maker = db_models.AsyncSessionLocal
+    results = []
+    try:
+        for pool_size in POOL_SIZES:
+            engine = create_async_engine(
+                DATABASE_URL, pool_size=pool_size, max_overflow=0
+            )
+            # get_or_create_user берет сессии из глобальной фабрики
+            db_models.AsyncSessionLocal = async_sessionmaker(
+                engine, expire_on_commit=False, class_=AsyncSession
+            )
+            try:
+                await _cleanup()
+                elapsed = await _run_calls(calls, concurrency)
+            finally:
+                db_models.AsyncSessionLocal = default_session_maker
+                await engine.dispose()
+            results.append((pool_size, elapsed, calls / elapsed))
+            print(
+                f"pool_size={pool_size:>3}  {calls} calls in {elapsed:.3f}s  "
+                f"-> {calls / elapsed:.1f} calls/s"
+            )
+    finally:
+        await _cleanup()
+        await close_database()
+
+    if results:
+        base_rate = results[0][2]
+        print("\nМасштабирование относительно pool_size=1:")
+        for pool_size, _elapsed, rate in results:
+            print(f"  pool_size={pool_size:>3}: x{rate / base_rate:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк get_or_create_user по размеру пула")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.concurrency))
@@ -0,0 +1,173 @@
+# data/instructions.py
+# Неизменяемый каталог текстов Instructions на процесс: тексты сообщений и промптов без запросов к БД
+
+# === BLOCK 1: Imports ===
+import logging
+import time
+from types import MappingProxyType
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from database.cache_sync import cache_sync, notify_cache_change
+from database.models import Instructions
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Catalog Structures ===
+# Порядок поиска текста: язык пользователя (если он есть в списке) -> остальные по порядку
+FALLBACK_LANGS: Tuple[str, ...] = tuple(
+    getattr(config, "DEFAULT_FALLBACK_LANGS", None) or ("en", "uk", "ru")
+)
+# Языки fallback-цепочки, для которых в Instructions есть колонка text_<lang>
+_CATALOG_LANGS: Tuple[str, ...] = tuple(
+    lang for lang in FALLBACK_LANGS if hasattr(Instructions, f"text_{lang}")
+)
+_missing_langs = [lang for lang in FALLBACK_LANGS if lang not in _CATALOG_LANGS]
+if _missing_langs:
+    logger.warning(f"InstructionsCache: колонок text_<lang> нет для языков {_missing_langs}, они пропускаются.")
+
+
+def fallback_chain(user_lang_code: Optional[str]) -> Tuple[str, ...]:
+    """Цепочка языков как в прежнем _get_instruction_text: язык пользователя первым, если он в FALLBACK_LANGS."""
+    user_lang = user_lang_code.lower() if user_lang_code else None
+    if user_lang in FALLBACK_LANGS:
+        return (user_lang,) + tuple(lang for lang in FALLBACK_LANGS if lang != user_lang)
+    return FALLBACK_LANGS
+
+
+def _resolve_texts(instruction: Instructions) -> Mapping[Optional[str], Optional[str]]:
+    """
+    {язык пользователя: итоговый текст} для одной инструкции: цепочка
+    fallback уже пройдена. Ключ None - язык пользователя вне FALLBACK_LANGS.
+    """
+    texts: Dict[str, str] = {}
+    for lang in _CATALOG_LANGS:
+        value = getattr(instruction, f"text_{lang}")
+        if value and value.strip():
+            texts[lang] = value.strip()
+    resolved: Dict[Optional[str], Optional[str]] = {}
+    for user_lang in (None,) + FALLBACK_LANGS:
+        resolved[user_lang] = next(
+            (texts[lang] for lang in fallback_chain(user_lang) if lang in texts), None
+        )
+    return MappingProxyType(resolved)
+
+
+class InstructionsCatalog:
+    """
+    Снимок таблицы Instructions: key -> {язык пользователя: текст после fallback}.
+    Объект не меняется после сборки; обновление - замена целиком.
+    """
+
+    __slots__ = ("_texts", "fingerprint", "loaded_at")
+
+    def __init__(self, instructions: Iterable[Instructions], fingerprint: str) -> None:
+        self._texts: Mapping[str, Mapping[Optional[str], Optional[str]]] = MappingProxyType(
+            {instruction.key: _resolve_texts(instruction) for instruction in instructions}
+        )
+        self.fingerprint = fingerprint
+        self.loaded_at = time.time()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._texts
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def get_text(self, key: str, user_lang_code: Optional[str]) -> Optional[str]:
+        """Текст по ключу с учетом fallback; None - ключа нет или текст пуст на всех языках."""
+        resolved = self._texts.get(key)
+        if resolved is None:
+            return None
+        user_lang = user_lang_code.lower() if user_lang_code else None
+        return resolved.get(user_lang if user_lang in resolved else None)
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Process-Wide Catalog ===
+INSTRUCTIONS_CACHE_CHANNEL = "instructions_cache"
+
+_instructions_catalog: Optional[InstructionsCatalog] = None
+
+_FINGERPRINT_SQL = text(
+    "SELECT md5(coalesce(string_agg(i::text, ',' ORDER BY i.instruction_id), '')) FROM instructions i"
+)
+
+
+async def refresh_instructions_catalog(session: AsyncSession, force: bool = False) -> InstructionsCatalog:
+    """
+    Пересобирает каталог одним запросом, если таблица изменилась (или
+    force=True), и атомарно подменяет глобальный. Возвращает актуальный каталог.
+    """
+    global _instructions_catalog
+    fingerprint = (await session.execute(_FINGERPRINT_SQL)).scalar_one()
+    current = _instructions_catalog
+    if current is not None and not force and current.fingerprint == fingerprint:
+        return current
+
+    load_start_time = time.monotonic()
+    instructions = (await session.execute(select(Instructions))).scalars().all()
+    catalog = InstructionsCatalog(instructions, fingerprint)
+    _instructions_catalog = catalog
+    logger.info(
+        f"InstructionsCache: каталог Instructions обновлен ({len(catalog)} ключей) "
+        f"за {time.monotonic() - load_start_time:.4f}s."
+    )
+    return catalog
+
+
+async def get_instructions_catalog(session: AsyncSession) -> InstructionsCatalog:
+    """Текущий каталог; если его еще нет (сбой при старте) - загружает через session."""
+    catalog = _instructions_catalog
+    if catalog is not None:
+        return catalog
+    logger.warning("InstructionsCache: каталог не загружен, загружаем по запросу.")
+    return await refresh_instructions_catalog(session, force=True)
+
+
+async def get_instruction_text(
+    session: AsyncSession, instruction_key: str, user_lang_code: Optional[str] = None
+) -> Optional[str]:
+    """
+    Текст инструкции из каталога. Ключа нет в каталоге (добавлен после сборки) -
+    одна строка дочитывается из БД, а каталог ставится на сверку.
+    """
+    catalog = await get_instructions_catalog(session)
+    if instruction_key in catalog:
+        return catalog.get_text(instruction_key, user_lang_code)
+
+    stmt = select(Instructions).where(Instructions.key == instruction_key).limit(1)
+    instruction = (await session.execute(stmt)).scalar_one_or_none()
+    if instruction is None:
+        return None
+    logger.info(f"InstructionsCache: ключа '{instruction_key}' нет в каталоге, каталог поставлен на сверку.")
+    cache_sync.request_poll(INSTRUCTIONS_CACHE_CHANNEL)
+    user_lang = user_lang_code.lower() if user_lang_code else None
+    resolved = _resolve_texts(instruction)
+    return resolved.get(user_lang if user_lang in resolved else None)
+
+
+async def notify_instructions_changed(session: AsyncSession) -> None:
+    """NOTIFY для всех процессов в транзакции, изменившей Instructions (после commit)."""
+    await notify_cache_change(session, INSTRUCTIONS_CACHE_CHANNEL, "changed")
+
+
+def _on_instructions_notify(payload: str) -> None:
+    cache_sync.request_poll(INSTRUCTIONS_CACHE_CHANNEL)
+
+
+async def _poll_instructions(session: AsyncSession) -> None:
+    await refresh_instructions_catalog(session)
+
+
+cache_sync.register(INSTRUCTIONS_CACHE_CHANNEL, _on_instructions_notify, _poll_instructions)
+# === END BLOCK 4 ===
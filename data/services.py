@@ -0,0 +1,234 @@
+# data/services.py
+# Неизменяемый снимок таблицы Services на процесс: навигация по дереву услуг без запросов к БД
+
+# === BLOCK 1: Imports ===
+import logging
+import time
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import noload
+
+from database.cache_sync import cache_sync, notify_cache_change
+from database.models import Services
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Snapshot Structures ===
+# Языки, для которых в Services есть колонка name_<lang>
+SERVICE_NAME_LANGS: Tuple[str, ...] = (
+    "en", "es", "fr", "de", "uk", "pl", "ru", "ro", "ar", "tr", "fa", "pt", "hi", "uz",
+)
+
+
+class ServiceNode:
+    """Одна услуга из снимка (только чтение)."""
+
+    __slots__ = (
+        "service_id",
+        "parent_id",
+        "name_key",
+        "names",
+        "category_group",
+        "is_selectable_by_master",
+        "is_selectable_by_customer",
+        "requires_travel_question",
+        "requires_workplace_question",
+        "has_children",
+    )
+
+    def __init__(self, service: Services) -> None:
+        self.service_id: int = service.service_id
+        self.parent_id: Optional[int] = service.parent_id
+        self.name_key: str = service.name_key
+        self.names: Mapping[str, str] = MappingProxyType({
+            lang: getattr(service, f"name_{lang}")
+            for lang in SERVICE_NAME_LANGS
+            if getattr(service, f"name_{lang}", None)
+        })
+        self.category_group: str = service.category_group
+        self.is_selectable_by_master: bool = service.is_selectable_by_master
+        self.is_selectable_by_customer: bool = service.is_selectable_by_customer
+        self.requires_travel_question: bool = service.requires_travel_question
+        self.requires_workplace_question: bool = service.requires_workplace_question
+        # Есть ли выбираемые мастером дети; заполняется при сборке снимка
+        self.has_children: bool = False
+
+    def display_name(self, lang_code: Optional[str]) -> str:
+        """Название на языке пользователя -> name_en -> name_key (как раньше в хендлерах)."""
+        return (
+            (self.names.get(lang_code.lower()) if lang_code else None)
+            or self.names.get("en")
+            or self.name_key
+        )
+
+    def as_child_dict(self, lang_code: str) -> Dict[str, Any]:
+        """Формат элемента get_service_children."""
+        return {
+            "service_id": self.service_id,
+            "name_key": self.name_key,
+            "display_name": self.display_name(lang_code),
+            "has_children": self.has_children,
+            "is_selectable_by_master": self.is_selectable_by_master,
+        }
+
+
+class ServicesSnapshot:
+    """
+    Снимок всей таблицы Services с индексами:
+      - by_id / by_name_key;
+      - parent_id -> выбираемые мастером дети (по service_id);
+      - has_children у каждого узла (есть ли выбираемые дети).
+    Объект не меняется после сборки; обновление - замена целиком.
+    """
+
+    __slots__ = ("by_id", "by_name_key", "_selectable_children", "fingerprint", "loaded_at")
+
+    def __init__(self, services: Iterable[Services], fingerprint: str) -> None:
+        nodes = sorted((ServiceNode(service) for service in services), key=lambda n: n.service_id)
+        children: Dict[int, List[ServiceNode]] = {}
+        for node in nodes:
+            if node.parent_id is not None and node.is_selectable_by_master:
+                children.setdefault(node.parent_id, []).append(node)
+        for node in nodes:
+            node.has_children = node.service_id in children
+        self.by_id: Mapping[int, ServiceNode] = MappingProxyType({n.service_id: n for n in nodes})
+        self.by_name_key: Mapping[str, ServiceNode] = MappingProxyType({n.name_key: n for n in nodes})
+        self._selectable_children: Mapping[int, Tuple[ServiceNode, ...]] = MappingProxyType(
+            {parent_id: tuple(child_nodes) for parent_id, child_nodes in children.items()}
+        )
+        self.fingerprint = fingerprint
+        self.loaded_at = time.time()
+
+    def get(self, service_id: Optional[int]) -> Optional[ServiceNode]:
+        return self.by_id.get(service_id) if service_id is not None else None
+
+    def get_by_name_key(self, name_key: str) -> Optional[ServiceNode]:
+        return self.by_name_key.get(name_key)
+
+    def selectable_children(self, parent_id: int) -> Tuple[ServiceNode, ...]:
+        return self._selectable_children.get(parent_id, ())
+
+    def display_names(self, service_ids: Iterable[int], lang_code: str) -> Dict[int, str]:
+        """{service_id: название} для найденных id (неизвестные пропускаются)."""
+        result: Dict[int, str] = {}
+        for service_id in service_ids:
+            node = self.by_id.get(service_id)
+            if node is not None:
+                result[service_id] = node.display_name(lang_code)
+        return result
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Process-Wide Snapshot ===
+SERVICES_CACHE_CHANNEL = "services_cache"
+
+_services_snapshot: Optional[ServicesSnapshot] = None
+
+# Отпечаток содержимого таблицы: для маленького справочника дешевле
+# пересчитать его, чем следить за updated_at (загрузчик не всегда его меняет)
+_FINGERPRINT_SQL = text(
+    "SELECT md5(coalesce(string_agg(s::text, ',' ORDER BY s.service_id), '')) FROM services s"
+)
+
+
+async def refresh_services_snapshot(session: AsyncSession, force: bool = False) -> ServicesSnapshot:
+    """
+    Пересобирает снимок, если таблица изменилась (или force=True), и
+    атомарно подменяет глобальный. Возвращает актуальный снимок.
+    """
+    global _services_snapshot
+    fingerprint = (await session.execute(_FINGERPRINT_SQL)).scalar_one()
+    current = _services_snapshot
+    if current is not None and not force and current.fingerprint == fingerprint:
+        return current
+
+    load_start_time = time.monotonic()
+    # Связи (children/masters - lazy="selectin") снимку не нужны: дерево строим сами
+    services = (
+        await session.execute(select(Services).options(noload("*")))
+    ).scalars().all()
+    snapshot = ServicesSnapshot(services, fingerprint)
+    _services_snapshot = snapshot
+    logger.info(
+        f"ServicesCache: снимок Services обновлен ({len(snapshot)} услуг) "
+        f"за {time.monotonic() - load_start_time:.4f}s."
+    )
+    return snapshot
+
+
+def current_services_snapshot() -> Optional[ServicesSnapshot]:
+    """Текущий снимок без обращения к БД (None - еще не загружен)."""
+    return _services_snapshot
+
+
+async def get_services_snapshot(session: AsyncSession) -> ServicesSnapshot:
+    """Текущий снимок; если его еще нет (сбой при старте) - загружает через session."""
+    snapshot = _services_snapshot
+    if snapshot is not None:
+        return snapshot
+    logger.warning("ServicesCache: снимок не загружен, загружаем по запросу.")
+    return await refresh_services_snapshot(session, force=True)
+
+
+async def resolve_service_nodes(
+    session: AsyncSession, service_ids: Iterable[int]
+) -> Dict[int, ServiceNode]:
+    """
+    {service_id: ServiceNode} для списка id, в порядке первого появления.
+    Берет из снимка; id, которых в снимке нет (услугу добавили после сборки),
+    дочитываются одним запросом (has_children у них не вычисляется),
+    а снимок ставится на сверку. Неизвестные id в результат не попадают.
+    """
+    unique_ids = list(dict.fromkeys(service_ids))
+    snapshot = await get_services_snapshot(session)
+    found: Dict[int, ServiceNode] = {}
+    missing_ids = [service_id for service_id in unique_ids if snapshot.get(service_id) is None]
+    if missing_ids:
+        stmt = select(Services).where(Services.service_id.in_(missing_ids)).options(noload("*"))
+        found = {service.service_id: ServiceNode(service) for service in (await session.execute(stmt)).scalars()}
+        if found:
+            logger.info(f"ServicesCache: {len(found)} услуг нет в снимке, снимок поставлен на сверку.")
+            cache_sync.request_poll(SERVICES_CACHE_CHANNEL)
+    nodes: Dict[int, ServiceNode] = {}
+    for service_id in unique_ids:
+        node = snapshot.get(service_id) or found.get(service_id)
+        if node is not None:
+            nodes[service_id] = node
+    return nodes
+
+
+async def resolve_service_names(
+    session: AsyncSession, service_ids: Iterable[int], lang_code: str
+) -> Dict[int, str]:
+    """{service_id: название на lang_code} для списка id (не более одного запроса к БД)."""
+    nodes = await resolve_service_nodes(session, service_ids)
+    return {service_id: node.display_name(lang_code) for service_id, node in nodes.items()}
+
+
+async def notify_services_changed(session: AsyncSession) -> None:
+    """NOTIFY для всех процессов в транзакции, изменившей Services (после commit)."""
+    await notify_cache_change(session, SERVICES_CACHE_CHANNEL, "changed")
+
+
+def _on_services_notify(payload: str) -> None:
+    cache_sync.request_poll(SERVICES_CACHE_CHANNEL)
+
+
+async def _poll_services(session: AsyncSession) -> None:
+    await refresh_services_snapshot(session)
+
+
+cache_sync.register(SERVICES_CACHE_CHANNEL, _on_services_notify, _poll_services)
+# === END BLOCK 4 ===
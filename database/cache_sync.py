@@ -0,0 +1,175 @@
+# database/cache_sync.py
+# Синхронизация in-memory кэшей между процессами бота через PostgreSQL LISTEN/NOTIFY
+
+# === BLOCK 1: Imports ===
+import asyncio
+import contextlib
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.models import DATABASE_URL
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Listener ===
+NotifyCallback = Callable[[str], None]
+PollCallback = Callable[[AsyncSession], Awaitable[None]]
+
+
+class _CacheChannel:
+    __slots__ = ("channel", "on_notify", "poll")
+
+    def __init__(self, channel: str, on_notify: NotifyCallback, poll: PollCallback) -> None:
+        self.channel = channel
+        self.on_notify = on_notify
+        self.poll = poll
+
+
+class CacheSyncListener:
+    """
+    Держит отдельное соединение asyncpg с LISTEN на зарегистрированные каналы.
+    Каждый кэш регистрирует:
+      - on_notify(payload): точечная инвалидация по NOTIFY (синхронная, быстрая);
+      - poll(session): полная сверка с БД (после (пере)подключения и как fallback).
+    Если по NOTIFY нужно сходить в БД, on_notify вызывает request_poll(channel):
+    сверка запускается отдельной задачей со своей сессией.
+    Пока LISTEN-соединения нет, poll вызывается каждые poll_interval секунд,
+    так что изменения доходят до процесса не дольше чем за poll_interval.
+    """
+
+    def __init__(self, poll_interval: float = 1.0, reconnect_interval: float = 5.0) -> None:
+        self._poll_interval = poll_interval
+        self._reconnect_interval = reconnect_interval
+        self._channels: Dict[str, _CacheChannel] = {}
+        self._session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+        self._connection: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._poll_tasks: Set[asyncio.Task] = set()
+
+    def register(self, channel: str, on_notify: NotifyCallback, poll: PollCallback) -> None:
+        """Регистрирует кэш. Вызывается при импорте модуля кэша (до start)."""
+        self._channels[channel] = _CacheChannel(channel, on_notify, poll)
+
+    def request_poll(self, channel: str) -> None:
+        """Запускает сверку канала в фоне (для on_notify, которому нужна БД)."""
+        cache_channel = self._channels.get(channel)
+        if not cache_channel or not self._session_maker:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._poll_channel(cache_channel), name=f"cache-sync-poll-{channel}"
+        )
+        self._poll_tasks.add(task)
+        task.add_done_callback(self._poll_tasks.discard)
+
+    @property
+    def is_listening(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def start(self, session_maker: async_sessionmaker[AsyncSession]) -> None:
+        if self._task and not self._task.done():
+            return
+        self._session_maker = session_maker
+        self._task = asyncio.create_task(self._run(), name="cache-sync-listener")
+        logger.info(f"CacheSync: запущен для каналов {list(self._channels)}.")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for task in list(self._poll_tasks):
+            task.cancel()
+        await self._close_connection()
+        logger.info("CacheSync: остановлен.")
+
+    # --- Внутренняя логика ---
+    def _dispatch(self, connection, pid: int, channel: str, payload: str) -> None:
+        cache_channel = self._channels.get(channel)
+        if not cache_channel:
+            return
+        logger.debug(f"CacheSync: NOTIFY {channel} '{payload}' (pid {pid}).")
+        try:
+            cache_channel.on_notify(payload)
+        except Exception as e:
+            logger.error(f"CacheSync: ошибка обработки NOTIFY {channel}: {e}", exc_info=True)
+
+    async def _poll_channel(self, cache_channel: _CacheChannel) -> None:
+        try:
+            async with self._session_maker() as session:
+                await cache_channel.poll(session)
+        except Exception as e:
+            logger.error(
+                f"CacheSync: ошибка сверки кэша {cache_channel.channel}: {e}",
+                exc_info=True,
+            )
+
+    async def _poll_all(self) -> None:
+        if not self._session_maker:
+            return
+        for cache_channel in list(self._channels.values()):
+            await self._poll_channel(cache_channel)
+
+    async def _connect(self) -> None:
+        # asyncpg не понимает схему SQLAlchemy "postgresql+asyncpg"
+        dsn = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+        connection = await asyncpg.connect(dsn)
+        for channel in self._channels:
+            await connection.add_listener(channel, self._dispatch)
+        self._connection = connection
+        logger.info(f"CacheSync: LISTEN активен для каналов {list(self._channels)}.")
+
+    async def _close_connection(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None and not connection.is_closed():
+            try:
+                await connection.close()
+            except Exception as e:
+                logger.warning(f"CacheSync: ошибка закрытия соединения LISTEN: {e}")
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_connect_attempt = 0.0
+        while True:
+            if not self.is_listening and loop.time() >= next_connect_attempt:
+                await self._close_connection()
+                try:
+                    await self._connect()
+                except Exception as e:
+                    next_connect_attempt = loop.time() + self._reconnect_interval
+                    logger.warning(
+                        f"CacheSync: LISTEN недоступен ({e}). Работаем через опрос каждые {self._poll_interval}s."
+                    )
+                # Сверка после (пере)подключения: NOTIFY за время простоя потеряны
+                await self._poll_all()
+            elif not self.is_listening:
+                await self._poll_all()
+            await asyncio.sleep(self._poll_interval)
+
+
+# Один экземпляр на процесс
+cache_sync = CacheSyncListener()
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Notify Helper ===
+async def notify_cache_change(session: AsyncSession, channel: str, payload: str) -> None:
+    """
+    Отправляет NOTIFY в рамках транзакции сессии: подписчики получат его
+    только после commit (и не получат при rollback).
+    """
+    await session.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": channel, "payload": payload},
+    )
+# === END BLOCK 4 ===
@@ -0,0 +1,128 @@
+# database/last_seen.py
+# Накопитель UserData.last_seen: активность пишется в БД пачкой раз в N секунд
+
+# === BLOCK 1: Imports ===
+import asyncio
+import contextlib
+import datetime
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import BigInteger, DateTime, column, update, values
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.models import UserData
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Tracker ===
+LAST_SEEN_FLUSH_INTERVAL = 30.0  # секунд
+# Строк в одном UPDATE ... FROM (VALUES ...): 2 параметра на строку,
+# с запасом до лимита параметров asyncpg (32767)
+_FLUSH_CHUNK_SIZE = 1000
+
+
+class LastSeenTracker:
+    """
+    touch(user_id) только запоминает время в памяти. Фоновая задача раз в
+    flush_interval секунд пишет всех "грязных" пользователей одним
+    UPDATE user_data ... FROM (VALUES ...) (по чанкам _FLUSH_CHUNK_SIZE).
+
+    last_seen может отставать от реальности на flush_interval; при падении
+    процесса теряется не более одного интервала. Пишется только для уже
+    существующих строк user_data и только вперед по времени.
+    """
+
+    def __init__(self, flush_interval: float = LAST_SEEN_FLUSH_INTERVAL) -> None:
+        self._flush_interval = flush_interval
+        self._pending: Dict[int, datetime.datetime] = {}
+        self._session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, user_id: int, seen_at: Optional[datetime.datetime] = None) -> None:
+        """Отмечает активность пользователя (без обращения к БД)."""
+        if not isinstance(user_id, int) or user_id <= 0:
+            return
+        self._pending[user_id] = seen_at or datetime.datetime.now(datetime.UTC)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def start(self, session_maker: async_sessionmaker[AsyncSession]) -> None:
+        if self._task and not self._task.done():
+            return
+        self._session_maker = session_maker
+        self._task = asyncio.create_task(self._run(), name="last-seen-flusher")
+        logger.info(f"LastSeen: запущен, интервал записи {self._flush_interval}s.")
+
+    async def stop(self) -> None:
+        """Останавливает фоновую задачу и записывает накопленное."""
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+        logger.info("LastSeen: остановлен.")
+
+    async def flush(self) -> int:
+        """Пишет накопленные отметки в БД. Возвращает число обновленных строк."""
+        if not self._pending or not self._session_maker:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows: List[Tuple[int, datetime.datetime]] = list(pending.items())
+        updated = 0
+        try:
+            async with self._session_maker() as session, session.begin():
+                for chunk_start in range(0, len(rows), _FLUSH_CHUNK_SIZE):
+                    result = await session.execute(
+                        _build_bulk_update(rows[chunk_start:chunk_start + _FLUSH_CHUNK_SIZE]),
+                        execution_options={"synchronize_session": False},
+                    )
+                    updated += result.rowcount or 0
+        except Exception as e:
+            # Возвращаем отметки в очередь (более новые, пришедшие за время записи, не затираем)
+            for user_id, seen_at in rows:
+                if user_id not in self._pending or self._pending[user_id] < seen_at:
+                    self._pending[user_id] = seen_at
+            logger.error(f"LastSeen: ошибка записи {len(rows)} отметок: {e}", exc_info=True)
+            return 0
+        logger.debug(f"LastSeen: записано {updated} из {len(rows)} отметок.")
+        return updated
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+
+
+def _build_bulk_update(rows: List[Tuple[int, datetime.datetime]]):
+    """
+    UPDATE user_data SET last_seen = v.last_seen
+    FROM (VALUES ...) AS v(user_id, last_seen)
+    WHERE user_data.user_id = v.user_id AND user_data.last_seen < v.last_seen
+    updated_at не трогаем (иначе сработал бы onupdate): это не изменение профиля.
+    """
+    seen_values = values(
+        column("user_id", BigInteger),
+        column("last_seen", DateTime(timezone=True)),
+        name="v",
+    ).data(rows)
+    return (
+        update(UserData)
+        .where(UserData.user_id == seen_values.c.user_id)
+        .where(UserData.last_seen < seen_values.c.last_seen)
+        .values(last_seen=seen_values.c.last_seen, updated_at=UserData.updated_at)
+    )
+
+
+# Один экземпляр на процесс
+last_seen_tracker = LastSeenTracker()
+# === END BLOCK 3 ===
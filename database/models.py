@@ -1,10 +1,10 @@
 # Sprofy/database/models.py (Версия с добавленной моделью UserStates)
 
 # === BLOCK 1: Imports ===
-import asyncio
 import datetime
 import logging
-from typing import Any, Optional  # Добавлены Any, Optional, Union для type hints
+import time
+from typing import Any, Dict, Optional  # Добавлены Any, Optional, Union для type hints
 
 from sqlalchemy import (
     BigInteger,
@@ -16,13 +16,17 @@ from sqlalchemy import (
     String,
     Text,
     UniqueConstraint,
+    event,
     func,
+    literal_column,
+    or_,
     select,
+    text,
 )
 
 # Импорт JSONB для PostgreSQL
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.exc import IntegrityError as SQLAlchemyIntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import (
     DeclarativeBase,
@@ -76,9 +80,6 @@ async_engine = None  # Глобальная переменная для движ
 AsyncSessionLocal: Optional[async_sessionmaker[AsyncSession]] = (
     None  # Глобальная фабрика сессий
 )
-_get_or_create_lock = (
-    asyncio.Lock()
-)  # Мьютекс для предотвращения гонок при создании юзера
 # === END BLOCK 4 ===
 
 
@@ -525,10 +526,10 @@ class UserStates(Base):
     # Связь для доступа к объекту UserData из состояния
     user: Mapped["UserData"] = relationship(back_populates="current_state")
 
-    # Ограничение: У одного пользователя может быть только одно активное состояние?
-    # Если да, можно добавить UniqueConstraint("user_id", name="uq_user_state")
-    # Пока не добавляем для гибкости, но стоит подумать.
-    # __table_args__ = (UniqueConstraint("user_id", name="uq_user_state"),)
+    # Ограничение: у одного пользователя только одно активное состояние.
+    # Нужно для INSERT ... ON CONFLICT (user_id) в BehaviorEngine.state_manager.
+    # Для уже существующих таблиц индекс создается в initialize_database.
+    __table_args__ = (UniqueConstraint("user_id", name="uq_user_state"),)
 
     def __repr__(self):
         # Строка f-string разбита для E501
@@ -589,6 +590,8 @@ async def initialize_database() -> Optional[async_sessionmaker[AsyncSession]]:
             # включая новую UserStates
             await conn.run_sync(Base.metadata.create_all)
         logger.info("Таблицы проверены/созданы/обновлены.")
+        await _check_user_state_unique_index()
+        _attach_pool_listeners(async_engine)
         logger.info("SQLAlchemy async engine и sessionmaker инициализированы.")
         return local_session_maker  # Возвращаем фабрику для передачи в bot_data
 
@@ -610,6 +613,31 @@ async def initialize_database() -> Optional[async_sessionmaker[AsyncSession]]:
         return None
 
 
+async def _check_user_state_unique_index() -> None:
+    """
+    create_all не добавляет ограничения в существующие таблицы, а upsert
+    состояний (ON CONFLICT (user_id)) без уникального индекса uq_user_state
+    падает на каждом апдейте. Поэтому без индекса бот не запускается:
+    для старой БД его создает разовый скрипт migrate_user_states_unique_index.py.
+    """
+    async with async_engine.connect() as conn:
+        result = await conn.execute(
+            text(
+                "SELECT 1 FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = 'uq_user_state' AND i.indisunique "
+                "AND i.indrelid = 'user_states'::regclass"
+            )
+        )
+        index_exists = result.scalar_one_or_none() is not None
+    if not index_exists:
+        raise RuntimeError(
+            "Нет уникального индекса uq_user_state на user_states(user_id). "
+            "Запустите migrate_user_states_unique_index.py."
+        )
+    logger.info("Уникальный индекс user_states(user_id) на месте.")
+
+
 async def close_database():
     """Корректно закрывает (утилизирует) асинхронный движок SQLAlchemy."""
     global async_engine, AsyncSessionLocal
@@ -634,8 +662,19 @@ async def get_or_create_user(
     """
     Получает пользователя по ID или создает нового, используя
     глобальную AsyncSessionLocal. (Строка docstring разбита для E501)
-    Обновляет username, first_name, language_code, last_seen при каждом вызове.
+    Обновляет username, first_name, language_code, если они изменились.
     Возвращает (объект UserData или None, флаг created=True/False).
+
+    Одна команда INSERT ... ON CONFLICT (user_id) DO UPDATE ... RETURNING
+    без глобального мьютекса: параллельные вызовы для одного user_id
+    сериализует блокировка строки в PostgreSQL, для разных - идут параллельно.
+    language_code обновляется, только если передан. Если профиль не изменился,
+    строка не перезаписывается (DO UPDATE ... WHERE), а пользователь читается
+    обычным SELECT. created определяется по xmax = 0 (строка вставлена этой
+    командой, а не обновлена).
+
+    last_seen здесь пишется только при создании; дальше его обновляет
+    database.last_seen.last_seen_tracker пачками.
     """
     if not AsyncSessionLocal:
         # Строка разбита для E501
@@ -645,133 +684,148 @@ async def get_or_create_user(
         )
         return None, False
 
-    created = False
-    user: UserData | None = None
     current_time = datetime.datetime.now(datetime.timezone.utc)  # Используем UTC
+    insert_stmt = pg_insert(UserData).values(
+        user_id=user_id,
+        username=username,
+        first_name=first_name,
+        language_code=language_code,
+        last_seen=current_time,
+    )
+    excluded = insert_stmt.excluded
+    new_language_code = func.coalesce(excluded.language_code, UserData.language_code)
+    profile_changed = or_(
+        UserData.username.is_distinct_from(excluded.username),
+        UserData.first_name.is_distinct_from(excluded.first_name),
+        UserData.language_code.is_distinct_from(new_language_code),
+    )
+    stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[UserData.user_id],
+        set_={
+            "username": excluded.username,
+            "first_name": excluded.first_name,
+            "language_code": new_language_code,
+            "updated_at": func.now(),
+        },
+        where=profile_changed,
+    ).returning(UserData, literal_column("xmax = 0", Boolean).label("created"))
 
-    # Комментарий разбит для E501
-    # Используем мьютекс для предотвращения гонки
-    # при одновременном создании одного юзера
-    # Исправлено SIM117: объединены lock, session и transaction begin в один with
-    async with _get_or_create_lock, AsyncSessionLocal() as session, session.begin():
-        try:
-            # Пытаемся получить пользователя
-            stmt_get = select(UserData).where(UserData.user_id == user_id)
-            result = await session.execute(stmt_get)
-            user = result.scalar_one_or_none()
-
-            if user:
-                # Пользователь найден, обновляем данные
-                needs_update = False
-                if user.username != username:
-                    user.username = username
-                    needs_update = True
-                if user.first_name != first_name:
-                    user.first_name = first_name
-                    needs_update = True
-                # Обновляем язык только если он передан и отличается
-                if language_code and user.language_code != language_code:
-                    user.language_code = language_code
-                    needs_update = True
-                # Всегда обновляем last_seen
-                user.last_seen = current_time
-                needs_update = True  # Эта строка была здесь, сохраняем
-
-                if needs_update:
-                    logger.debug(f"Обновление данных для UserData {user_id}...")
-                # Комментарий разбит для E501
-                # session.add(user) не нужен здесь, т.к. объект уже в сессии
-                # и будет сохранен при commit
-                created = False
+    try:
+        async with AsyncSessionLocal() as session, session.begin():
+            result = await session.execute(
+                stmt, execution_options={"populate_existing": True}
+            )
+            row = result.one_or_none()
+            if row is not None:
+                user, created = row
             else:
-                # Пользователь не найден, создаем нового
-                # Строка f-string разбита для E501
-                logger.info(
-                    f"[get_or_create_user] Пользователь {user_id} "
-                    "не найден, создаем..."
+                # Конфликт без изменений профиля: строка не тронута, просто читаем
+                user = await session.scalar(
+                    select(UserData).where(UserData.user_id == user_id)
                 )
-                user = UserData(
-                    user_id=user_id,
-                    username=username,
-                    first_name=first_name,
-                    language_code=language_code,
-                    # Комментарий перенесен для E501
-                    last_seen=current_time,  # last_seen устанавливается при создании
-                )
-                session.add(user)  # Добавляем нового пользователя в сессию
-                # Не нужно вызывать flush или refresh здесь, т.к. мы в begin()
-                logger.info(f"Новый UserData {user_id} ({username}) добавлен в сессию.")
-                created = True
+                created = False
+    except Exception as e:
+        # Строка f-string разбита для E501
+        logger.error(
+            "[get_or_create_user] Ошибка upsert для "
+            f"user_id={user_id}: {e}",
+            exc_info=True,
+        )
+        return None, False
 
-        except SQLAlchemyIntegrityError as e:
-            # Комментарий разбит для E501
-            # Эта ошибка может возникнуть, если два процесса одновременно
-            # пытаются создать одного юзера
-            # Строка f-string разбита для E501
-            logger.warning(
-                f"[get_or_create_user] IntegrityError для user_id={user_id}. "
-                f"Вероятно, создан параллельно. Ошибка: {e}"
-            )
-            # Комментарий разбит для E501
-            # Транзакция будет автоматически отменена (rollback)
-            # из-за session.begin()
-            # Комментарий разбит для E501
-            # Пытаемся получить пользователя еще раз ВНУТРИ ЭТОЙ ЖЕ СЕССИИ
-            # (но уже после rollback)
-            # Комментарий разбит для E501
-            # Это может не сработать как ожидается без новой транзакции,
-            # но попробуем
-            # Комментарий разбит для E501
-            # ЛУЧШЕ: Выйти из lock и сделать повторный вызов
-            # get_or_create_user, но пока так.
-            try:
-                stmt_get_retry = select(UserData).where(UserData.user_id == user_id)
-                result_retry = await session.execute(stmt_get_retry)
-                user = result_retry.scalar_one_or_none()
-                if user:
-                    # Комментарий разбит для E501
-                    # Если нашли, обновляем last_seen и считаем,
-                    # что не создавали
-                    user.last_seen = current_time
-                    session.add(user)  # Добавляем в сессию для обновления last_seen
-                    # Строка f-string разбита для E501
-                    logger.info(
-                        f"UserData {user_id} успешно получен " "после IntegrityError."
-                    )
-                    created = False
-                else:
-                    # Строка f-string разбита для E501
-                    logger.error(
-                        f"!!! UserData {user_id} НЕ найден после "
-                        "IntegrityError и повторной попытки!"
-                    )
-                    return None, False  # Критическая ситуация
-            except Exception as e_retry:
-                # Строка f-string разбита для E501
-                logger.error(
-                    "Критическая ошибка при повторном получении "
-                    f"user_id={user_id} после IntegrityError: {e_retry}",
-                    exc_info=True,
-                )
-                return None, False
+    if user is not None:
+        # Кэш профилей (database.user_profiles): заменяем на только что прочитанный
+        from database.user_profiles import (
+            invalidate_user_profile,
+            remember_user_profile,
+        )
 
-        except Exception as e:
-            # Строка f-string разбита для E501
-            logger.error(
-                "[get_or_create_user] Неперехваченная ошибка для "
-                f"user_id={user_id}: {e}",
-                exc_info=True,
-            )
-            # Транзакция будет автоматически отменена
-            return None, False  # Возвращаем ошибку
+        invalidate_user_profile(user_id)
+        remember_user_profile(user)
+    if created:
+        logger.info(f"Новый UserData {user_id} ({username}) создан.")
+    else:
+        logger.debug(f"Обновление данных для UserData {user_id}...")
+    # Возвращаем пользователя и флаг создания
+    return user, bool(created)
 
-        # Комментарий разбит для E501
-        # Если вышли из session.begin() без исключений,
-        # коммит произойдет автоматически
-        # Если было исключение, произойдет rollback
 
-    # Возвращаем пользователя (может быть None при ошибке) и флаг создания
-    return user, created
+# === END BLOCK 15 ===
+
 
+# === BLOCK 16: Connection Pool Usage ===
+# Счетчики выдачи соединений из пула (на процесс). Время удержания соединения
+# показывает, не держит ли кто-то соединение во время внешних вызовов (AI, Telegram).
+_pool_usage: Dict[str, float] = {
+    "checkouts": 0,
+    "checkins": 0,
+    "total_hold_seconds": 0.0,
+    "max_hold_seconds": 0.0,
+}
 
-# === END BLOCK 15 ===
+
+def _on_pool_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    connection_record.info["checkout_started_at"] = time.monotonic()
+    _pool_usage["checkouts"] += 1
+
+
+def _on_pool_checkin(dbapi_connection, connection_record) -> None:
+    started_at = connection_record.info.pop("checkout_started_at", None)
+    _pool_usage["checkins"] += 1
+    if started_at is None:
+        return
+    held_for = time.monotonic() - started_at
+    _pool_usage["total_hold_seconds"] += held_for
+    if held_for > _pool_usage["max_hold_seconds"]:
+        _pool_usage["max_hold_seconds"] = held_for
+
+
+def _attach_pool_listeners(engine) -> None:
+    """Подписывает счетчики на события пула (sync_engine: события пула синхронные)."""
+    pool = engine.sync_engine.pool
+    if not event.contains(pool, "checkout", _on_pool_checkout):
+        event.listen(pool, "checkout", _on_pool_checkout)
+        event.listen(pool, "checkin", _on_pool_checkin)
+
+
+def get_pool_status() -> Dict[str, Any]:
+    """
+    Текущая занятость пула и накопленная статистика удержания соединений.
+    Пустой словарь, если движок не инициализирован.
+    """
+    if not async_engine:
+        return {}
+    pool = async_engine.sync_engine.pool
+    status: Dict[str, Any] = {}
+    # QueuePool (по умолчанию для asyncpg) умеет size/checkedout/overflow
+    for attr in ("size", "checkedout", "checkedin", "overflow"):
+        getter = getattr(pool, attr, None)
+        if callable(getter):
+            status[attr] = getter()
+    checkins = _pool_usage["checkins"]
+    status["checkouts_total"] = int(_pool_usage["checkouts"])
+    status["avg_hold_seconds"] = (
+        round(_pool_usage["total_hold_seconds"] / checkins, 4) if checkins else 0.0
+    )
+    status["max_hold_seconds"] = round(_pool_usage["max_hold_seconds"], 4)
+    return status
+
+
+async def release_session_connection(session: Optional[AsyncSession]) -> None:
+    """
+    Завершает текущую транзакцию сессии, чтобы соединение вернулось в пул
+    на время внешнего вызова (OpenAI, Telegram). Следующий запрос сессии
+    возьмет соединение заново (autobegin).
+
+    Важно: это commit, а не rollback - все, что хендлеры уже записали через
+    сессию, становится видимым до конца апдейта. Состояние пользователя
+    при этом не пишется: в движке оно копится в памяти (отложенная запись
+    state_manager) и сбрасывается в БД одним flush перед финальным commit.
+    Объекты после commit не истекают (expire_on_commit=False).
+    """
+    if session is None or not session.in_transaction():
+        return
+    await session.commit()
+
+
+# === END BLOCK 16 ===
@@ -0,0 +1,89 @@
+# database/user_profiles.py
+# Кэш профилей UserData между апдейтами: язык пользователя без session.get в каждом действии
+
+# === BLOCK 1: Imports ===
+import logging
+from typing import Dict, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.models import UserData
+from utils.ttl_cache import TTLCache
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Profile ===
+USER_PROFILE_CACHE_TTL = 300.0  # секунд
+USER_PROFILE_CACHE_MAX_USERS = 10000
+
+# Язык названий услуг и текстов в хендлерах регистрации
+DEFAULT_DISPLAY_LANG = "ru"
+
+
+def resolve_display_lang(language_code: Optional[str]) -> str:
+    """uk* -> 'uk', en* -> 'en', иначе DEFAULT_DISPLAY_LANG (как было в хендлерах)."""
+    if language_code:
+        if language_code.startswith("uk"):
+            return "uk"
+        if language_code.startswith("en"):
+            return "en"
+    return DEFAULT_DISPLAY_LANG
+
+
+class UserProfile:
+    """Неизменяемая копия полей UserData, нужных действиям и хендлерам."""
+
+    __slots__ = ("user_id", "username", "first_name", "language_code", "display_lang")
+
+    def __init__(self, user: UserData) -> None:
+        self.user_id: int = user.user_id
+        self.username: Optional[str] = user.username
+        self.first_name: Optional[str] = user.first_name
+        # Как в БД: для _get_instruction_text и AI
+        self.language_code: Optional[str] = user.language_code
+        # Разрешенный язык отображения
+        self.display_lang: str = resolve_display_lang(user.language_code)
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Process-Wide Cache ===
+# Профиль меняет только get_or_create_user (/start), он же обновляет кэш.
+# Изменения из другого процесса видны не позже чем через USER_PROFILE_CACHE_TTL.
+# is_admin/is_banned сюда намеренно не входят - права проверяются по БД.
+_profile_cache: TTLCache[int, UserProfile] = TTLCache(
+    USER_PROFILE_CACHE_MAX_USERS, USER_PROFILE_CACHE_TTL
+)
+
+
+async def get_user_profile(session: AsyncSession, user_id: int) -> Optional[UserProfile]:
+    """Профиль из кэша; при промахе - session.get(UserData) и запоминание. None - пользователя нет."""
+    profile = _profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+    user = await session.get(UserData, user_id)
+    if user is None:
+        return None
+    return remember_user_profile(user)
+
+
+def remember_user_profile(user: UserData) -> UserProfile:
+    """Кладет в кэш свежий профиль (после записи UserData)."""
+    profile = UserProfile(user)
+    _profile_cache.set(profile.user_id, profile)
+    return profile
+
+
+def invalidate_user_profile(user_id: int) -> None:
+    if _profile_cache.pop(user_id) is not None:
+        logger.debug(f"UserProfiles: профиль {user_id} удален из кэша.")
+
+
+def get_user_profile_cache_stats() -> Dict[str, int]:
+    return _profile_cache.get_stats()
+# === END BLOCK 4 ===
@@ -20,6 +20,21 @@ from telegram import Update, constants
 from telegram.ext import ContextTypes
 from yaml import YAMLError  # Для ошибок YAML
 
+from ai.gateway import ai_gateway
+from ai.request_coalescer import ai_request_coalescer
+from ai.response_cache import ai_response_cache
+from BehaviorEngine.callback_ack import get_callback_ack_stats
+from BehaviorEngine.compiler import compile_scenario
+from BehaviorEngine.executor import ACTION_HANDLERS, get_pre_classify_stats
+from BehaviorEngine.parser import (
+    SCENARIO_CACHE_CHANNEL,
+    build_scenario_notify_payload,
+    clear_scenario_cache,
+)
+from BehaviorEngine.update_queue import get_update_queue_stats
+from data.instructions import notify_instructions_changed, refresh_instructions_catalog
+from database.cache_sync import notify_cache_change
+
 # Импортируем все модели, используемые в этом файле (отсортировано I001)
 from database.models import (
     ConversationScenario,  # Модель сценариев
@@ -27,6 +42,8 @@ from database.models import (
     RegistrationCodes,
     UserData,
 )
+from database.user_profiles import get_user_profile_cache_stats
+from utils.outbound_scheduler import BULK_RATE_LIMIT_ARGS
 
 
 # Отдельная функция-заглушка для escape_md
@@ -184,7 +201,9 @@ async def view_registration_codes(
             if not part.strip():
                 continue
             await update.message.reply_text(
-                part, parse_mode=constants.ParseMode.MARKDOWN_V2
+                part,
+                parse_mode=constants.ParseMode.MARKDOWN_V2,
+                rate_limit_args=BULK_RATE_LIMIT_ARGS,  # Многочастный отчет - низкий приоритет
             )
     except Exception as send_err:
         logger.error(
@@ -415,7 +434,11 @@ async def handle_codes_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         for _i, part in enumerate(final_report_messages):
             if not part.strip():
                 continue
-            await message.reply_text(part, parse_mode=constants.ParseMode.MARKDOWN_V2)
+            await message.reply_text(
+                part,
+                parse_mode=constants.ParseMode.MARKDOWN_V2,
+                rate_limit_args=BULK_RATE_LIMIT_ARGS,  # Многочастный отчет - низкий приоритет
+            )
     except Exception as send_err:
         logger.error(
             f"Ошибка отправки отчета админу {user_id}: {send_err}", exc_info=True
@@ -519,7 +542,9 @@ async def view_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if not part.strip():
                 continue
             await update.message.reply_text(
-                part, parse_mode=constants.ParseMode.MARKDOWN_V2
+                part,
+                parse_mode=constants.ParseMode.MARKDOWN_V2,
+                rate_limit_args=BULK_RATE_LIMIT_ARGS,  # Многочастный отчет - низкий приоритет
             )
     except Exception as send_err:
         # Строка лога разбита для E501
@@ -633,6 +658,17 @@ async def handle_instructions_file(
     error_message = "Функционал обработки CSV еще не реализован."  # Пример
     # --- Конец временной заглушки ---
 
+    # Каталог текстов (data.instructions): этот процесс перечитывает сразу,
+    # остальные - по NOTIFY после commit
+    try:
+        async with session_maker() as session, session.begin():
+            await notify_instructions_changed(session)
+            await refresh_instructions_catalog(session)
+    except Exception as catalog_err:
+        logger.error(
+            f"Не удалось обновить каталог инструкций: {catalog_err}", exc_info=True
+        )
+
     # Формирование отчета
     try:
         from utils.message_utils import escape_md
@@ -682,7 +718,9 @@ async def handle_instructions_file(
             if not part.strip():
                 continue
             await update.message.reply_text(
-                part, parse_mode=constants.ParseMode.MARKDOWN_V2
+                part,
+                parse_mode=constants.ParseMode.MARKDOWN_V2,
+                rate_limit_args=BULK_RATE_LIMIT_ARGS,  # Многочастный отчет - низкий приоритет
             )
     except Exception as send_err:  # Fallback
         # --- ИСПРАВЛЕННАЯ СТРОКА (была ~652, теперь может чуть сместиться) ---
@@ -835,6 +873,7 @@ async def handle_scenario_file(
     processed_key = "N/A"
     new_version = 0
     existing_scenario_version = 0  # Для отчета
+    compile_problems: typing.List[str] = []  # Некритичные проблемы компиляции
 
     try:
         # Скачивание
@@ -879,6 +918,17 @@ async def handle_scenario_file(
         if not scenario_key or not name:
             raise ValueError("Ключи 'scenario_key' и 'name' не могут быть пустыми.")
 
+        # Компиляция: функции call_handler разрешаются сейчас, а не при первом
+        # обращении пользователя. Ненайденный хендлер - ошибка загрузки.
+        compiled_scenario = compile_scenario(
+            scenario_key, scenario_data, ACTION_HANDLERS, compile_problems
+        )
+        if compiled_scenario.unresolved_handlers:
+            raise ValueError(
+                "Не найдены функции call_handler: "
+                f"{', '.join(compiled_scenario.unresolved_handlers)}"
+            )
+
         # --- Взаимодействие с БД ---
         logger.debug(f"Поиск/Обновление/Вставка сценария '{scenario_key}' в БД...")
         # Комментарий перенесен на строку выше для исправления E501
@@ -928,6 +978,15 @@ async def handle_scenario_file(
                 await session.flush()
                 added_count = 1
                 logger.info(f"Добавлен новый сценарий '{scenario_key}' v{new_version}.")
+
+            # Остальные процессы бота сбросят кэш после commit (LISTEN/NOTIFY)
+            await notify_cache_change(
+                session,
+                SCENARIO_CACHE_CHANNEL,
+                build_scenario_notify_payload(scenario_key, new_version),
+            )
+        # И в этом процессе - сразу, не дожидаясь NOTIFY
+        clear_scenario_cache(scenario_key)
         logger.info(f"Операция с БД для сценария '{scenario_key}' завершена успешно.")
 
     # --- Обработка ВСЕХ возможных ошибок ---
@@ -983,6 +1042,11 @@ async def handle_scenario_file(
             )
         if added_count == 0 and updated_count == 0 and not error_message:
             report_text += "\\_\\(Изменений не внесено\\)_"
+        if compile_problems:
+            report_text += (
+                f"\\- Предупреждений компиляции: {len(compile_problems)} "
+                "\\(подробности в логе\\)\n"
+            )
 
     plain_fallback_text = (
         f"Обработка файла {doc.file_name} завершена. "
@@ -1010,3 +1074,90 @@ async def handle_scenario_file(
 
 
 # === END BLOCK 8 ===
+
+
+# === BLOCK 9: Runtime Stats ===
+# Счетчики подсистем для /bot_stats: (заголовок, функция без аргументов -> dict)
+_STATS_SECTIONS: list[tuple[str, typing.Callable[[], typing.Mapping[str, typing.Any]]]] = [
+    ("Очередь апдейтов", get_update_queue_stats),
+    ("Ответы на callback_query", get_callback_ack_stats),
+    ("Кэш профилей пользователей", get_user_profile_cache_stats),
+    ("Кэш ответов AI", ai_response_cache.get_stats),
+    ("Объединение запросов к AI", ai_request_coalescer.get_stats),
+    ("AI-шлюз", ai_gateway.get_stats),
+    ("pre_classify перед call_ai", get_pre_classify_stats),
+]
+_STATS_MAX_LIST_ITEMS = 20
+
+
+def _format_stats_value(value: typing.Any) -> str:
+    if isinstance(value, float):
+        return f"{value:.4f}"
+    if isinstance(value, typing.Mapping):
+        return ", ".join(f"{k}={_format_stats_value(v)}" for k, v in value.items())
+    return str(value)
+
+
+def _format_stats_section(title: str, stats: typing.Mapping[str, typing.Any]) -> str:
+    lines = [f"{title}:"]
+    for key, value in stats.items():
+        if isinstance(value, list):
+            lines.append(f"  {key}: {len(value)}")
+            lines.extend(
+                f"    - {_format_stats_value(item)}"
+                for item in value[:_STATS_MAX_LIST_ITEMS]
+            )
+        else:
+            lines.append(f"  {key}: {_format_stats_value(value)}")
+    return "\n".join(lines)
+
+
+async def view_bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /bot_stats - счетчики очереди апдейтов, кэшей и AI-шлюза текущего процесса.
+    /bot_stats <user_id> - очередь и время ожидания одного пользователя.
+    """
+    if not update or not update.effective_user or not update.message:
+        return
+    user_id = update.effective_user.id
+    session_maker = context.bot_data.get("session_maker")
+    if not await _is_admin(user_id, session_maker):
+        await update.message.reply_text("Нет прав.")
+        return
+
+    if context.args:
+        try:
+            target_user_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Использование: /bot_stats [user_id]")
+            return
+        user_stats = get_update_queue_stats(target_user_id)
+        if user_stats is None:
+            await update.message.reply_text(
+                f"Нет статистики очереди для пользователя {target_user_id}."
+            )
+            return
+        await update.message.reply_text(
+            _format_stats_section(f"Очередь пользователя {target_user_id}", user_stats)
+        )
+        return
+
+    sections = []
+    for title, get_stats in _STATS_SECTIONS:
+        try:
+            sections.append(_format_stats_section(title, get_stats()))
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики '{title}': {e}", exc_info=True)
+            sections.append(f"{title}: ошибка ({type(e).__name__})")
+
+    reply_parts = [""]
+    max_part_len = 4000
+    for section in sections:
+        if reply_parts[-1] and len(reply_parts[-1]) + len(section) > max_part_len:
+            reply_parts.append("")
+        reply_parts[-1] += section[:max_part_len] + "\n\n"
+    for part in reply_parts:
+        await update.message.reply_text(part, rate_limit_args=BULK_RATE_LIMIT_ARGS)
+
+
+# === END BLOCK 9 ===
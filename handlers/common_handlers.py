@@ -9,6 +9,7 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from BehaviorEngine.state_manager import reset_user_state
+from database.last_seen import last_seen_tracker
 
 logger = logging.getLogger(__name__)
 
@@ -115,3 +116,17 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 # === END BLOCK (cancel function) ===
+
+
+# === BLOCK (track_user_activity): Отметка активности пользователя ===
+async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Для любого апдейта с пользователем отмечает last_seen в памяти
+    (database.last_seen); в БД отметки уходят пачкой раз в интервал.
+    Регистрируется TypeHandler'ом в группе -1, ничего не блокирует.
+    """
+    if update.effective_user:
+        last_seen_tracker.touch(update.effective_user.id)
+
+
+# === END BLOCK (track_user_activity) ===
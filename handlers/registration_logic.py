@@ -8,9 +8,6 @@ import time
 from contextlib import suppress
 from typing import Any, Dict, List, Optional
 
-import telegram 
-
-from sqlalchemy import select, func
 from sqlalchemy.sql.expression import literal_column
 
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -37,8 +34,27 @@ except ImportError:
         return "Mocked instruction text"
 
 try:
-    from BehaviorEngine.state_manager import reset_user_state, update_user_state
-    from database.models import Services, UserData, UserStates 
+    from BehaviorEngine.callback_ack import answer_callback, register_deferred_answer
+    from BehaviorEngine.state_manager import (
+        defers_state_writes,
+        release_connection_for_io,
+        reset_user_state,
+        update_user_state,
+    )
+    from data.services import (
+        get_services_snapshot,
+        resolve_service_names,
+        resolve_service_nodes,
+    )
+    from database.models import Services, UserData, UserStates
+    from database.user_profiles import DEFAULT_DISPLAY_LANG, get_user_profile
+    from keyboards.sub_service_toggles import (
+        build_sub_service_keyboard,
+        children_version,
+        read_toggles_from_markup,
+        selection_from_mask,
+    )
+    from utils.edit_coalescer import edit_coalescer
     if '_HANDLER_INITIATED_SWITCH_FLAG' not in globals(): 
         _HANDLER_INITIATED_SWITCH_FLAG = "handler_initiated_scenario_switch"
 except ImportError:
@@ -50,12 +66,32 @@ except ImportError:
     class UserStates: pass
     async def update_user_state(*args, **kwargs): pass
     async def reset_user_state(*args, **kwargs): pass
+    async def get_services_snapshot(*args, **kwargs): raise RuntimeError("Services snapshot is unavailable (import error)")
+    async def resolve_service_names(*args, **kwargs) -> Dict[int, str]: return {}
+    async def resolve_service_nodes(*args, **kwargs) -> Dict[int, Any]: return {}
+    def build_sub_service_keyboard(*args, **kwargs): return None
+    def children_version(*args, **kwargs) -> str: return ""
+    def read_toggles_from_markup(*args, **kwargs) -> Optional[tuple]: return None
+    def selection_from_mask(*args, **kwargs) -> List[int]: return []
+    def defers_state_writes(*args, **kwargs) -> bool: return False
+    async def release_connection_for_io(*args, **kwargs) -> bool: return False
+    DEFAULT_DISPLAY_LANG = "ru"
+    async def get_user_profile(*args, **kwargs): return None
+    async def answer_callback(query, text=None, show_alert=False) -> bool:
+        await query.answer(text=text, show_alert=show_alert)
+        return True
+    def register_deferred_answer(*args, **kwargs): pass
 
 
 CALLBACK_CONFIRM_CITY_PREFIX = "confirm_city_reg:"
+
+# Эти хендлеры отвечают на нажатие с всплывающим текстом - ранний ответ движка их ждет
+register_deferred_answer(r"^reg_category_done:")
+register_deferred_answer(r"^reg_skip_top_service:")
+register_deferred_answer(r"^reg_add_direct_service:")
 # === END BLOCK 1 ===
 
-# === BLOCK 2: Вспомогательная функция для получения дочерних услуг (ОПТИМИЗИРОВАННАЯ с логированием времени) ===
+# === BLOCK 2: Вспомогательная функция для получения дочерних услуг (из снимка Services, без запросов к БД) ===
 async def get_service_children(
     session: AsyncSession, parent_service_id: Optional[int], lang_code: str
 ) -> List[Dict[str, Any]]:
@@ -68,54 +104,12 @@ async def get_service_children(
         return children_services
     
     try:
-        db_call_children_start_time = time.monotonic()
-        # 1. Получаем всех прямых выбираемых детей
-        stmt_children = (
-            select(Services)
-            .where(
-                Services.parent_id == parent_service_id,
-                Services.is_selectable_by_master.is_(True)
-            )
-            .order_by(Services.service_id)
-        )
-        children_result = await session.execute(stmt_children)
-        db_children_services = children_result.scalars().all()
-        logger_func.debug(f"RegLogic: get_service_children - DB select children took {time.monotonic() - db_call_children_start_time:.4f}s. Found {len(db_children_services)} children.")
-        
-        parents_with_grand_children_ids = set()
-        if db_children_services:
-            child_ids = [child.service_id for child in db_children_services]
-            
-            db_call_grandchildren_start_time = time.monotonic()
-            # 2. Одним запросом проверяем, у каких из этих детей есть выбираемые внуки
-            stmt_grand_children_parents = (
-                select(Services.parent_id.distinct()) 
-                .where(
-                    Services.parent_id.in_(child_ids), 
-                    Services.is_selectable_by_master.is_(True) 
-                )
-            )
-            grand_children_parents_result = await session.execute(stmt_grand_children_parents)
-            parents_with_grand_children_ids = set(grand_children_parents_result.scalars().all())
-            logger_func.debug(f"RegLogic: get_service_children - DB select grandchildren existence took {time.monotonic() - db_call_grandchildren_start_time:.4f}s. Parents with grandchildren: {len(parents_with_grand_children_ids)}")
-
-            for child_service in db_children_services:
-                display_name = (
-                    getattr(child_service, f"name_{lang_code.lower()}", None)
-                    or getattr(child_service, "name_en", None)
-                    or child_service.name_key
-                )
-                has_grand_children_flag = child_service.service_id in parents_with_grand_children_ids
-                
-                children_services.append(
-                    {
-                        "service_id": child_service.service_id,
-                        "name_key": child_service.name_key,
-                        "display_name": display_name,
-                        "has_children": has_grand_children_flag,
-                        "is_selectable_by_master": child_service.is_selectable_by_master
-                    }
-                )
+        # Выбираемые дети и флаг has_children (есть ли выбираемые внуки) уже посчитаны в снимке
+        services_snapshot = await get_services_snapshot(session)
+        children_services = [
+            child_node.as_child_dict(lang_code)
+            for child_node in services_snapshot.selectable_children(parent_service_id)
+        ]
     except Exception as e:
         logger_func.error(
             f"RegLogic: Error fetching children for parent_id {parent_service_id}: {e}",
@@ -233,8 +227,8 @@ async def handle_city_confirmation_callback(
     
     try:
         answer_start_time = time.monotonic()
-        await query.answer()
-        logger.debug(f"RegLogic: query.answer() in handle_city_confirmation_callback took {time.monotonic() - answer_start_time:.4f}s")
+        await answer_callback(query)
+        logger.debug(f"RegLogic: answer_callback() in handle_city_confirmation_callback took {time.monotonic() - answer_start_time:.4f}s")
     except Exception as e_ans: 
         logger.warning(f"RegLogic: Could not answer callback in handle_city_confirmation_callback: {e_ans}")
 
@@ -338,20 +332,17 @@ async def analyze_and_match_services_initial(
     instruction_key_to_test = "classify_master_services_prompt"
     
     db_user_get_start_time = time.monotonic()
-    db_user = await session.get(UserData, user.id)
-    logger.debug(f"RegLogic: session.get(UserData) in analyze_services took {time.monotonic() - db_user_get_start_time:.4f}s")
+    user_profile = await get_user_profile(session, user.id)
+    logger.debug(f"RegLogic: get_user_profile in analyze_services took {time.monotonic() - db_user_get_start_time:.4f}s")
     
-    user_lang_code_for_display = "ru"
-    if db_user and db_user.language_code:
-        if db_user.language_code.startswith("uk"): user_lang_code_for_display = "uk"
-        elif db_user.language_code.startswith("en"): user_lang_code_for_display = "en"
+    user_lang_code_for_display = user_profile.display_lang if user_profile else DEFAULT_DISPLAY_LANG
     logger.debug(f"RegLogic: User {user_id_log} language for service display: {user_lang_code_for_display}")
     
     ai_response_json_str: Optional[str] = None
     ai_call_start_time = time.monotonic()
     try:
         logger.info(f"RegLogic: Calling AI with instruction_key='{instruction_key_to_test}' and user_reply_for_format='{master_services_text_input}' for lang='ru'")
-        ai_response_json_str = await generate_text_response(messages=[], instruction_key=instruction_key_to_test, user_reply_for_format=master_services_text_input, session=session, user_lang_code="ru")
+        ai_response_json_str = await generate_text_response(messages=[], instruction_key=instruction_key_to_test, user_reply_for_format=master_services_text_input, session=session, user_lang_code="ru", release_session_before_call=defers_state_writes(session))
         logger.info(f"RegLogic: Raw AI response string for services (user {user_id_log}): \n---\n{ai_response_json_str}\n---")
     except Exception as e:
         logger.error(f"RegLogic: Error calling AI for service classification (user {user_id_log}): {e}", exc_info=True)
@@ -396,29 +387,36 @@ async def analyze_and_match_services_initial(
     enriched_matched_services = []
     enrich_start_time = time.monotonic()
     if ai_parsed_data:
-        matched_services_from_ai = ai_parsed_data.get("matched_services", [])
+        matched_services_from_ai = [
+            ai_service for ai_service in ai_parsed_data.get("matched_services", [])
+            if isinstance(ai_service, dict) and "name_key" in ai_service
+        ]
+        # Все name_key разрешаются по снимку Services одним проходом (без запросов на каждую услугу)
+        services_snapshot = None
+        try:
+            services_snapshot = await get_services_snapshot(session)
+        except Exception as db_exc:
+            logger.error(f"RegLogic: Error getting Services snapshot for enrichment: {db_exc}", exc_info=True)
         for ai_service in matched_services_from_ai:
-            if isinstance(ai_service, dict) and "name_key" in ai_service:
-                name_key = ai_service["name_key"]
-                user_provided_text = ai_service.get("user_provided_text", "")
-                service_id_db: Optional[int] = None; display_name_db: str = f"Услуга ({name_key})"; parent_id_db: Optional[int] = None; has_children_db: bool = False; is_selectable_by_master_db: bool = False
-                try:
-                    stmt_service = select(Services).where(Services.name_key == name_key)
-                    result_service = await session.execute(stmt_service)
-                    db_service_obj = result_service.scalar_one_or_none()
-                    if db_service_obj:
-                        service_id_db = db_service_obj.service_id
-                        display_name_db = (getattr(db_service_obj, f"name_{user_lang_code_for_display.lower()}", None) or db_service_obj.name_en or name_key)
-                        parent_id_db = db_service_obj.parent_id
-                        is_selectable_by_master_db = (db_service_obj.is_selectable_by_master)
-                        stmt_children = (select(Services.service_id).where(Services.parent_id == service_id_db, Services.is_selectable_by_master.is_(True)).limit(1))
-                        result_children = await session.execute(stmt_children)
-                        if result_children.scalar_one_or_none() is not None: has_children_db = True
-                        logger.info(f"RegLogic: Enriched service '{name_key}': ID={service_id_db}, Name='{display_name_db}', HasChildren={has_children_db}, SelectableByMaster={is_selectable_by_master_db}, ParentID={parent_id_db}")
-                    else: logger.warning(f"RegLogic: Service with name_key '{name_key}' not found in DB for enrichment.")
-                except Exception as db_exc: logger.error(f"RegLogic: DB error enriching service '{name_key}': {db_exc}", exc_info=True)
-                enriched_matched_services.append({"name_key": name_key, "service_id": service_id_db, "display_name": display_name_db, "has_children": has_children_db, "parent_id": parent_id_db, "user_provided_text": user_provided_text, "is_selectable_by_master": is_selectable_by_master_db})
-    logger.debug(f"RegLogic: Service enrichment loop took {time.monotonic() - enrich_start_time:.4f}s")
+            name_key = ai_service["name_key"]
+            user_provided_text = ai_service.get("user_provided_text", "")
+            service_id_db: Optional[int] = None
+            display_name_db: str = f"Услуга ({name_key})"
+            parent_id_db: Optional[int] = None
+            has_children_db: bool = False
+            is_selectable_by_master_db: bool = False
+            service_node = services_snapshot.get_by_name_key(name_key) if services_snapshot else None
+            if service_node:
+                service_id_db = service_node.service_id
+                display_name_db = service_node.display_name(user_lang_code_for_display)
+                parent_id_db = service_node.parent_id
+                is_selectable_by_master_db = service_node.is_selectable_by_master
+                has_children_db = service_node.has_children
+                logger.info(f"RegLogic: Enriched service '{name_key}': ID={service_id_db}, Name='{display_name_db}', HasChildren={has_children_db}, SelectableByMaster={is_selectable_by_master_db}, ParentID={parent_id_db}")
+            else:
+                logger.warning(f"RegLogic: Service with name_key '{name_key}' not found in DB for enrichment.")
+            enriched_matched_services.append({"name_key": name_key, "service_id": service_id_db, "display_name": display_name_db, "has_children": has_children_db, "parent_id": parent_id_db, "user_provided_text": user_provided_text, "is_selectable_by_master": is_selectable_by_master_db})
+    logger.debug(f"RegLogic: Service enrichment (snapshot lookup) took {time.monotonic() - enrich_start_time:.4f}s")
 
     next_step = "REG_MASTER_ASK_SERVICES_AGAIN" 
     if ai_parsed_data:
@@ -515,12 +513,9 @@ async def prepare_service_suggestions_message(
     logger.debug(f"RegLogic: Auto-detailing logic in prepare_suggestions took {time.monotonic() - auto_detail_start_time:.4f}s")
         
     get_user_db_start_time = time.monotonic()
-    db_user = await session.get(UserData, user.id)
-    logger.debug(f"RegLogic: session.get(UserData) in prepare_suggestions took {time.monotonic() - get_user_db_start_time:.4f}s")
-    user_lang_code_for_display = "ru" 
-    if db_user and db_user.language_code:
-        if db_user.language_code.startswith("uk"): user_lang_code_for_display = "uk"
-        elif db_user.language_code.startswith("en"): user_lang_code_for_display = "en"
+    user_profile = await get_user_profile(session, user.id)
+    logger.debug(f"RegLogic: get_user_profile in prepare_suggestions took {time.monotonic() - get_user_db_start_time:.4f}s")
+    user_lang_code_for_display = user_profile.display_lang if user_profile else DEFAULT_DISPLAY_LANG
 
     message_text = ""
     keyboard_buttons = []
@@ -528,17 +523,16 @@ async def prepare_service_suggestions_message(
     if query: 
         try:
             q_answer_start_time = time.monotonic()
-            await query.answer()
-            logger.debug(f"RegLogic: query.answer() in prepare_service_suggestions_message took {time.monotonic() - q_answer_start_time:.4f}s")
+            await answer_callback(query)
+            logger.debug(f"RegLogic: answer_callback() in prepare_service_suggestions_message took {time.monotonic() - q_answer_start_time:.4f}s")
         except Exception as e_ans:
             logger.warning(f"RegLogic: prepare_service_suggestions_message: Could not answer query: {e_ans}")
 
     # --- Логика отображения текущей детализируемой категории ---
     build_kbd_start_time = time.monotonic()
     if current_category_id_detailed:
-        get_parent_start_time = time.monotonic()
-        parent_service_obj = await session.get(Services, current_category_id_detailed)
-        logger.debug(f"RegLogic: session.get(Services) for parent took {time.monotonic() - get_parent_start_time:.4f}s")
+        services_snapshot = await get_services_snapshot(session)
+        parent_service_obj = services_snapshot.get(current_category_id_detailed)
 
         if not parent_service_obj:
             logger.error(f"RegLogic: User {user_id_log}: Parent service ID {current_category_id_detailed} for detailing not found. Clearing detail state.")
@@ -546,7 +540,7 @@ async def prepare_service_suggestions_message(
             logger.debug(f"RegLogic: prepare_service_suggestions_message total took {time.monotonic() - func_start_time:.4f}s (parent not found)")
             return context_updates_to_return
 
-        parent_display_name = (getattr(parent_service_obj, f"name_{user_lang_code_for_display.lower()}", None) or getattr(parent_service_obj, "name_en", None) or parent_service_obj.name_key)
+        parent_display_name = parent_service_obj.display_name(user_lang_code_for_display)
         
         get_children_start_time = time.monotonic()
         children_services = await get_service_children(session, current_category_id_detailed, user_lang_code_for_display) # Уже логирует время внутри
@@ -568,11 +562,23 @@ async def prepare_service_suggestions_message(
             message_text = f"Категория: **{parent_display_name}**.\nВыберите уточняющие услуги (можно несколько, повторное нажатие меняет выбор):"
             selections_for_this_cat = current_category_selections.get(str(current_category_id_detailed), [])
             logger.debug(f"RegLogic: User {user_id_log}: Rendering sub-services for {parent_display_name} (ID {current_category_id_detailed}). Current selections for it: {selections_for_this_cat}")
-            for child in children_services:
-                is_selected = child["service_id"] in selections_for_this_cat
-                button_text = f"{'✅ ' if is_selected else '☑️ '} {child['display_name']}"
-                keyboard_buttons.append([InlineKeyboardButton(button_text, callback_data=f"reg_toggle_sub_service:{child['service_id']}:{current_category_id_detailed}")])
-            keyboard_buttons.append([InlineKeyboardButton(f"👍 Готово с '{parent_display_name}'", callback_data=f"reg_category_done:{current_category_id_detailed}")])
+            done_button_text = f"👍 Готово с '{parent_display_name}'"
+            # Выбор хранится в клавиатуре (rts:-токены, handlers/service_toggles.py); в состояние - только по "Готово"
+            toggles_markup = build_sub_service_keyboard(
+                current_category_id_detailed,
+                [(child["service_id"], child["display_name"]) for child in children_services],
+                selections_for_this_cat,
+                done_button_text,
+            )
+            if toggles_markup:
+                keyboard_buttons.extend(list(row) for row in toggles_markup.inline_keyboard)
+            else:
+                # Слишком большая категория для маски в callback_data: переключение через состояние
+                for child in children_services:
+                    is_selected = child["service_id"] in selections_for_this_cat
+                    button_text = f"{'✅ ' if is_selected else '☑️ '} {child['display_name']}"
+                    keyboard_buttons.append([InlineKeyboardButton(button_text, callback_data=f"reg_toggle_sub_service:{child['service_id']}:{current_category_id_detailed}")])
+                keyboard_buttons.append([InlineKeyboardButton(done_button_text, callback_data=f"reg_category_done:{current_category_id_detailed}")])
 
     # --- Логика отображения услуг из основной очереди ---
     elif service_processing_queue:
@@ -601,29 +607,22 @@ async def prepare_service_suggestions_message(
         logger.info(f"RegLogic: User {user_id_log}: Service processing queue IS EMPTY and no category is being detailed. Finalizing service selection.")
         final_message = "Выбор услуг завершен."
         if master_selected_services:
-            selected_names = []
-            processed_ids_for_names = set()
-            for service_id_selected in master_selected_services:
-                if service_id_selected in processed_ids_for_names: continue
-                service_obj_final_start_time = time.monotonic()
-                service_obj = await session.get(Services, service_id_selected)
-                logger.debug(f"RegLogic: session.get(Services) for final list item took {time.monotonic() - service_obj_final_start_time:.4f}s")
-                if service_obj:
-                    display_name_sel = (getattr(service_obj, f"name_{user_lang_code_for_display.lower()}", None) or getattr(service_obj, "name_en", None) or service_obj.name_key)
-                    selected_names.append(f"- {display_name_sel}")
-                    processed_ids_for_names.add(service_id_selected)
+            resolve_names_start_time = time.monotonic()
+            selected_display_names = await resolve_service_names(session, master_selected_services, user_lang_code_for_display)
+            logger.debug(f"RegLogic: resolve_service_names for {len(master_selected_services)} selected services took {time.monotonic() - resolve_names_start_time:.4f}s")
+            selected_names = [f"- {display_name_sel}" for display_name_sel in selected_display_names.values()]
             if selected_names: final_message += " Вы выбрали:\n" + "\n".join(selected_names)
             else: final_message += " Вы пока не выбрали ни одной конкретной услуги."
         else: final_message += " Вы пока не выбрали ни одной конкретной услуги. Вы сможете добавить их позже."
 
         if chat_id:
+            await release_connection_for_io(session) # Дальше только Telegram API
             last_msg_id = service_suggestion_message_id 
             if last_msg_id:
-                try: 
-                    edit_markup_start_time = time.monotonic()
-                    await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=last_msg_id, reply_markup=None)
-                    logger.debug(f"RegLogic: edit_message_reply_markup (final) took {time.monotonic() - edit_markup_start_time:.4f}s")
-                except Exception as e_final_edit: logger.warning(f"RegLogic: Could not remove keyboard from final message {last_msg_id}: {e_final_edit}")
+                edit_markup_start_time = time.monotonic()
+                if not await edit_coalescer.submit(context.bot, chat_id, last_msg_id, reply_markup=None, delay=0):
+                    logger.warning(f"RegLogic: Could not remove keyboard from final message {last_msg_id}.")
+                logger.debug(f"RegLogic: edit_message_reply_markup (final) took {time.monotonic() - edit_markup_start_time:.4f}s")
             
             send_final_msg_start_time = time.monotonic()
             await context.bot.send_message(chat_id=chat_id, text=final_message)
@@ -649,31 +648,26 @@ async def prepare_service_suggestions_message(
     message_to_send = message_text if message_text else "Пожалуйста, выберите действие."
     message_id_to_edit = service_suggestion_message_id 
 
+    await release_connection_for_io(session) # Дальше только Telegram API
     send_edit_logic_start_time = time.monotonic()
     if query and query.message and message_id_to_edit == query.message.message_id:
-        try:
-            edit_msg_start_time = time.monotonic()
-            await query.edit_message_text(text=message_to_send, reply_markup=reply_markup, parse_mode="Markdown")
-            logger.debug(f"RegLogic: query.edit_message_text took {time.monotonic() - edit_msg_start_time:.4f}s")
+        # Через edit_coalescer: повтор той же разметки не уходит в API ("message is not modified"),
+        # а быстрые переключатели (handlers/service_toggles.py) видят актуальную клавиатуру
+        edit_msg_start_time = time.monotonic()
+        edited = await edit_coalescer.submit(context.bot, chat_id, message_id_to_edit, text=message_to_send, reply_markup=reply_markup, parse_mode="Markdown", delay=0)
+        logger.debug(f"RegLogic: edit_message_text (coalesced) took {time.monotonic() - edit_msg_start_time:.4f}s")
+        if edited:
             logger.info(f"RegLogic: Edited message_id {message_id_to_edit} for user {user_id_log} via query.")
             context_updates_to_return["service_suggestion_message_id"] = message_id_to_edit 
-        except telegram.error.BadRequest as e_bad_request: 
-            if "message is not modified" in str(e_bad_request).lower():
-                logger.debug(f"RegLogic: Message {message_id_to_edit} not modified. Callback already answered.")
-            else:
-                logger.warning(f"RegLogic: BadRequest editing message {message_id_to_edit} via query (user {user_id_log}): {e_bad_request}. Will try to send new.")
-                message_id_to_edit = None 
-        except Exception as e_edit:
-            logger.warning(f"RegLogic: Could not edit message {message_id_to_edit} via query (user {user_id_log}): {e_edit}. Will try to send new.")
+        else:
+            logger.warning(f"RegLogic: Could not edit message {message_id_to_edit} via query (user {user_id_log}). Will try to send new.")
             message_id_to_edit = None 
     
     if not message_id_to_edit and chat_id and (reply_markup or message_text): 
         if service_suggestion_message_id: 
-            try: 
-                edit_markup_start_time = time.monotonic()
-                await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=service_suggestion_message_id, reply_markup=None)
-                logger.debug(f"RegLogic: edit_message_reply_markup (before new) took {time.monotonic() - edit_markup_start_time:.4f}s")
-            except Exception: pass
+            edit_markup_start_time = time.monotonic()
+            await edit_coalescer.submit(context.bot, chat_id, service_suggestion_message_id, reply_markup=None, delay=0)
+            logger.debug(f"RegLogic: edit_message_reply_markup (before new) took {time.monotonic() - edit_markup_start_time:.4f}s")
         
         send_new_msg_start_time = time.monotonic()
         sent_message = await context.bot.send_message(chat_id=chat_id, text=message_to_send, reply_markup=reply_markup, parse_mode="Markdown")
@@ -681,13 +675,12 @@ async def prepare_service_suggestions_message(
         context_updates_to_return["service_suggestion_message_id"] = sent_message.message_id
         logger.info(f"RegLogic: Sent NEW service suggestions message (ID: {sent_message.message_id}) to user {user_id_log}.")
     elif chat_id and not reply_markup and message_id_to_edit : 
-        try:
-            edit_text_start_time = time.monotonic()
-            await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id_to_edit, text=message_to_send, reply_markup=None, parse_mode="Markdown")
+        edit_text_start_time = time.monotonic()
+        if await edit_coalescer.submit(context.bot, chat_id, message_id_to_edit, text=message_to_send, reply_markup=None, parse_mode="Markdown", delay=0):
             logger.debug(f"RegLogic: edit_message_text (remove kbd) took {time.monotonic() - edit_text_start_time:.4f}s")
             context_updates_to_return["service_suggestion_message_id"] = message_id_to_edit 
             logger.info(f"RegLogic: Edited message {message_id_to_edit} to remove keyboard.")
-        except Exception:
+        else:
             logger.warning(f"RegLogic: Could not edit message {message_id_to_edit} to remove keyboard.")
             context_updates_to_return["service_suggestion_message_id"] = None 
     
@@ -712,14 +705,15 @@ async def handle_detail_category(
     if not query or not query.data or not query.data.startswith("reg_detail_category:"):
         logger.warning(f"RegLogic: User {user_id_log}: handle_detail_category called with invalid data: {query.data if query else 'No query'}")
         if query: 
-            with suppress(Exception): await query.answer("Ошибка: нет данных.", show_alert=True) # Answer once
+            with suppress(Exception):
+                await answer_callback(query, "Ошибка: нет данных.", show_alert=True) # Answer once
         logger.debug(f"RegLogic: handle_detail_category took {time.monotonic() - func_start_time:.4f}s (invalid data)")
         return None 
 
     try:
         answer_start_time = time.monotonic()
-        await query.answer() 
-        logger.debug(f"RegLogic: query.answer() in handle_detail_category took {time.monotonic() - answer_start_time:.4f}s")
+        await answer_callback(query)
+        logger.debug(f"RegLogic: answer_callback() in handle_detail_category took {time.monotonic() - answer_start_time:.4f}s")
     except Exception as e_ans:
         logger.warning(f"RegLogic: handle_detail_category: Could not answer query: {e_ans}")
         
@@ -757,14 +751,15 @@ async def handle_toggle_sub_service(
     if (not query or not query.data or not query.data.startswith("reg_toggle_sub_service:")):
         logger.warning(f"RegLogic: User {user_id_log}: handle_toggle_sub_service called with invalid data: {query.data if query else 'No query'}")
         if query: 
-            with suppress(Exception): await query.answer("Ошибка обработки выбора.", show_alert=True)
+            with suppress(Exception):
+                await answer_callback(query, "Ошибка обработки выбора.", show_alert=True)
         logger.debug(f"RegLogic: handle_toggle_sub_service took {time.monotonic() - func_start_time:.4f}s (invalid data)")
         return None
 
     try:
         answer_start_time = time.monotonic()
-        await query.answer() 
-        logger.debug(f"RegLogic: query.answer() in handle_toggle_sub_service took {time.monotonic() - answer_start_time:.4f}s")
+        await answer_callback(query)
+        logger.debug(f"RegLogic: answer_callback() in handle_toggle_sub_service took {time.monotonic() - answer_start_time:.4f}s")
     except Exception as e_ans:
         logger.warning(f"RegLogic: handle_toggle_sub_service: Could not answer query: {e_ans}")
         
@@ -809,17 +804,11 @@ async def handle_category_done(
     if not query or not query.data or not query.data.startswith("reg_category_done:"):
         logger.warning(f"RegLogic: User {user_id_log}: handle_category_done called with invalid data: {query.data if query else 'No query'}")
         if query: 
-            with suppress(Exception): await query.answer("Ошибка обработки.", show_alert=True)
+            with suppress(Exception):
+                await answer_callback(query, "Ошибка обработки.", show_alert=True)
         logger.debug(f"RegLogic: handle_category_done took {time.monotonic() - func_start_time:.4f}s (invalid data)")
         return None 
 
-    try:
-        answer_start_time = time.monotonic()
-        await query.answer("Выбор в категории сохранен.") 
-        logger.debug(f"RegLogic: query.answer() in handle_category_done took {time.monotonic() - answer_start_time:.4f}s")
-    except Exception as e_ans:
-        logger.warning(f"RegLogic: handle_category_done: Could not answer query: {e_ans}")
-
     try:
         parent_id_done_str = query.data.split(":")[1]
         parent_id_done = int(parent_id_done_str)
@@ -833,18 +822,44 @@ async def handle_category_done(
     master_selected_services_copy = state_context.get("master_selected_services", []).copy()
     service_processing_queue_copy = state_context.get("service_processing_queue", []).copy()
     selections_for_this_done_category = current_category_selections_from_context.get(str(parent_id_done), [])
+    # Клавиатура с масками (rts:-токены): выбор берем из нее, а не из состояния
+    # (последняя версия клавиатуры может еще ждать отправки в edit_coalescer)
+    done_markup = None
+    if query.message:
+        done_markup = edit_coalescer.latest_markup(query.message.chat_id, query.message.message_id) or query.message.reply_markup
+    toggles = read_toggles_from_markup(done_markup, parent_id_done)
+    if toggles is not None:
+        toggles_version, toggles_mask = toggles
+        services_snapshot = await get_services_snapshot(session)
+        children_ids = [child_node.service_id for child_node in services_snapshot.selectable_children(parent_id_done)]
+        if toggles_version != children_version(children_ids):
+            # Services обновились после отрисовки: биты маски указывают на других детей.
+            # Категорию не закрываем - она будет показана заново по текущему снимку.
+            logger.warning(f"RegLogic: User {user_id_log}: Stale toggles keyboard for category {parent_id_done} (version {toggles_version}). Re-rendering category.")
+            with suppress(Exception):
+                await answer_callback(query, "Список услуг обновился. Отметьте, пожалуйста, услуги заново.", show_alert=True)
+            context_updates_to_return["current_category_being_detailed_id"] = parent_id_done
+            logger.debug(f"RegLogic: handle_category_done took {time.monotonic() - func_start_time:.4f}s (stale keyboard)")
+            return context_updates_to_return
+        selections_for_this_done_category = selection_from_mask(children_ids, toggles_mask)
+        logger.debug(f"RegLogic: User {user_id_log}: Selections for category {parent_id_done} from keyboard mask {toggles_mask}: {selections_for_this_done_category}")
+
+    try:
+        answer_start_time = time.monotonic()
+        await answer_callback(query, "Выбор в категории сохранен.")
+        logger.debug(f"RegLogic: answer_callback() in handle_category_done took {time.monotonic() - answer_start_time:.4f}s")
+    except Exception as e_ans:
+        logger.warning(f"RegLogic: handle_category_done: Could not answer query: {e_ans}")
 
     for sub_service_id in selections_for_this_done_category:
         if sub_service_id not in master_selected_services_copy:
             master_selected_services_copy.append(sub_service_id)
 
     if not selections_for_this_done_category: 
-        get_parent_obj_start_time = time.monotonic()
-        parent_service_obj = await session.get(Services, parent_id_done)
-        logger.debug(f"RegLogic: session.get(Services) in category_done took {time.monotonic() - get_parent_obj_start_time:.4f}s")
+        parent_service_obj = (await resolve_service_nodes(session, [parent_id_done])).get(parent_id_done)
         if (parent_service_obj and parent_service_obj.is_selectable_by_master and parent_service_obj.service_id not in master_selected_services_copy):
             master_selected_services_copy.append(parent_service_obj.service_id)
-            logger.info(f"RegLogic: User {user_id_log}: No sub-services selected for '{getattr(parent_service_obj, 'name_ru', parent_service_obj.name_key)}', adding parent category itself (ID: {parent_id_done}) as it's selectable.")
+            logger.info(f"RegLogic: User {user_id_log}: No sub-services selected for '{parent_service_obj.display_name('ru')}', adding parent category itself (ID: {parent_id_done}) as it's selectable.")
 
     context_updates_to_return["master_selected_services"] = master_selected_services_copy
     logger.info(f"RegLogic: User {user_id_log}: Current master_selected_services after category {parent_id_done}: {master_selected_services_copy}")
@@ -879,14 +894,15 @@ async def handle_skip_top_service(
     if (not query or not query.data or not query.data.startswith("reg_skip_top_service:")):
         logger.warning(f"RegLogic: User {user_id_log}: handle_skip_top_service called with invalid data: {query.data if query else 'No query'}")
         if query: 
-            with suppress(Exception): await query.answer("Ошибка обработки.", show_alert=True)
+            with suppress(Exception):
+                await answer_callback(query, "Ошибка обработки.", show_alert=True)
         logger.debug(f"RegLogic: handle_skip_top_service took {time.monotonic() - func_start_time:.4f}s (invalid data)")
         return None
 
     try:
         answer_start_time = time.monotonic()
-        await query.answer("Услуга/категория пропущена.") 
-        logger.debug(f"RegLogic: query.answer() in handle_skip_top_service took {time.monotonic() - answer_start_time:.4f}s")
+        await answer_callback(query, "Услуга/категория пропущена.")
+        logger.debug(f"RegLogic: answer_callback() in handle_skip_top_service took {time.monotonic() - answer_start_time:.4f}s")
     except Exception as e_ans:
         logger.warning(f"RegLogic: handle_skip_top_service: Could not answer query: {e_ans}")
 
@@ -936,7 +952,8 @@ async def handle_add_direct_service(
     if (not query or not query.data or not query.data.startswith("reg_add_direct_service:")):
         logger.warning(f"RegLogic: User {user_id_log}: handle_add_direct_service called with invalid data: {query.data if query else 'No query'}")
         if query: 
-            with suppress(Exception): await query.answer("Ошибка обработки.", show_alert=True)
+            with suppress(Exception):
+                await answer_callback(query, "Ошибка обработки.", show_alert=True)
         logger.debug(f"RegLogic: handle_add_direct_service took {time.monotonic() - func_start_time:.4f}s (invalid data)")
         return None
     
@@ -946,7 +963,8 @@ async def handle_add_direct_service(
     except (IndexError, ValueError):
         logger.error(f"RegLogic: User {user_id_log}: Invalid service_id in callback for add_direct_service: {query.data}")
         if query: 
-            with suppress(Exception): await query.answer("Ошибка: неверный ID услуги.", show_alert=True)
+            with suppress(Exception):
+                await answer_callback(query, "Ошибка: неверный ID услуги.", show_alert=True)
         logger.debug(f"RegLogic: handle_add_direct_service took {time.monotonic() - func_start_time:.4f}s (parse error)")
         return None
 
@@ -959,19 +977,14 @@ async def handle_add_direct_service(
         master_selected_services_copy.append(service_id_to_add)
         context_updates_to_return["master_selected_services"] = master_selected_services_copy
         
-        get_service_obj_start_time = time.monotonic()
-        service_obj = await session.get(Services, service_id_to_add)
-        logger.debug(f"RegLogic: session.get(Services) in add_direct_service took {time.monotonic() - get_service_obj_start_time:.4f}s")
+        service_obj = (await resolve_service_nodes(session, [service_id_to_add])).get(service_id_to_add)
 
         if service_obj:
             db_user_for_lang_start_time = time.monotonic()
-            db_user_for_lang = await session.get(UserData, user.id)
-            logger.debug(f"RegLogic: session.get(UserData) for lang in add_direct_service took {time.monotonic() - db_user_for_lang_start_time:.4f}s")
-            user_lang_code_add = "ru"
-            if db_user_for_lang and db_user_for_lang.language_code:
-                if db_user_for_lang.language_code.startswith("uk"): user_lang_code_add = "uk"
-                elif db_user_for_lang.language_code.startswith("en"): user_lang_code_add = "en"
-            service_display_name_for_answer = (getattr(service_obj, f"name_{user_lang_code_add.lower()}", None) or getattr(service_obj, "name_en", None) or service_obj.name_key)
+            user_profile = await get_user_profile(session, user.id)
+            logger.debug(f"RegLogic: get_user_profile for lang in add_direct_service took {time.monotonic() - db_user_for_lang_start_time:.4f}s")
+            user_lang_code_add = user_profile.display_lang if user_profile else DEFAULT_DISPLAY_LANG
+            service_display_name_for_answer = service_obj.display_name(user_lang_code_add)
         logger.info(f"RegLogic: User {user_id_log}: Added service '{service_display_name_for_answer}' (ID: {service_id_to_add}) to selections.")
         answer_text = f"Услуга '{service_display_name_for_answer}' добавлена."
     else:
@@ -981,8 +994,8 @@ async def handle_add_direct_service(
     if query:
         try:
             answer_start_time = time.monotonic()
-            await query.answer(answer_text)
-            logger.debug(f"RegLogic: query.answer() in handle_add_direct_service took {time.monotonic() - answer_start_time:.4f}s")
+            await answer_callback(query, answer_text)
+            logger.debug(f"RegLogic: answer_callback() in handle_add_direct_service took {time.monotonic() - answer_start_time:.4f}s")
         except Exception as e_ans:
             logger.warning(f"RegLogic: handle_add_direct_service: Could not answer query: {e_ans}")
 
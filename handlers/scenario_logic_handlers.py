@@ -58,6 +58,8 @@ async def evaluate_role_and_get_next_state(
         "UNCLEAR"  # Убедись, что это значение AI возвращает для неясных случаев
     )
 
+    # Роль кладет call_ai: локально через pre_classify (кнопки role_choice:, "я мастер")
+    # или ответом AI для неоднозначного текста
     classified_role = state_context.get(classified_role_key)
     return_payload: Dict[str, Any] = {}  # Используем Dict
 
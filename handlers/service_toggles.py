@@ -0,0 +1,131 @@
+# handlers/service_toggles.py
+# Переключение уточняющих услуг без движка и БД: выбор живет в клавиатуре (rts:-токены)
+# Выполняется в очереди пользователя (update_queue.run_in_user_queue, см. run.py)
+
+# === BLOCK 1: Imports ===
+import logging
+import time
+from contextlib import suppress
+
+from telegram import InlineKeyboardMarkup, Update
+from telegram.ext import ContextTypes
+
+from BehaviorEngine.callback_ack import answer_callback
+from data.services import ServicesSnapshot, current_services_snapshot
+from database.user_profiles import resolve_display_lang
+from keyboards.sub_service_toggles import (
+    apply_toggle_to_markup,
+    build_sub_service_keyboard,
+    children_version,
+    find_done_button_text,
+    parse_toggle_callback_data,
+    read_toggles_from_markup,
+)
+from utils.edit_coalescer import edit_coalescer
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Toggle Handler ===
+STALE_KEYBOARD_ALERT = "Список услуг обновился. Отметьте, пожалуйста, услуги заново."
+
+
+def _rerender_stale_keyboard(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    parent_id: int,
+    reply_markup: InlineKeyboardMarkup,
+    snapshot: ServicesSnapshot,
+) -> bool:
+    """
+    Клавиатура построена по старому списку детей: перерисовывает ее по текущему
+    снимку (выбор сбрасывается - старую маску не к чему привязать).
+    False, если перерисовать нельзя (категория исчезла или стала слишком большой).
+    """
+    done_button_text = find_done_button_text(reply_markup, parent_id)
+    children = snapshot.selectable_children(parent_id)
+    if not done_button_text or not children:
+        return False
+    lang_code = resolve_display_lang(update.effective_user.language_code if update.effective_user else None)
+    fresh_markup = build_sub_service_keyboard(
+        parent_id,
+        [(child.service_id, child.display_name(lang_code)) for child in children],
+        [],
+        done_button_text,
+    )
+    if fresh_markup is None:
+        return False
+    message = update.callback_query.message
+    edit_coalescer.submit(context.bot, message.chat_id, message.message_id, reply_markup=fresh_markup)
+    return True
+
+
+async def handle_sub_service_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Нажатие на переключатель "rts:<parent>:<version>:<mask>:<index>": инвертирует
+    бит index и перерисовывает клавиатуру через edit_coalescer (одна правка на
+    пачку быстрых нажатий). Ни состояния, ни БД не трогает -
+    выбор сохраняется в UserStates только по "Готово" (handle_category_done).
+    Если version не совпадает с текущим списком детей (Services обновились
+    после отрисовки), бит не переключается - клавиатура перерисовывается.
+    Регистрируется в run.py перед обработчиком движка в той же группе.
+    """
+    func_start_time = time.monotonic()
+    query = update.callback_query
+    if not query:
+        return
+    parsed = parse_toggle_callback_data(query.data)
+    reply_markup = query.message.reply_markup if query.message else None
+    if not parsed or not reply_markup:
+        logger.warning(f"SubServiceToggle: Invalid toggle callback '{query.data}' (markup present: {bool(reply_markup)}).")
+        with suppress(Exception):
+            await answer_callback(query, "Ошибка обработки выбора.", show_alert=True)
+        return
+
+    parent_id, version, mask, index = parsed
+    snapshot = current_services_snapshot()
+    if snapshot is not None:
+        current_version = children_version(
+            [child.service_id for child in snapshot.selectable_children(parent_id)]
+        )
+        if current_version != version:
+            rerendered = _rerender_stale_keyboard(update, context, parent_id, reply_markup, snapshot)
+            logger.info(
+                f"SubServiceToggle: Stale keyboard for category {parent_id} "
+                f"(version {version}, current {current_version}). Re-rendered: {rerendered}."
+            )
+            with suppress(Exception):
+                await answer_callback(query, STALE_KEYBOARD_ALERT, show_alert=True)
+            return
+
+    chat_id, message_id = query.message.chat_id, query.message.message_id
+    # При быстрых нажатиях Telegram присылает клавиатуру до еще не отправленной
+    # правки: берем последнюю известную версию из склейщика правок
+    latest_markup = edit_coalescer.latest_markup(chat_id, message_id)
+    latest_toggles = read_toggles_from_markup(latest_markup, parent_id)
+    if latest_toggles is not None and latest_toggles[0] == version:
+        reply_markup = latest_markup
+        mask = latest_toggles[1]
+    new_mask = mask ^ (1 << index)
+    # Правка ставится в очередь без ожидания отправки: следующее нажатие
+    # (в очереди пользователя) видит ее в latest_markup и не затирает.
+    # Правка клавиатуры - одна на пачку нажатий, ответ на нажатие - сразу.
+    edit_coalescer.submit(
+        context.bot, chat_id, message_id,
+        reply_markup=apply_toggle_to_markup(reply_markup, parent_id, new_mask),
+    )
+    with suppress(Exception):
+        await answer_callback(query)
+    logger.debug(
+        f"SubServiceToggle: User {update.effective_user.id if update.effective_user else 'Unknown'} "
+        f"toggled index {index} in category {parent_id} (mask {mask} -> {new_mask}). "
+        f"Took {time.monotonic() - func_start_time:.4f}s"
+    )
+
+
+# === END BLOCK 3 ===
@@ -0,0 +1,181 @@
+# Sprofy/keyboards/sub_service_toggles.py
+# Клавиатура уточняющих услуг, где выбор хранится в самой клавиатуре (битовая маска в callback_data)
+import logging
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# --- Формат callback_data ---
+# Переключатель: "rts:<parent_id>:<version>:<mask>:<index>" (числа в base36).
+#   version - отпечаток списка детей (id в порядке снимка), по которому
+#             построена клавиатура: после обновления Services биты маски
+#             указывали бы на других детей, такой токен отклоняется;
+#   mask    - текущий выбор в категории: бит i = i-й выбираемый ребенок
+#             (в порядке data.services: по service_id);
+#   index   - какой бит переключает кнопка.
+# Кнопка "Готово" остается "reg_category_done:<parent_id>" (ее матчит сценарий),
+# а выбор handle_category_done читает из масок кнопок той же клавиатуры.
+TOGGLE_CALLBACK_PREFIX = "rts:"
+CATEGORY_DONE_CALLBACK_PREFIX = "reg_category_done:"
+MAX_CALLBACK_DATA_BYTES = 64  # Лимит Telegram
+
+SELECTED_MARK = "✅ "
+UNSELECTED_MARK = "☑️ "
+
+_BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+_VERSION_MODULUS = 36**4  # 4 символа base36 в токене
+
+
+def _to_base36(value: int) -> str:
+    if value < 0:
+        raise ValueError("base36 encoding supports only non-negative integers")
+    if value == 0:
+        return "0"
+    digits = []
+    while value:
+        value, remainder = divmod(value, 36)
+        digits.append(_BASE36_DIGITS[remainder])
+    return "".join(reversed(digits))
+
+
+def children_version(children_ids: Sequence[int]) -> str:
+    """Отпечаток порядка детей категории (crc32 списка id, 4 символа base36)."""
+    key = ",".join(str(child_id) for child_id in children_ids).encode("ascii")
+    return _to_base36(zlib.crc32(key) % _VERSION_MODULUS)
+
+
+def mask_from_selection(children_ids: Sequence[int], selected_ids: Sequence[int]) -> int:
+    selected = set(selected_ids)
+    mask = 0
+    for index, child_id in enumerate(children_ids):
+        if child_id in selected:
+            mask |= 1 << index
+    return mask
+
+
+def selection_from_mask(children_ids: Sequence[int], mask: int) -> List[int]:
+    """id выбранных детей; биты за пределами списка игнорируются."""
+    return [child_id for index, child_id in enumerate(children_ids) if mask >> index & 1]
+
+
+def toggle_callback_data(parent_id: int, version: str, mask: int, index: int) -> str:
+    return (
+        f"{TOGGLE_CALLBACK_PREFIX}{_to_base36(parent_id)}:{version}:"
+        f"{_to_base36(mask)}:{_to_base36(index)}"
+    )
+
+
+def parse_toggle_callback_data(data: Optional[str]) -> Optional[Tuple[int, str, int, int]]:
+    """(parent_id, version, mask, index) или None, если это не токен переключателя."""
+    if not data or not data.startswith(TOGGLE_CALLBACK_PREFIX):
+        return None
+    try:
+        parent_str, version, mask_str, index_str = data[len(TOGGLE_CALLBACK_PREFIX):].split(":")
+        int(version, 36)
+        return int(parent_str, 36), version, int(mask_str, 36), int(index_str, 36)
+    except ValueError:
+        return None
+
+
+def _button_text(display_name: str, is_selected: bool) -> str:
+    # Формат как у прежней клавиатуры: "<отметка> <название>"
+    return f"{SELECTED_MARK if is_selected else UNSELECTED_MARK} {display_name}"
+
+
+def _set_mark(text: str, is_selected: bool) -> str:
+    for mark in (SELECTED_MARK, UNSELECTED_MARK):
+        if text.startswith(mark):
+            text = text[len(mark):]
+            break
+    return f"{SELECTED_MARK if is_selected else UNSELECTED_MARK}{text}"
+
+
+def build_sub_service_keyboard(
+    parent_id: int,
+    children: Sequence[Tuple[int, str]],
+    selected_ids: Sequence[int],
+    done_button_text: str,
+) -> Optional[InlineKeyboardMarkup]:
+    """
+    Клавиатура категории: по кнопке-переключателю на ребенка + "Готово".
+    children - [(service_id, display_name)] в порядке снимка Services.
+    None, если маска не помещается в 64 байта callback_data (очень большая
+    категория) - тогда вызывающий код строит прежнюю клавиатуру с записью в состояние.
+    """
+    children_ids = [child_id for child_id, _ in children]
+    version = children_version(children_ids)
+    mask = mask_from_selection(children_ids, selected_ids)
+    full_mask = (1 << len(children_ids)) - 1
+    longest_token = toggle_callback_data(parent_id, version, full_mask, max(len(children_ids) - 1, 0))
+    if len(longest_token.encode("utf-8")) > MAX_CALLBACK_DATA_BYTES:
+        logger.info(
+            f"SubServiceToggles: category {parent_id} has {len(children_ids)} children, "
+            "mask does not fit into callback_data. Using stateful toggles."
+        )
+        return None
+    keyboard = [
+        [InlineKeyboardButton(
+            _button_text(display_name, bool(mask >> index & 1)),
+            callback_data=toggle_callback_data(parent_id, version, mask, index),
+        )]
+        for index, (_, display_name) in enumerate(children)
+    ]
+    keyboard.append([InlineKeyboardButton(
+        done_button_text, callback_data=f"{CATEGORY_DONE_CALLBACK_PREFIX}{parent_id}"
+    )])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def read_toggles_from_markup(
+    reply_markup: Optional[InlineKeyboardMarkup], parent_id: int
+) -> Optional[Tuple[str, int]]:
+    """(version, mask) из кнопок-переключателей клавиатуры (None - это не клавиатура с масками)."""
+    if not reply_markup:
+        return None
+    for row in reply_markup.inline_keyboard:
+        for button in row:
+            parsed = parse_toggle_callback_data(button.callback_data)
+            if parsed and parsed[0] == parent_id:
+                return parsed[1], parsed[2]
+    return None
+
+
+def find_done_button_text(
+    reply_markup: Optional[InlineKeyboardMarkup], parent_id: int
+) -> Optional[str]:
+    """Текст кнопки "Готово" категории (для перерисовки клавиатуры)."""
+    done_callback_data = f"{CATEGORY_DONE_CALLBACK_PREFIX}{parent_id}"
+    if not reply_markup:
+        return None
+    for row in reply_markup.inline_keyboard:
+        for button in row:
+            if button.callback_data == done_callback_data:
+                return button.text
+    return None
+
+
+def apply_toggle_to_markup(
+    reply_markup: InlineKeyboardMarkup, parent_id: int, new_mask: int
+) -> InlineKeyboardMarkup:
+    """
+    Новая клавиатура из текущей: у всех переключателей категории маска
+    заменяется на new_mask, отметки приводятся в соответствие. Остальные
+    кнопки (в т.ч. "Готово") не меняются. Названия услуг берутся из текста кнопок.
+    """
+    keyboard = []
+    for row in reply_markup.inline_keyboard:
+        new_row = []
+        for button in row:
+            parsed = parse_toggle_callback_data(button.callback_data)
+            if parsed and parsed[0] == parent_id:
+                _, version, _, index = parsed
+                button = InlineKeyboardButton(
+                    _set_mark(button.text, bool(new_mask >> index & 1)),
+                    callback_data=toggle_callback_data(parent_id, version, new_mask, index),
+                )
+            new_row.append(button)
+        keyboard.append(new_row)
+    return InlineKeyboardMarkup(keyboard)
@@ -17,6 +17,7 @@ try:
 
     # Убедитесь, что config импортируется для DATABASE_URL
     # и база данных может быть инициализирована
+    from data.services import notify_services_changed
     from database.models import Services, close_database, initialize_database
 except ImportError as e:
     # Строка разбита для E501
@@ -370,6 +371,8 @@ async def load_data(session_maker: async_sessionmaker[AsyncSession]):
                     f"Всего: {total_records}. Пропущенные ключи: {missed_keys_str}"
                 )
 
+            # Запущенные боты пересоберут снимок Services после commit
+            await notify_services_changed(session)
             await session.commit()
             # Строка f-string разбита для E501
             logging.info(
@@ -0,0 +1,63 @@
+# migrate_user_states_unique_index.py
+# Разовая миграция: уникальный индекс uq_user_state на user_states(user_id).
+# Нужна для БД, созданных до перехода на upsert состояний (ON CONFLICT (user_id)):
+# create_all не добавляет ограничения в существующие таблицы.
+# Новые БД получают индекс из модели UserStates, для них скрипт ничего не меняет.
+import asyncio
+import logging
+import os
+import sys
+
+try:
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    from database.models import DATABASE_URL
+except ImportError as e:
+    print(
+        f"Ошибка импорта: {e}. Убедитесь, что скрипт находится в "
+        "правильном месте или настройте PYTHONPATH."
+    )
+    sys.exit(1)
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+
+async def migrate() -> bool:
+    """
+    В одной транзакции: удаляет дубликаты состояний (оставляет самое новое
+    состояние пользователя - с наибольшим user_state_id) и создает индекс.
+    """
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL не определен. Миграция отменена.")
+        return False
+    engine = create_async_engine(DATABASE_URL, echo=False)
+    try:
+        async with engine.begin() as conn:
+            deleted = await conn.execute(
+                text(
+                    "DELETE FROM user_states a USING user_states b "
+                    "WHERE a.user_id = b.user_id AND a.user_state_id < b.user_state_id"
+                )
+            )
+            logging.info(f"Удалено дубликатов состояний: {deleted.rowcount}.")
+            await conn.execute(
+                text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS uq_user_state "
+                    "ON user_states (user_id)"
+                )
+            )
+        logging.info("Уникальный индекс uq_user_state на user_states(user_id) создан/на месте.")
+        return True
+    except Exception as e:
+        logging.error(f"Миграция не выполнена (изменения отменены): {e}", exc_info=True)
+        return False
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    success = asyncio.run(migrate())
+    logging.info(f"Скрипт {os.path.basename(__file__)} завершил работу.")
+    sys.exit(0 if success else 1)
@@ -16,11 +16,16 @@ from telegram.ext import (
     CommandHandler,
     # ConversationHandler, # УДАЛЕНО
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
 try:
-    from BehaviorEngine.engine import handle_update as engine_handle_update
+    # Апдейты идут через очередь пользователя, а не напрямую в engine.handle_update
+    from BehaviorEngine.update_queue import (
+        handle_update_ordered as engine_handle_update,
+    )
+    from BehaviorEngine.update_queue import run_in_user_queue
 except ImportError as e:
     logging.critical(f"CRITICAL: Failed to import BehaviorEngine: {e}", exc_info=True)
     print(f"CRITICAL: Failed to import BehaviorEngine: {e}", file=sys.stderr)
@@ -69,6 +74,10 @@ logger = logging.getLogger(__name__)
 # === BLOCK 4: Handler and DB Imports ===
 # --- Импорты обработчиков и БД ---
 try:
+    from data.instructions import refresh_instructions_catalog
+    from data.services import refresh_services_snapshot
+    from database.cache_sync import cache_sync
+    from database.last_seen import last_seen_tracker
     from database.models import close_database, initialize_database
     from handlers.admin import (
         ask_for_codes_file,
@@ -77,14 +86,21 @@ try:
         handle_codes_file,
         handle_instructions_file,
         handle_scenario_file,
+        view_bot_stats,
         view_instructions,
         view_registration_codes,
     )
 
     # Импорты старых обработчиков диалогов УДАЛЕНЫ
-    from handlers.common_handlers import cancel  # Для команды /cancel
+    from handlers.common_handlers import (  # Для команды /cancel и учета активности
+        cancel,
+        track_user_activity,
+    )
+    from handlers.service_toggles import handle_sub_service_toggle
     from handlers.start import start  # Новый /start через BehaviorEngine
+    from keyboards.sub_service_toggles import TOGGLE_CALLBACK_PREFIX
     from utils.error_handler import error_handler
+    from utils.outbound_scheduler import outbound_scheduler
     # from utils.message_utils import escape_md # Если escape_md не используется напрямую в run.py
 
     logger.info("Обработчики, утилиты и функции БД успешно импортированы.")
@@ -155,6 +171,14 @@ async def shutdown(signal_number: typing.Union[int, str], frame) -> None:
             )
     else:
         logger.warning("Объект application не найден или уже не запущен.")
+    try:
+        await cache_sync.stop()
+    except Exception as cache_sync_err:
+        logger.error(f"Ошибка при остановке cache_sync: {cache_sync_err}", exc_info=True)
+    try:
+        await last_seen_tracker.stop()  # Записывает накопленные отметки last_seen
+    except Exception as last_seen_err:
+        logger.error(f"Ошибка при остановке last_seen_tracker: {last_seen_err}", exc_info=True)
     logger.info("Вызов close_database()...")
     try:
         await close_database()
@@ -210,8 +234,28 @@ async def main() -> None:
         logger.critical("!!! БД не инициализирована.")
         return
     logger.info("<<< initialize_database() успешно завершена.")
+    # Снимок справочника Services для навигации по услугам без запросов к БД
+    try:
+        async with session_maker() as session:
+            await refresh_services_snapshot(session, force=True)
+    except Exception as services_err:
+        # Не критично: снимок загрузится при первом обращении или при сверке cache_sync
+        logger.error(f"Не удалось загрузить снимок Services: {services_err}", exc_info=True)
+    # Каталог текстов Instructions (сообщения и промпты) без запросов к БД
+    try:
+        async with session_maker() as session:
+            await refresh_instructions_catalog(session, force=True)
+    except Exception as instructions_err:
+        logger.error(f"Не удалось загрузить каталог Instructions: {instructions_err}", exc_info=True)
+    # Синхронизация кэшей (сценарии, Services и др.) между процессами: LISTEN/NOTIFY + опрос
+    await cache_sync.start(session_maker)
+    # last_seen пишется пачкой раз в интервал, а не на каждое сообщение
+    await last_seen_tracker.start(session_maker)
     logger.info(">>> Инициализация ApplicationBuilder...")
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Все запросы к Bot API идут через планировщик: лимиты Telegram, приоритеты, RetryAfter
+    application = (
+        ApplicationBuilder().token(BOT_TOKEN).rate_limiter(outbound_scheduler).build()
+    )
     logger.info("<<< ApplicationBuilder завершен.")
     application.bot_data["session_maker"] = session_maker
     logger.info("Фабрика сессий БД добавлена в application.bot_data")
@@ -219,6 +263,10 @@ async def main() -> None:
     # --- Старый Conversation Handler УДАЛЕН ---
 
     # --- Регистрация обработчиков В ПРАВИЛЬНОМ ПОРЯДКЕ ---
+    application.add_handler(
+        TypeHandler(Update, track_user_activity, block=False), group=-1
+    )
+    logger.info("Учет активности (last_seen) добавлен в группу -1.")
     application.add_handler(
         MessageHandler(
             filters.ChatType.PRIVATE & filters.ALL & ~filters.COMMAND,
@@ -227,10 +275,24 @@ async def main() -> None:
         ),
         group=0,
     )
+    # Переключатели уточняющих услуг (rts:) обрабатываются без движка и БД, но в
+    # очереди пользователя - по порядку с его апдейтами движка; в группе
+    # срабатывает первый подходящий обработчик, поэтому он раньше движка
+    application.add_handler(
+        CallbackQueryHandler(
+            run_in_user_queue(handle_sub_service_toggle),
+            pattern=f"^{TOGGLE_CALLBACK_PREFIX}",
+            block=False,
+        ),
+        group=0,
+    )
     application.add_handler(
         CallbackQueryHandler(engine_handle_update, block=False), group=0
     )
-    logger.info("Обработчик BehaviorEngine (engine_handle_update) добавлен в группу 0.")
+    logger.info(
+        "Обработчик BehaviorEngine (engine_handle_update через очередь пользователя) "
+        "добавлен в группу 0."
+    )
 
     application.add_handler(CommandHandler("start", start), group=1)
     application.add_handler(CommandHandler("cancel", cancel), group=1)
@@ -252,6 +314,7 @@ async def main() -> None:
     application.add_handler(
         CommandHandler("upload_scenario", ask_for_scenario_file), group=3
     )
+    application.add_handler(CommandHandler("bot_stats", view_bot_stats), group=3)
 
     application.add_handler(
         MessageHandler(
@@ -0,0 +1,11 @@
+# tests/conftest.py
+import importlib.util
+import sys
+import types
+
+# config.py - локальный файл с ключами и в репозиторий не входит. Модули читают
+# необязательные настройки через getattr(config, ...), для тестов хватает пустого модуля.
+if importlib.util.find_spec("config") is None:
+    sys.modules["config"] = types.ModuleType("config")
+    # ai.interaction читает ключ напрямую; без ключа клиент OpenAI не создается
+    sys.modules["config"].OPENAI_API_KEY = None
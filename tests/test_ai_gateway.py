@@ -0,0 +1,176 @@
+# tests/test_ai_gateway.py
+# CircuitBreaker и цикл повторов AIGateway.complete: дедлайн, повторы, 4xx
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from ai import gateway
+from ai.gateway import AIError, AIGateway, CircuitBreaker
+
+
+def _api_error(error_class, status_code):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, request=request)
+    return error_class(f"HTTP {status_code}", response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def _fast_retries(monkeypatch):
+    monkeypatch.setattr(gateway, "AI_RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(gateway, "AI_RETRY_MAX_DELAY", 0.002)
+
+
+# --- CircuitBreaker ---
+def test_breaker_opens_after_threshold_and_rejects():
+    breaker = CircuitBreaker("test", failure_threshold=2, open_seconds=60)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_half_open_allows_single_probe_and_success_closes():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # второй пробный запрос не пускаем
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_circuit():
+    breaker = CircuitBreaker("test", failure_threshold=3, open_seconds=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_released_probe_lets_next_request_probe():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.release_probe()
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+
+
+# --- AIGateway.complete ---
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def _factory_from(outcomes):
+    """request_factory, который по очереди возвращает значения или бросает исключения."""
+    calls = {"count": 0}
+
+    async def factory():
+        outcome = outcomes[calls["count"]]
+        calls["count"] += 1
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    return factory, calls
+
+
+def test_success_on_first_attempt():
+    factory, calls = _factory_from(["ответ"])
+    result = _run(AIGateway().complete("openai", "m", factory, timeout=5))
+    assert result.ok and result.text == "ответ"
+    assert result.attempts == 1 and calls["count"] == 1
+
+
+def test_retries_rate_limit_and_server_errors_then_succeeds():
+    factory, calls = _factory_from(
+        [_api_error(openai.RateLimitError, 429), _api_error(openai.InternalServerError, 500), "ок"]
+    )
+    ai_gateway = AIGateway()
+    result = _run(ai_gateway.complete("openai", "m", factory, timeout=5))
+    assert result.ok and result.attempts == 3
+    assert ai_gateway.get_stats()["retries"] == 2
+
+
+def test_exhausted_retries_return_error_code():
+    factory, _ = _factory_from([_api_error(openai.RateLimitError, 429)] * gateway.AI_MAX_ATTEMPTS)
+    result = _run(AIGateway().complete("openai", "m", factory, timeout=5))
+    assert not result.ok
+    assert result.error == AIError.RATE_LIMITED
+    assert result.attempts == gateway.AI_MAX_ATTEMPTS
+
+
+def test_client_error_is_not_retried_and_does_not_trip_breaker(monkeypatch):
+    monkeypatch.setattr(gateway, "AI_BREAKER_FAILURE_THRESHOLD", 1)
+    ai_gateway = AIGateway()
+    factory, calls = _factory_from([_api_error(openai.BadRequestError, 400)])
+    result = _run(ai_gateway.complete("openai", "m", factory, timeout=5))
+    assert result.error == AIError.PROVIDER_ERROR
+    assert calls["count"] == 1
+    assert ai_gateway.get_stats()["circuits"] == {"openai/m": "closed"}
+
+
+def test_provider_failures_open_circuit_and_reject_without_request(monkeypatch):
+    monkeypatch.setattr(gateway, "AI_BREAKER_FAILURE_THRESHOLD", 1)
+    monkeypatch.setattr(gateway, "AI_MAX_ATTEMPTS", 1)
+    ai_gateway = AIGateway()
+    failing, _ = _factory_from([_api_error(openai.InternalServerError, 503)])
+    assert _run(ai_gateway.complete("openai", "m", failing, timeout=5)).error == AIError.PROVIDER_ERROR
+
+    never_called, calls = _factory_from(["не должен вызываться"])
+    result = _run(ai_gateway.complete("openai", "m", never_called, timeout=5))
+    assert result.error == AIError.CIRCUIT_OPEN
+    assert calls["count"] == 0
+
+
+def test_empty_response_is_an_error():
+    factory, _ = _factory_from([None])
+    assert _run(AIGateway().complete("openai", "m", factory, timeout=5)).error == AIError.EMPTY_RESPONSE
+
+
+def test_deadline_bounds_slow_request():
+    async def slow():
+        await asyncio.sleep(5)
+        return "поздно"
+
+    started_at = time.monotonic()
+    result = _run(AIGateway().complete("openai", "m", slow, timeout=0.1))
+    assert result.error == AIError.TIMEOUT
+    assert time.monotonic() - started_at < 1
+
+
+def test_deadline_includes_waiting_for_concurrency_slot(monkeypatch):
+    monkeypatch.setattr(gateway, "AI_MAX_CONCURRENCY", 1)
+
+    async def scenario():
+        ai_gateway = AIGateway()
+        release = asyncio.Event()
+
+        async def holder():
+            await release.wait()
+            return "первый"
+
+        first = asyncio.create_task(ai_gateway.complete("openai", "m", holder, timeout=5))
+        await asyncio.sleep(0)  # первый вызов занимает единственный слот
+        factory, calls = _factory_from(["второй"])
+        started_at = time.monotonic()
+        second = await ai_gateway.complete("openai", "m", factory, timeout=0.1)
+        waited = time.monotonic() - started_at
+        release.set()
+        return await first, second, calls["count"], waited
+
+    first, second, second_calls, waited = _run(scenario())
+    assert first.ok
+    assert second.error == AIError.TIMEOUT
+    assert second_calls == 0
+    assert waited < 1
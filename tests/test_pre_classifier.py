@@ -0,0 +1,140 @@
+# tests/test_pre_classifier.py
+# Локальная классификация pre_classify перед call_ai (BehaviorEngine.compiler)
+import pytest
+
+from BehaviorEngine.compiler import (
+    CompiledPreClassifier,
+    _compile_pre_classifier,
+    compile_scenario,
+)
+
+ROLE_RULES = {
+    "callback_data": {"role_choice:master": "MASTER", "role_choice:client": "CLIENT"},
+    "rules": [
+        {"result": "MASTER", "lang": ["ru", "uk"], "keywords": ["я мастер", "я майстер"]},
+        {"result": "CLIENT", "keywords": ["я клиент", "ищу мастера"]},
+    ],
+    "defer_keywords": ["не", "ні"],
+    "max_words": 6,
+}
+
+
+@pytest.fixture
+def classifier():
+    errors = []
+    compiled = _compile_pre_classifier(ROLE_RULES, "test", errors)
+    assert errors == []
+    return compiled
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("Я  МАСТЁР!", "MASTER"),  # регистр, пробелы, ё/е, пунктуация
+        ("я майстер", "MASTER"),
+        ("ищу мастера", "CLIENT"),
+        ("мастерская", None),  # ключевые слова - только целыми словами
+        ("привет", None),
+        ("", None),
+    ],
+)
+def test_keyword_rules(classifier, text, expected):
+    assert classifier.classify(text, None, "ru") == expected
+
+
+def test_callback_data_is_matched_exactly(classifier):
+    assert classifier.classify(None, "role_choice:client", None) == "CLIENT"
+    assert classifier.classify(None, "role_choice:other", None) is None
+
+
+def test_defer_keywords_send_input_to_ai(classifier):
+    assert classifier.classify("я не мастер", None, "ru") is None
+    assert classifier.classify("я ні майстер", None, "uk") is None
+
+
+def test_max_words_sends_long_input_to_ai(classifier):
+    assert classifier.classify("я мастер", None, "ru") == "MASTER"
+    assert classifier.classify("я мастер по ремонту и ищу новых клиентов", None, "ru") is None
+
+
+def test_conflicting_rules_are_ambiguous(classifier):
+    assert classifier.classify("я мастер, ищу мастера", None, "ru") is None
+
+
+def test_language_filter(classifier):
+    assert classifier.classify("я мастер", None, "en") is None
+    assert classifier.classify("я мастер", None, "uk-UA") == "MASTER"
+    assert classifier.classify("я мастер", None, None) == "MASTER"  # язык неизвестен
+
+
+def test_regex_rules_and_invalid_regex_reporting():
+    errors = []
+    compiled = _compile_pre_classifier(
+        {"rules": [{"result": "YES", "regex": [r"^да+$"]}, {"result": "BAD", "regex": ["(["]}]},
+        "test",
+        errors,
+    )
+    assert len(compiled.rules) == 1
+    assert len(errors) == 1 and "invalid regex" in errors[0]
+    assert compiled.classify("Дааа", None, None) == "YES"
+    assert compiled.classify("да нет", None, None) is None
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        "не словарь",
+        {},
+        {"rules": [{"keywords": ["без результата"]}]},
+        {"rules": [{"result": "X"}]},
+    ],
+)
+def test_unusable_config_is_reported(raw):
+    errors = []
+    assert _compile_pre_classifier(raw, "test", errors) is None
+    assert errors
+
+
+def test_invalid_max_words_is_ignored_with_error():
+    errors = []
+    compiled = _compile_pre_classifier(
+        {"rules": [{"result": "X", "keywords": ["x"]}], "max_words": 0}, "test", errors
+    )
+    assert compiled.max_words is None
+    assert errors
+
+
+def test_compile_scenario_replaces_pre_classify_with_compiled_classifier():
+    async def call_ai(**kwargs):
+        return None
+
+    definition = {
+        "states": {
+            "ASK_ROLE": {
+                "input_handlers": [
+                    {
+                        "filters": [],
+                        "actions": [
+                            {
+                                "action": "call_ai",
+                                "params": {
+                                    "prompt_key": "classify_role",
+                                    "save_to": "classified_role",
+                                    "pre_classify": ROLE_RULES,
+                                },
+                            }
+                        ],
+                    }
+                ]
+            }
+        }
+    }
+    errors = []
+    scenario = compile_scenario("test", definition, {"call_ai": call_ai}, errors)
+    assert errors == []
+    action = scenario.get_state("ASK_ROLE").input_handlers[0].actions[0]
+    params = action.params.render({})
+    assert isinstance(params["pre_classify"], CompiledPreClassifier)
+    assert params["save_to"] == "classified_role"
+    # Исходный YAML-словарь не меняется
+    assert definition["states"]["ASK_ROLE"]["input_handlers"][0]["actions"][0]["params"]["pre_classify"] is ROLE_RULES
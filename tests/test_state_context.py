@@ -0,0 +1,196 @@
+# tests/test_state_context.py
+# StateContext (учет изменений верхнего уровня) и дельта-UPDATE state_manager._patch_user_state
+import asyncio
+import copy
+import pickle
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from BehaviorEngine.context import StateContext
+from BehaviorEngine.state_manager import (
+    _patch_user_state,
+    _remember_user_state,
+    begin_deferred_state_writes,
+    flush_deferred_state_writes,
+    get_known_user_state,
+    update_user_state,
+)
+from database.models import UserStates
+
+
+def test_new_context_has_no_changes():
+    ctx = StateContext({"a": 1, "b": 2})
+    assert ctx == {"a": 1, "b": 2}
+    assert not ctx.has_changes
+    assert ctx.get_delta() == ({}, [])
+
+
+def test_set_and_delete_are_tracked():
+    ctx = StateContext({"a": 1, "b": 2})
+    ctx["c"] = 3
+    del ctx["a"]
+    assert ctx.get_delta() == ({"c": 3}, ["a"])
+
+
+def test_setting_deleted_key_again_is_a_set_not_a_delete():
+    ctx = StateContext({"a": 1})
+    del ctx["a"]
+    ctx["a"] = 10
+    assert ctx.get_delta() == ({"a": 10}, [])
+
+
+def test_deleting_key_absent_from_base_is_not_reported():
+    ctx = StateContext({"a": 1})
+    ctx["tmp"] = 1
+    ctx.pop("tmp")
+    assert ctx.get_delta() == ({}, [])
+    assert not ctx.has_changes
+
+
+def test_update_setdefault_pop_and_clear():
+    ctx = StateContext({"a": 1, "b": 2})
+    ctx.update({"a": 5}, c=3)
+    assert ctx.setdefault("a", 100) == 5
+    assert ctx.setdefault("d", 4) == 4
+    assert ctx.pop("missing", None) is None
+    set_patch, deleted = ctx.get_delta()
+    assert set_patch == {"a": 5, "c": 3, "d": 4}
+    assert deleted == []
+
+    ctx.clear()
+    assert ctx == {}
+    assert ctx.get_delta() == ({}, ["a", "b"])
+
+
+def test_pop_missing_key_without_default_raises():
+    ctx = StateContext({})
+    with pytest.raises(KeyError):
+        ctx.pop("missing")
+
+
+def test_copy_keeps_base_and_changes_independently():
+    ctx = StateContext({"a": 1})
+    ctx["b"] = 2
+    clone = ctx.copy()
+    clone["c"] = 3
+    assert isinstance(clone, StateContext)
+    assert clone.get_delta() == ({"b": 2, "c": 3}, [])
+    assert ctx.get_delta() == ({"b": 2}, [])
+
+
+def test_from_persisted_copies_existing_state_context():
+    ctx = StateContext({"a": 1})
+    ctx["b"] = 2
+    restored = StateContext.from_persisted(ctx)
+    assert restored is not ctx
+    assert restored.get_delta() == ({"b": 2}, [])
+    assert StateContext.from_persisted(None) == {}
+
+
+def test_pickle_and_deepcopy_produce_plain_dict():
+    ctx = StateContext({"a": [1, 2]})
+    ctx["b"] = {"x": 1}
+    for restored in (pickle.loads(pickle.dumps(ctx)), copy.deepcopy(ctx)):
+        assert type(restored) is dict
+        assert restored == {"a": [1, 2], "b": {"x": 1}}
+
+
+class _RecordingSession:
+    """Сессия, которая только запоминает выполненный запрос."""
+
+    def __init__(self):
+        self.statements = []
+        self.info = {}
+
+    def __contains__(self, instance):
+        return False
+
+    async def execute(self, stmt, execution_options=None):
+        self.statements.append(stmt)
+        return self
+
+    def scalar_one_or_none(self):
+        return None
+
+    def scalar_one(self):
+        return UserStates(user_state_id=1, user_id=7, scenario_key="written", current_state_key="written")
+
+
+def _compile(stmt):
+    return stmt.compile(dialect=postgresql.dialect())
+
+
+def test_patch_user_state_sends_only_delta():
+    ctx = StateContext({"keep": 1, "old": 2})
+    ctx["new"] = 3
+    del ctx["old"]
+    session = _RecordingSession()
+
+    result = asyncio.run(_patch_user_state(7, "scenario", "STATE", ctx, session))
+
+    assert result is None  # строки нет - вызывающий код делает полный upsert
+    compiled = _compile(session.statements[0])
+    sql = str(compiled)
+    set_clause = sql.split(" WHERE ")[0]
+    assert "coalesce(user_states.state_context" in set_clause
+    assert "||" in set_clause and ") - " in set_clause
+    params = list(compiled.params.values())
+    assert {"new": 3} in params
+    assert ["old"] in params
+    assert {"keep": 1, "new": 3} not in params  # весь документ не отправляется
+
+
+def test_patch_user_state_without_changes_keeps_context_column():
+    session = _RecordingSession()
+    asyncio.run(_patch_user_state(7, "scenario", "STATE", StateContext({"a": 1}), session))
+    sql = str(_compile(session.statements[0]))
+    assert "state_context" not in sql.split(" WHERE ")[0]
+
+
+def _deferred_session_with_row(scenario_key, state_context):
+    session = _RecordingSession()
+    begin_deferred_state_writes(session)
+    persisted = UserStates(
+        user_state_id=1, user_id=7, scenario_key=scenario_key,
+        current_state_key="START", state_context=state_context,
+    )
+    _remember_user_state(session, 7, persisted)
+    return session
+
+
+async def _save_on_entry_flag(session, scenario_key):
+    # Как executor: контекст следующего шага строится из staged-состояния
+    _, staged = get_known_user_state(7, session)
+    ctx = StateContext.from_persisted(staged.state_context)
+    ctx["_internal_on_entry_actions_done"] = True
+    await update_user_state(7, scenario_key, "ENTRY", ctx, session)
+
+
+def test_deferred_scenario_switch_with_plain_dict_is_flushed_as_full_replace():
+    session = _deferred_session_with_row("main_start_v1", {"classified_role": "MASTER", "old": 1})
+
+    async def chain():
+        await update_user_state(7, "master_registration_v1", "ENTRY", {}, session)
+        await _save_on_entry_flag(session, "master_registration_v1")
+        return await flush_deferred_state_writes(session)
+
+    assert asyncio.run(chain()) == 1
+    assert len(session.statements) == 1
+    compiled = _compile(session.statements[0])
+    sql = str(compiled)
+    assert sql.startswith("INSERT INTO user_states")
+    assert "ON CONFLICT (user_id) DO UPDATE" in sql
+    assert compiled.params["state_context"] == {"_internal_on_entry_actions_done": True}
+
+
+def test_deferred_chain_of_state_contexts_is_flushed_as_delta():
+    session = _deferred_session_with_row("main_start_v1", {"old": 1})
+
+    async def chain():
+        await _save_on_entry_flag(session, "main_start_v1")
+        return await flush_deferred_state_writes(session)
+
+    assert asyncio.run(chain()) == 1
+    sql = str(_compile(session.statements[0]))
+    assert sql.startswith("UPDATE user_states")
@@ -0,0 +1,206 @@
+# tests/test_sub_service_toggles.py
+# Битовая маска выбора в callback_data клавиатуры уточняющих услуг
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from BehaviorEngine.update_queue import UserUpdateQueue
+from handlers import service_toggles
+from keyboards.sub_service_toggles import (
+    CATEGORY_DONE_CALLBACK_PREFIX,
+    MAX_CALLBACK_DATA_BYTES,
+    SELECTED_MARK,
+    UNSELECTED_MARK,
+    apply_toggle_to_markup,
+    build_sub_service_keyboard,
+    children_version,
+    mask_from_selection,
+    parse_toggle_callback_data,
+    read_toggles_from_markup,
+    selection_from_mask,
+    toggle_callback_data,
+)
+
+
+@pytest.mark.parametrize(
+    ("parent_id", "mask", "index"),
+    [(1, 0, 0), (35, 1, 0), (36, 2**40 - 1, 39), (123456789, 0b1010, 3)],
+)
+def test_toggle_callback_data_round_trip(parent_id, mask, index):
+    version = children_version([1, 2, 3])
+    data = toggle_callback_data(parent_id, version, mask, index)
+    assert parse_toggle_callback_data(data) == (parent_id, version, mask, index)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [None, "", "reg_category_done:5", "rts:1:2", "rts:1:2:3", "rts:1:2:3:4:5", "rts:x!:v:1:0", "rts:1:v!:1:0"],
+)
+def test_parse_rejects_foreign_or_malformed_data(data):
+    assert parse_toggle_callback_data(data) is None
+
+
+def test_mask_and_selection_round_trip():
+    children_ids = [10, 11, 12, 13]
+    mask = mask_from_selection(children_ids, [13, 11, 99])
+    assert mask == 0b1010
+    assert selection_from_mask(children_ids, mask) == [11, 13]
+    # Биты за пределами списка детей игнорируются
+    assert selection_from_mask(children_ids, mask | 1 << 10) == [11, 13]
+
+
+def test_children_version_tracks_ids_and_order():
+    assert children_version([1, 2, 3]) == children_version([1, 2, 3])
+    assert children_version([1, 2, 3]) != children_version([1, 3, 2])
+    assert children_version([1, 2, 3]) != children_version([1, 2, 3, 4])
+    assert len(children_version(list(range(500)))) <= 4
+
+
+def _children(count):
+    return [(1000 + i, f"Услуга {i}") for i in range(count)]
+
+
+def test_keyboard_buttons_carry_mask_and_marks():
+    children = _children(3)
+    markup = build_sub_service_keyboard(77, children, [1001], "Готово")
+    rows = markup.inline_keyboard
+    assert len(rows) == 4
+    assert rows[0][0].text.startswith(UNSELECTED_MARK)
+    assert rows[1][0].text.startswith(SELECTED_MARK)
+    assert rows[3][0].callback_data == f"{CATEGORY_DONE_CALLBACK_PREFIX}77"
+    version = children_version([1000, 1001, 1002])
+    assert read_toggles_from_markup(markup, 77) == (version, 0b010)
+    assert read_toggles_from_markup(markup, 78) is None
+    for row in rows:
+        assert len(row[0].callback_data.encode("utf-8")) <= MAX_CALLBACK_DATA_BYTES
+
+
+def test_keyboard_falls_back_when_mask_exceeds_callback_limit():
+    # Максимальный токен: "rts:" + parent + версия + полная маска + индекс
+    fits = max(
+        count
+        for count in range(1, 1000)
+        if len(toggle_callback_data(10**9, "zzzz", (1 << count) - 1, count - 1)) <= MAX_CALLBACK_DATA_BYTES
+    )
+    assert 100 < fits < 1000
+    assert build_sub_service_keyboard(10**9, _children(fits), [], "Готово") is not None
+    assert build_sub_service_keyboard(10**9, _children(fits + 1), [], "Готово") is None
+
+
+def test_apply_toggle_updates_all_toggles_and_keeps_other_buttons():
+    markup = build_sub_service_keyboard(5, _children(3), [], "Готово")
+    new_markup = apply_toggle_to_markup(markup, 5, 0b101)
+    rows = new_markup.inline_keyboard
+    version = children_version([1000, 1001, 1002])
+    assert [parse_toggle_callback_data(row[0].callback_data) for row in rows[:3]] == [
+        (5, version, 0b101, 0),
+        (5, version, 0b101, 1),
+        (5, version, 0b101, 2),
+    ]
+    assert rows[0][0].text == f"{SELECTED_MARK} Услуга 0"
+    assert rows[1][0].text == f"{UNSELECTED_MARK} Услуга 1"
+    assert rows[3][0] == markup.inline_keyboard[3][0]
+
+
+# --- Обработчик нажатий (handlers/service_toggles.py) ---
+class _FakeCoalescer:
+    def __init__(self):
+        self.submitted = []
+
+    def latest_markup(self, chat_id, message_id):
+        return self.submitted[-1] if self.submitted else None
+
+    def submit(self, bot, chat_id, message_id, reply_markup=None, **kwargs):
+        self.submitted.append(reply_markup)
+
+
+class _FakeSnapshot:
+    def __init__(self, children):
+        self._children = [
+            SimpleNamespace(service_id=child_id, display_name=lambda lang, name=name: name)
+            for child_id, name in children
+        ]
+
+    def selectable_children(self, parent_id):
+        return tuple(self._children)
+
+
+@pytest.fixture
+def toggle_env(monkeypatch):
+    coalescer = _FakeCoalescer()
+    answers = []
+
+    async def fake_answer_callback(query, text=None, show_alert=False):
+        answers.append((text, show_alert))
+        return True
+
+    monkeypatch.setattr(service_toggles, "edit_coalescer", coalescer)
+    monkeypatch.setattr(service_toggles, "answer_callback", fake_answer_callback)
+    return coalescer, answers
+
+
+def _press(markup, row_index):
+    message = SimpleNamespace(chat_id=1, message_id=2, reply_markup=markup)
+    query = SimpleNamespace(data=markup.inline_keyboard[row_index][0].callback_data, message=message)
+    update = SimpleNamespace(
+        callback_query=query, effective_user=SimpleNamespace(id=7, language_code="ru")
+    )
+    return update, SimpleNamespace(bot=None)
+
+
+def test_toggle_with_current_version_flips_bit(toggle_env, monkeypatch):
+    coalescer, answers = toggle_env
+    children = _children(3)
+    monkeypatch.setattr(service_toggles, "current_services_snapshot", lambda: _FakeSnapshot(children))
+    markup = build_sub_service_keyboard(5, children, [], "Готово")
+
+    asyncio.run(service_toggles.handle_sub_service_toggle(*_press(markup, 1)))
+
+    assert read_toggles_from_markup(coalescer.submitted[-1], 5)[1] == 0b010
+    assert answers == [(None, False)]
+
+
+def test_toggle_with_stale_version_rerenders_instead_of_flipping(toggle_env, monkeypatch):
+    coalescer, answers = toggle_env
+    markup = build_sub_service_keyboard(5, _children(3), [1000], "Готово")
+    # Services обновились: новый ребенок встал между старыми
+    fresh_children = [(1000, "Услуга 0"), (999, "Новая"), (1001, "Услуга 1"), (1002, "Услуга 2")]
+    monkeypatch.setattr(service_toggles, "current_services_snapshot", lambda: _FakeSnapshot(fresh_children))
+
+    asyncio.run(service_toggles.handle_sub_service_toggle(*_press(markup, 1)))
+
+    rerendered = coalescer.submitted[-1]
+    assert read_toggles_from_markup(rerendered, 5) == (children_version([1000, 999, 1001, 1002]), 0)
+    assert [row[0].text for row in rerendered.inline_keyboard[:4]] == [
+        f"{UNSELECTED_MARK} {name}" for _, name in fresh_children
+    ]
+    assert rerendered.inline_keyboard[4][0].text == "Готово"
+    assert answers == [(service_toggles.STALE_KEYBOARD_ALERT, True)]
+
+
+def test_handler_in_user_queue_runs_after_earlier_update_of_same_user():
+    events = []
+
+    async def slow_engine_update(update, context):
+        events.append("engine-start")
+        await asyncio.sleep(0.01)
+        events.append("engine-end")
+        return True
+
+    async def toggle(update, context):
+        events.append("toggle")
+        return True
+
+    async def scenario():
+        queue = UserUpdateQueue(handler=slow_engine_update)
+        user = SimpleNamespace(id=7)
+        engine_update = SimpleNamespace(update_id=1, effective_user=user)
+        toggle_update = SimpleNamespace(update_id=2, effective_user=user)
+        await asyncio.gather(
+            queue.submit(engine_update, None),
+            queue.submit(toggle_update, None, toggle),
+        )
+
+    asyncio.run(scenario())
+    assert events == ["engine-start", "engine-end", "toggle"]
@@ -0,0 +1,178 @@
+# utils/edit_coalescer.py
+# Склейка частых правок одного сообщения: в Telegram уходит только последняя версия
+
+# === BLOCK 1: Imports ===
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import telegram
+from telegram import Bot, InlineKeyboardMarkup
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Edit Coalescer ===
+EDIT_COALESCE_WINDOW = 0.35  # секунд
+_LAST_SENT_MAX_MESSAGES = 2000
+
+MessageKey = Tuple[int, int]
+
+
+class _PendingEdit:
+    __slots__ = ("text", "reply_markup", "parse_mode", "future")
+
+    def __init__(self, text: Optional[str], reply_markup: Optional[InlineKeyboardMarkup], parse_mode: Optional[str]) -> None:
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def signature(self) -> Tuple[Any, ...]:
+        markup_dict = self.reply_markup.to_dict() if self.reply_markup else None
+        return (self.text, repr(markup_dict), self.parse_mode)
+
+
+class EditCoalescer:
+    """
+    Правки сообщения (chat_id, message_id) копятся window секунд; новая правка
+    заменяет ожидающую, и в Telegram уходит только последняя. Все, кто ждал
+    замененные правки, получают результат итоговой.
+
+    text=None - правится только клавиатура (edit_message_reply_markup).
+    Правка, совпадающая с последней отправленной, не отправляется вовсе
+    (вместо ошибки "message is not modified").
+
+    latest_markup() отдает последнюю известную клавиатуру сообщения (ожидающую
+    или отправленную): по ней строятся следующие нажатия во время пачки, пока
+    Telegram еще присылает в callback_query старую версию сообщения.
+    """
+
+    def __init__(self, window: float = EDIT_COALESCE_WINDOW) -> None:
+        self._window = window
+        self._pending: Dict[MessageKey, _PendingEdit] = {}
+        self._flush_tasks: Dict[MessageKey, asyncio.Task] = {}
+        # Последняя отправленная версия: key -> (signature, reply_markup)
+        self._last_sent: OrderedDict[MessageKey, Tuple[Tuple[Any, ...], Optional[InlineKeyboardMarkup]]] = OrderedDict()
+        self._stats: Dict[str, int] = {"submitted": 0, "sent": 0, "merged": 0, "skipped_unchanged": 0, "failed": 0}
+
+    def submit(
+        self,
+        bot: Bot,
+        chat_id: int,
+        message_id: int,
+        text: Optional[str] = None,
+        reply_markup: Optional[InlineKeyboardMarkup] = None,
+        parse_mode: Optional[str] = None,
+        delay: Optional[float] = None,
+    ) -> "asyncio.Future[bool]":
+        """
+        Ставит правку в очередь. Future -> True, если итоговая правка применена
+        (или не требовалась), False - если Telegram ее отклонил.
+        delay=0 - отправить без ожидания окна (но с проверкой на повтор).
+        """
+        key = (chat_id, message_id)
+        edit = _PendingEdit(text, reply_markup, parse_mode)
+        self._stats["submitted"] += 1
+        replaced = self._pending.get(key)
+        if replaced is not None:
+            self._stats["merged"] += 1
+            # Ждавшие замененную правку получат результат новой
+            edit.future.add_done_callback(lambda f, old=replaced.future: _copy_result(f, old))
+        self._pending[key] = edit
+        if key not in self._flush_tasks:
+            wait = self._window if delay is None else delay
+            self._flush_tasks[key] = asyncio.create_task(
+                self._flush_after(bot, key, wait), name=f"edit-coalescer-{chat_id}-{message_id}"
+            )
+        return edit.future
+
+    def latest_markup(self, chat_id: int, message_id: int) -> Optional[InlineKeyboardMarkup]:
+        """Последняя известная клавиатура сообщения (ожидающая или отправленная); None - неизвестна."""
+        key = (chat_id, message_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending.reply_markup
+        last_sent = self._last_sent.get(key)
+        return last_sent[1] if last_sent is not None else None
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self._stats, pending=len(self._pending))
+
+    async def _flush_after(self, bot: Bot, key: MessageKey, wait: float) -> None:
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # Правки, пришедшие во время отправки, уходят следующим заходом
+            while key in self._pending:
+                edit = self._pending.pop(key)
+                await self._send(bot, key, edit)
+        finally:
+            self._flush_tasks.pop(key, None)
+
+    async def _send(self, bot: Bot, key: MessageKey, edit: _PendingEdit) -> None:
+        signature = edit.signature()
+        last_sent = self._last_sent.get(key)
+        if last_sent is not None and last_sent[0] == signature:
+            self._stats["skipped_unchanged"] += 1
+            _set_result(edit.future, True)
+            return
+        chat_id, message_id = key
+        send_start_time = time.monotonic()
+        try:
+            if edit.text is None:
+                await bot.edit_message_reply_markup(
+                    chat_id=chat_id, message_id=message_id, reply_markup=edit.reply_markup
+                )
+            else:
+                await bot.edit_message_text(
+                    chat_id=chat_id, message_id=message_id, text=edit.text,
+                    reply_markup=edit.reply_markup, parse_mode=edit.parse_mode,
+                )
+        except telegram.error.BadRequest as e_bad_request:
+            if "message is not modified" not in str(e_bad_request).lower():
+                self._stats["failed"] += 1
+                logger.warning(f"EditCoalescer: Edit of message {message_id} in chat {chat_id} failed: {e_bad_request}")
+                _set_result(edit.future, False)
+                return
+        except Exception as e:
+            self._stats["failed"] += 1
+            logger.warning(f"EditCoalescer: Edit of message {message_id} in chat {chat_id} failed: {e}")
+            _set_result(edit.future, False)
+            return
+        self._stats["sent"] += 1
+        self._remember_sent(key, signature, edit.reply_markup)
+        logger.debug(f"EditCoalescer: Edited message {message_id} in chat {chat_id} in {time.monotonic() - send_start_time:.4f}s")
+        _set_result(edit.future, True)
+
+    def _remember_sent(self, key: MessageKey, signature: Tuple[Any, ...], reply_markup: Optional[InlineKeyboardMarkup]) -> None:
+        self._last_sent[key] = (signature, reply_markup)
+        self._last_sent.move_to_end(key)
+        while len(self._last_sent) > _LAST_SENT_MAX_MESSAGES:
+            self._last_sent.popitem(last=False)
+
+
+def _set_result(future: asyncio.Future, result: bool) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _copy_result(source: asyncio.Future, target: asyncio.Future) -> None:
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    else:
+        target.set_result(source.result())
+
+
+# Один экземпляр на процесс
+edit_coalescer = EditCoalescer()
+# === END BLOCK 3 ===
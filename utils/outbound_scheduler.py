@@ -0,0 +1,274 @@
+# utils/outbound_scheduler.py
+# Планировщик исходящих запросов к Bot API: общий и по-чатовые token bucket,
+# приоритеты (ответы на callback > интерактивные ответы > массовые отправки), RetryAfter
+
+# === BLOCK 1: Imports ===
+import asyncio
+import contextlib
+import datetime
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from enum import IntEnum
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: Logger Definition ===
+logger = logging.getLogger(__name__)
+# === END BLOCK 2 ===
+
+
+# === BLOCK 3: Priorities and Limits ===
+class SendPriority(IntEnum):
+    """Чем меньше значение, тем раньше запрос получает токен."""
+
+    CALLBACK_ANSWER = 0  # answerCallbackQuery - снимает "часики" с кнопки
+    INTERACTIVE = 1  # ответы пользователю в диалоге (по умолчанию)
+    BULK = 2  # многочастные отчеты, рассылки
+
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, ~20/мин в группу.
+# Небольшой burst в чате, чтобы цепочка on_entry из 2-3 сообщений не ждала.
+GLOBAL_RATE_PER_SECOND = 30.0
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE_PER_SECOND = 1.0
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE_PER_SECOND = 20 / 60
+GROUP_CHAT_BURST = 3
+MAX_RETRIES_ON_RETRY_AFTER = 3
+_MAX_CHAT_BUCKETS = 10000
+
+# Запросы без chat_id, которые все же расходуют общий лимит
+_CHATLESS_LIMITED_ENDPOINTS = frozenset({"answerCallbackQuery", "answerInlineQuery"})
+
+# Для bot.send_message(..., rate_limit_args=BULK_RATE_LIMIT_ARGS)
+BULK_RATE_LIMIT_ARGS: Dict[str, Any] = {"priority": SendPriority.BULK}
+# === END BLOCK 3 ===
+
+
+# === BLOCK 4: Priority Token Bucket ===
+class _PriorityTokenBucket:
+    """
+    Token bucket, в котором ожидающие обслуживаются по (priority, порядок прихода):
+    токен получает только голова очереди. pause() останавливает выдачу
+    (RetryAfter) до указанного момента.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self._rate = rate
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int]] = []
+        self._cond = asyncio.Condition()
+
+    @property
+    def is_idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self._tokens >= self._burst and self._paused_until <= time.monotonic()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority: int, seq: int) -> None:
+        entry = (priority, seq)
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            # Новый запрос мог стать головой: пусть текущие ожидающие пересчитают ожидание
+            self._cond.notify_all()
+            try:
+                while True:
+                    delay = self._delay_for(entry)
+                    if delay == 0.0:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        return
+                    with contextlib.suppress(TimeoutError):
+                        await asyncio.wait_for(self._cond.wait(), timeout=delay)
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+            finally:
+                self._cond.notify_all()
+
+    def _delay_for(self, entry: Tuple[int, int]) -> Optional[float]:
+        """0.0 - можно брать токен; None - ждать смены головы очереди; иначе - секунд до токена."""
+        if self._waiters[0] != entry:
+            return None
+        now = time.monotonic()
+        if self._paused_until > now:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def _refill(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+# === END BLOCK 4 ===
+
+
+# === BLOCK 5: Outbound Scheduler ===
+class OutboundScheduler(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Rate limiter для ApplicationBuilder().rate_limiter(...): через него идут
+    все запросы Bot API (send/edit/answer из executor, registration_logic,
+    admin и т.д.), без изменений в местах вызова.
+
+    - общий bucket на бота + bucket на каждый chat_id (личный/групповой лимит);
+    - при нехватке токенов раньше обслуживаются ответы на callback, затем
+      интерактивные ответы, затем BULK (rate_limit_args={"priority": ...});
+    - RetryAfter: bucket чата (или общий, если чата нет) ставится на паузу
+      на retry_after, запрос повторяется до MAX_RETRIES_ON_RETRY_AFTER раз.
+    Запросы без chat_id (getUpdates, getMe, ...) идут без ограничений.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE_PER_SECOND,
+        global_burst: int = GLOBAL_BURST,
+        max_retries: int = MAX_RETRIES_ON_RETRY_AFTER,
+    ) -> None:
+        self._global_rate = global_rate
+        self._global_burst = global_burst
+        self._max_retries = max_retries
+        self._global_bucket: Optional[_PriorityTokenBucket] = None
+        self._chat_buckets: OrderedDict[Union[int, str], _PriorityTokenBucket] = OrderedDict()
+        self._seq = itertools.count()
+        self._stats: Dict[str, Union[int, float]] = {
+            "requests": 0, "delayed": 0, "retry_after": 0, "max_wait": 0.0,
+        }
+
+    async def initialize(self) -> None:
+        # Bucket'ы создаются в цикле событий приложения (asyncio.Condition)
+        self._global_bucket = _PriorityTokenBucket(self._global_rate, self._global_burst)
+        self._chat_buckets.clear()
+        logger.info(
+            f"OutboundScheduler: initialized (global {self._global_rate}/s, "
+            f"private chat {PRIVATE_CHAT_RATE_PER_SECOND}/s, group chat {GROUP_CHAT_RATE_PER_SECOND:.2f}/s)."
+        )
+
+    async def shutdown(self) -> None:
+        logger.info(f"OutboundScheduler: shutdown. Stats: {self.get_stats()}")
+
+    def get_stats(self) -> Dict[str, Union[int, float]]:
+        return dict(self._stats, chat_buckets=len(self._chat_buckets))
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get("chat_id")
+        if chat_id is None and endpoint not in _CHATLESS_LIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = _resolve_priority(endpoint, rate_limit_args)
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority, endpoint)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e_retry:
+                attempt += 1
+                self._stats["retry_after"] += 1
+                retry_after = _retry_after_seconds(e_retry)
+                self._bucket_for_retry(chat_id).pause(retry_after)
+                if attempt > self._max_retries:
+                    logger.error(
+                        f"OutboundScheduler: {endpoint} to chat {chat_id} still flood-limited "
+                        f"after {self._max_retries} retries. Giving up."
+                    )
+                    raise
+                logger.warning(
+                    f"OutboundScheduler: RetryAfter {retry_after:.1f}s on {endpoint} "
+                    f"(chat {chat_id}, attempt {attempt}/{self._max_retries})."
+                )
+
+    async def _acquire(self, chat_id: Optional[Union[int, str]], priority: int, endpoint: str) -> None:
+        if self._global_bucket is None:
+            await self.initialize()
+        self._stats["requests"] += 1
+        seq = next(self._seq)
+        wait_start_time = time.monotonic()
+        # Сначала чат (медленный лимит), потом общий: ожидание лимита чата не занимает общий токен
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire(priority, seq)
+        await self._global_bucket.acquire(priority, seq)
+        waited = time.monotonic() - wait_start_time
+        if waited > 0.05:
+            self._stats["delayed"] += 1
+            self._stats["max_wait"] = max(self._stats["max_wait"], waited)
+            logger.debug(
+                f"OutboundScheduler: {endpoint} (chat {chat_id}, priority {SendPriority(priority).name}) "
+                f"waited {waited:.4f}s for a send slot."
+            )
+
+    def _bucket_for_retry(self, chat_id: Optional[Union[int, str]]) -> _PriorityTokenBucket:
+        return self._chat_bucket(chat_id) if chat_id is not None else self._global_bucket
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> _PriorityTokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= _MAX_CHAT_BUCKETS:
+                self._evict_idle_buckets()
+            if _is_group_chat(chat_id):
+                bucket = _PriorityTokenBucket(GROUP_CHAT_RATE_PER_SECOND, GROUP_CHAT_BURST)
+            else:
+                bucket = _PriorityTokenBucket(PRIVATE_CHAT_RATE_PER_SECOND, PRIVATE_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _evict_idle_buckets(self) -> None:
+        # Полный bucket без ожидающих неотличим от нового - его можно забыть
+        idle_chat_ids = [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_idle]
+        for chat_id in idle_chat_ids:
+            del self._chat_buckets[chat_id]
+        logger.debug(f"OutboundScheduler: evicted {len(idle_chat_ids)} idle chat buckets.")
+
+
+def _resolve_priority(endpoint: str, rate_limit_args: Optional[Dict[str, Any]]) -> int:
+    if endpoint == "answerCallbackQuery":
+        return SendPriority.CALLBACK_ANSWER
+    if rate_limit_args and "priority" in rate_limit_args:
+        return int(rate_limit_args["priority"])
+    return SendPriority.INTERACTIVE
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    # В новых версиях PTB retry_after - timedelta
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def _is_group_chat(chat_id: Union[int, str]) -> bool:
+    if isinstance(chat_id, str):
+        return chat_id.startswith("@") or chat_id.startswith("-")
+    return chat_id < 0
+
+
+# Один экземпляр на процесс
+outbound_scheduler = OutboundScheduler()
+# === END BLOCK 5 ===
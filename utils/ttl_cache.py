@@ -0,0 +1,67 @@
+# utils/ttl_cache.py
+# Ограниченный по размеру кэш с временем жизни записей (LRU + TTL), для одного цикла событий
+
+# === BLOCK 1: Imports ===
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+# === END BLOCK 1 ===
+
+
+# === BLOCK 2: TTL Cache ===
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Не более maxsize записей, каждая живет ttl секунд с момента set()
+    (или свой ttl, переданный в set).
+    При переполнении вытесняется давно не читанная запись. Не потокобезопасен
+    (все обращения из цикла событий бота).
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        if maxsize <= 0 or ttl <= 0:
+            raise ValueError("TTLCache requires positive maxsize and ttl")
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+        self._stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._data.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self._stats["misses"] += 1
+            return None
+        self._data.move_to_end(key)
+        self._stats["hits"] += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        """ttl - время жизни этой записи вместо общего."""
+        self._data[key] = (time.monotonic() + (ttl if ttl is not None else self._ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self._stats, size=len(self._data))
+# === END BLOCK 2 ===